@@ -0,0 +1,139 @@
+import queue
+import subprocess
+import threading
+
+from common.default import *
+
+
+class KafkaAdminHelperError(Exception):
+    """
+    Raised when the helper process does not answer, even after a restart
+    """
+
+
+class KafkaAdminHelper(object):
+    """
+    Long-lived helper process which answers Kafka admin requests
+
+    The helper is started once and then re-used for every request, so the
+    JVM start and the TLS/SASL handshake of --command-config are only paid
+    when it (re)starts. It speaks line-delimited JSON on stdin/stdout:
+
+        -> {"id": 1, "op": "list"}
+        <- {"id": 1, "groups": ["MongoInserter", ...]}
+        -> {"id": 2, "op": "describe", "group": "MongoInserter"}
+        <- {"id": 2, "group": "MongoInserter", "lag": {"perf_db_dt_wa_raw_5": 24}}
+
+    Any response may carry "error" instead of the result. Anything the
+    helper writes to stderr is passed through to our stderr.
+
+    Attributes:
+        command (list): helper command as an array, executed as-is
+        timeout_sec (int): seconds to wait for one response (includes startup)
+    """
+
+    def __init__(self, command, timeout_sec=60):
+        self.command = command
+        self.timeout_sec = timeout_sec
+        self.process = None
+        self.responses = None
+        self.request_id = 0
+        self.starts = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.process = subprocess.Popen(self.command,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        self.starts += 1
+
+        # A reader thread turns stdout into a queue so reads can time out
+        self.responses = queue.Queue()
+        reader = threading.Thread(target=self._read_stdout,
+                                  args=(self.process.stdout, self.responses))
+        reader.daemon = True
+        reader.start()
+
+        log_to_disk('AdminHelper',
+                    lvl='INFO' if self.starts == 1 else 'WARN',
+                    msg="Started" if self.starts == 1 else "Restarted",
+                    kv=kvalue(pid=self.process.pid, starts=self.starts,
+                              command=self.command))
+
+    @staticmethod
+    def _read_stdout(stdout, responses):
+        for line in stdout:
+            responses.put(line)
+        # None marks the end of the process output
+        responses.put(None)
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process = None
+
+    def _read_response(self, request_id):
+        deadline = time.time() + self.timeout_sec
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise queue.Empty()
+            line = self.responses.get(timeout=remaining)
+            if line is None:
+                raise OSError('helper exited with returncode=' +
+                              str(self.process.wait()))
+            response = json.loads(line.decode('utf-8'))
+            # Skip a late answer to a request which already timed out
+            if response.get('id') == request_id:
+                return response
+
+    def request(self, message):
+        """
+        Sends one request and returns the response dictionary
+
+        A crashed, hung or garbled helper is killed and restarted,
+        then the request is sent once more
+        """
+        with self.lock:
+            for attempt in range(2):
+                if self.process is None or self.process.poll() is not None:
+                    self.stop()
+                    self.start()
+
+                self.request_id += 1
+                message['id'] = self.request_id
+
+                try:
+                    self.process.stdin.write((json.dumps(message) + '\n').encode('utf-8'))
+                    self.process.stdin.flush()
+                    return self._read_response(self.request_id)
+                except (OSError, ValueError, queue.Empty) as e:
+                    log_to_disk('AdminHelper', lvl='ERROR',
+                                msg="No valid response, stopping helper",
+                                kv=kvalue(request=message, attempt=attempt + 1,
+                                          exception=e.__repr__()))
+                    self.stop()
+
+        raise KafkaAdminHelperError('No response from helper for ' + json.dumps(message))
+
+    def list_groups(self):
+        response = self.request({'op': 'list'})
+        if 'error' in response:
+            raise KafkaAdminHelperError(response['error'])
+        return response['groups']
+
+    def describe_lag(self, consumer_group):
+        """
+        @retval dictionary of topic:lag summed over the topic's partitions
+        """
+        response = self.request({'op': 'describe', 'group': consumer_group})
+        if 'error' in response:
+            raise KafkaAdminHelperError(response['error'])
+        return response['lag']
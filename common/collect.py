@@ -0,0 +1,40 @@
+from concurrent.futures import TimeoutError as FuturesTimeoutError, as_completed
+
+from common.default import *
+
+
+def collect_in_pool(executor, obtain, items, deadline=None, on_result=None):
+    """
+    Runs obtain(item) for every item in executor and collects the results
+
+    Items which are not finished by deadline (epoch seconds) are abandoned
+    and left out of the results: the ones not started yet are cancelled,
+    stopping the running ones is up to the caller.
+
+    on_result is called with every result as soon as it is ready
+    (in completion order, on the calling thread), the returned results
+    keep the order of items either way.
+
+    @retval tuple of (list of results in the order of items, True if deadline was reached)
+    """
+
+    futures = [executor.submit(obtain, item) for item in items]
+    done = set()
+    deadline_reached = False
+
+    try:
+        for future in as_completed(futures,
+                                   timeout=None if deadline is None else max(deadline - time.time(), 0)):
+            done.add(future)
+            if on_result is not None:
+                on_result(future.result())
+    except FuturesTimeoutError:
+        deadline_reached = True
+        for future in futures:
+            if future not in done:
+                future.cancel()
+
+    # Keep the submission order, not the completion order
+    results = [future.result() for future in futures if future in done]
+
+    return results, deadline_reached
@@ -7,6 +7,32 @@ import os
 import yaml
 from time import sleep
 import re
+import threading
+import email.utils
+import urllib.parse
+import requests
+import requests.adapters
+
+# Shared by every Dynatrace API call, see create_http_session()
+# The calling application may replace both, e.g.
+#   common.default.http_session = create_http_session(pool_size=20)
+http_session = None
+# (connect, read) timeout in seconds
+http_timeout = (5, 30)
+
+# Token bucket per host shared by every http_request(), see rate_limit_wait()
+# http_rate_limit is requests per second, 0 disables the bucket
+# (Retry-After and X-RateLimit-Reset of a 429 are honoured either way)
+http_rate_limit = 0
+http_rate_burst = 10
+# Times a 429 is retried by http_request() once the tenant allows it again
+http_rate_retries = 2
+# Longest wait honoured from Retry-After / X-RateLimit-Reset
+http_rate_max_wait_sec = 60
+http_rate_buckets = {}
+http_rate_lock = threading.Lock()
+# Totals over all threads, the caller reports their growth per cycle
+http_rate_stats = {'throttled_sec': 0.0, 'throttled': 0, 'rate_limited': 0}
 
 
 def get_hostname():
@@ -252,6 +278,208 @@ def grab_runtime_from_disk(file):
                                 "not match token hostname")
 
 
+def create_http_session(pool_size=10):
+    """
+    Creates a requests.Session which keeps the connections to the
+    tenant alive, so only the first call pays for the TCP+TLS handshake
+
+    Attributes:
+        pool_size (int): connections kept open per host, should be at
+                         least the number of threads calling at once
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def configure_http(app_conf):
+    """
+    Sets up http_session, http_timeout and the rate limiting of http_request()
+    from the http_* keys of app_conf, shared by the scripts which call the
+    Dynatrace API
+
+    Every Dynatrace API call of a script then goes through one keep-alive
+    connection pool and the token bucket and 429 handling of its tenant,
+    for all tenants and threads
+
+    Attributes:
+        app_conf (dict): http_pool_size (default 10),
+                         http_connect_timeout_sec (default 5),
+                         http_read_timeout_sec (default 30),
+                         http_rate_limit_per_sec (default 0),
+                         http_rate_burst (default 10),
+                         http_rate_retries (default 2)
+    """
+    global http_session, http_timeout, http_rate_limit, http_rate_burst, http_rate_retries
+
+    http_session = create_http_session(
+        pool_size=int(app_conf['http_pool_size']) if 'http_pool_size' in app_conf else 10)
+    http_timeout = (
+        float(app_conf['http_connect_timeout_sec']) if 'http_connect_timeout_sec' in app_conf else 5,
+        float(app_conf['http_read_timeout_sec']) if 'http_read_timeout_sec' in app_conf else 30)
+
+    http_rate_limit = \
+        float(app_conf['http_rate_limit_per_sec']) if 'http_rate_limit_per_sec' in app_conf else 0
+    http_rate_burst = int(app_conf['http_rate_burst']) if 'http_rate_burst' in app_conf else 10
+    http_rate_retries = int(app_conf['http_rate_retries']) if 'http_rate_retries' in app_conf else 2
+
+
+def get_rate_limit_bucket(f_url):
+    """
+    @retval token bucket of the host of f_url, call with http_rate_lock held
+    """
+
+    host = urllib.parse.urlsplit(f_url).netloc
+    if host not in http_rate_buckets:
+        http_rate_buckets[host] = {'tokens': float(http_rate_burst),
+                                   'updated': time.time(),
+                                   'blocked_until': 0.0}
+    return http_rate_buckets[host]
+
+
+def rate_limit_wait(f_url):
+    """
+    Waits until the host of f_url may be called again
+
+    Every host (tenant) has a token bucket of http_rate_burst tokens
+    refilled with http_rate_limit tokens per second. Each call takes one,
+    so bursts (first-loop metric creation, split pushes, several threads)
+    are spread out instead of being answered with 429. A call which finds
+    the bucket empty reserves the next token and sleeps until it is due.
+    After a 429 every call to that host waits until blocked_until, also
+    the ones already waiting for their token.
+
+    @retval seconds waited
+    """
+
+    t_start = time.time()
+
+    with http_rate_lock:
+        bucket = get_rate_limit_bucket(f_url)
+        token_due = t_start
+        if http_rate_limit > 0:
+            bucket['tokens'] = min(float(http_rate_burst),
+                                   bucket['tokens'] + (t_start - bucket['updated']) * http_rate_limit)
+            bucket['updated'] = t_start
+            bucket['tokens'] -= 1
+            if bucket['tokens'] < 0:
+                token_due = t_start - bucket['tokens'] / http_rate_limit
+
+    while True:
+        with http_rate_lock:
+            wait_sec = max(token_due, bucket['blocked_until']) - time.time()
+        if wait_sec <= 0:
+            break
+        sleep(wait_sec)
+
+    waited_sec = time.time() - t_start
+    if waited_sec > 0.001:
+        with http_rate_lock:
+            http_rate_stats['throttled_sec'] += waited_sec
+            http_rate_stats['throttled'] += 1
+    return waited_sec
+
+
+def get_rate_limit_reset_sec(response):
+    """
+    Seconds until the tenant accepts requests again, taken from the
+    Retry-After (seconds or HTTP date) or X-RateLimit-Reset (epoch, which
+    Dynatrace sends in microseconds) headers
+
+    @retval seconds, None if the response has neither header
+    """
+
+    now = time.time()
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is not None:
+        if retry_after.strip().isdigit():
+            return float(retry_after)
+        try:
+            return email.utils.parsedate_to_datetime(retry_after).timestamp() - now
+        except (TypeError, ValueError):
+            pass
+
+    reset = response.headers.get('X-RateLimit-Reset')
+    if reset is not None:
+        try:
+            reset = float(reset)
+        except ValueError:
+            return None
+        if reset > 1e14:
+            reset = reset / 1e6
+        elif reset > 1e11:
+            reset = reset / 1e3
+        return reset - now
+
+    return None
+
+
+def rate_limit_update(f_url, response):
+    """
+    Blocks the host of f_url after a 429, or when X-RateLimit-Remaining
+    says the limit is used up, until the time the response asks for
+    (1 second after a 429 without headers), at most http_rate_max_wait_sec
+    """
+
+    reset_sec = None
+    if response.status_code == 429:
+        with http_rate_lock:
+            http_rate_stats['rate_limited'] += 1
+        reset_sec = get_rate_limit_reset_sec(response)
+        if reset_sec is None:
+            reset_sec = 1.0
+    elif response.headers.get('X-RateLimit-Remaining', '').strip() == '0':
+        reset_sec = get_rate_limit_reset_sec(response)
+
+    if reset_sec is None or reset_sec <= 0:
+        return
+
+    reset_sec = min(reset_sec, http_rate_max_wait_sec)
+    with http_rate_lock:
+        bucket = get_rate_limit_bucket(f_url)
+        bucket['blocked_until'] = max(bucket['blocked_until'], time.time() + reset_sec)
+
+
+def http_request(m, f_url, **kwargs):
+    """
+    Sends a request through the shared http_session with http_timeout,
+    paced by rate_limit_wait(); a 429 is retried up to http_rate_retries
+    times once the tenant accepts requests again
+
+    Attributes:
+        m (str): get, post, put, delete
+        f_url (str): url
+        kwargs: passed on to requests, e.g. headers, json, data
+
+    @retval requests.Response, raises requests.exceptions.RequestException
+    """
+    global http_session
+
+    if http_session is None:
+        http_session = create_http_session()
+
+    if 'timeout' not in kwargs:
+        kwargs['timeout'] = http_timeout
+
+    attempt = 0
+    while True:
+        rate_limit_wait(f_url)
+        response = http_session.request(m.upper(), f_url, **kwargs)
+        rate_limit_update(f_url, response)
+
+        if response.status_code != 429 or attempt >= http_rate_retries:
+            return response
+        attempt += 1
+        log_to_disk('HTTPRequest', lvl='WARN',
+                    msg="Rate limited, retrying",
+                    kv=kvalue(url=f_url, attempt=attempt,
+                              retry_after=response.headers.get('Retry-After'),
+                              rate_limit_reset=response.headers.get('X-RateLimit-Reset')))
+
+
 def try_request(f_url, f_headers, log_category, error_msg,
                 log_key, log_value, f_dict, json_data="", m="get"):
     """
@@ -276,21 +504,11 @@ def try_request(f_url, f_headers, log_category, error_msg,
     # Attempt requests
     response = None
 
-    # Determine method type
-    if m == "get":
-        requests_type = requests.get
-    if m == "post":
-        requests_type = requests.post
-    if m == "put":
-        requests_type = requests.put
-    if m == "delete":
-        requests_type = requests.delete
-
     try:
         if json_data == "":
-            response = requests_type(f_url, headers=f_headers)
+            response = http_request(m, f_url, headers=f_headers)
         else:
-            response = requests_type(f_url, headers=f_headers, json=json_data)
+            response = http_request(m, f_url, headers=f_headers, json=json_data)
     except requests.exceptions.RequestException as e:
         log_to_disk(log_category, lvl='ERROR',
                     msg="RequestsError "+log_key+"="+log_value,
@@ -326,7 +544,7 @@ def try_request(f_url, f_headers, log_category, error_msg,
                 f_dict['json'] = "{}"
 
             # Optional development logging: output raw f_dict['json']
-            if app_conf['debug'] is True:
+            if app_debug is True:
                 print('JSON_CONTENT:' + str(f_dict['json']))
 
             log_to_disk(log_category,
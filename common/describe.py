@@ -0,0 +1,175 @@
+import re
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Notice about one Consumer Group in the output of kafka-consumer-groups.sh --describe, e.g.
+# "Consumer group 'HARSplitter' has no active members."
+# "Error: Consumer group 'HARSplitter' does not exist."
+CONSUMER_GROUP_NOTICE = re.compile(r"Consumer group '(?P<consumer_group>[^']+)'")
+
+
+def parse_kafka_consumer_groups_describe(lines, seen_groups=None):
+    """
+    Parses the output of kafka-consumer-groups.sh --describe line by line
+
+    The output of --all-groups repeats the header line for every Consumer Group
+    (separated by empty lines and "has no active members" notices),
+    so the header keys are re-read whenever a new header block starts
+
+    seen_groups (dict), when given, collects every Consumer Group of the
+    output as a key, also the ones which only appear in a notice or whose
+    offsets are all unknown, so they are not lost with their lag
+
+    @retval generator of (consumer_group, topic, current_offset, log_end_offset, lag)
+            for each partition, offsets and lag are None when unknown
+    """
+
+    header_keys = None
+
+    for line in lines:
+        fields = line.split()
+
+        if len(fields) == 0:
+            continue
+
+        # "Consumer group 'HARSplitter' has no active members." and the like
+        notice = CONSUMER_GROUP_NOTICE.search(line)
+        if notice is not None:
+            if seen_groups is not None and 'does not exist' not in line:
+                seen_groups.setdefault(notice.group('consumer_group'), None)
+            continue
+
+        # Start of a new header block
+        if 'TOPIC' in fields and 'LAG' in fields:
+            header_keys = [x.lower() for x in fields]
+            if 'group' in header_keys:
+                group_index = header_keys.index('group')
+            else:
+                group_index = None
+            topic_index = header_keys.index('topic')
+            current_index = header_keys.index('current-offset')
+            log_end_index = header_keys.index('log-end-offset')
+            lag_index = header_keys.index('lag')
+            continue
+
+        # Skip anything else before the first header
+        if header_keys is None or len(fields) <= lag_index:
+            continue
+
+        consumer_group = fields[group_index] if group_index is not None else None
+        if seen_groups is not None and consumer_group is not None:
+            seen_groups.setdefault(consumer_group, None)
+
+        # 'unknown' (older Kafka) or '-' (newer Kafka) when nothing is committed
+        try:
+            offsets = [None if fields[i] in ('unknown', '-') else int(fields[i])
+                       for i in (current_index, log_end_index, lag_index)]
+        except ValueError:
+            continue
+
+        yield consumer_group, fields[topic_index], offsets[0], offsets[1], offsets[2]
+
+
+def sum_partition_lag(rows):
+    """
+    Sums up the LAG column by Consumer Group and topic, row by row
+    (lag_aggregation: 'streaming')
+
+    Rows with an unknown lag are skipped, a negative lag is added as it is
+
+    @retval tuple of (dictionary of consumer_group:{topic:lag}, number of partition rows)
+    """
+
+    all_groups_lag = {}
+    num_rows = 0
+
+    for consumer_group, topic, current_offset, log_end_offset, lag in rows:
+        num_rows += 1
+        topic_lag = all_groups_lag.setdefault(consumer_group, {})
+        if lag is None:
+            continue
+        if topic not in topic_lag:
+            topic_lag[topic] = lag
+        else:
+            topic_lag[topic] += lag
+
+    return all_groups_lag, num_rows
+
+
+def aggregate_partition_lag_columnar(rows, use_numpy=True):
+    """
+    Columnar alternative to sum_partition_lag() (lag_aggregation: 'columnar')
+
+    The LAG column is collected into an int64 array next to an integer code
+    per (consumer_group, topic). It is then reduced per code in one shot
+    with NumPy (sort + reduceat), or with a plain Python loop over the arrays
+    if NumPy is not installed or use_numpy is False.
+    The lag is the same as the one of sum_partition_lag()
+
+    @retval tuple of (dictionary of consumer_group:{topic:{'lag', 'max_lag', 'partitions'}},
+                      number of partition rows)
+    """
+
+    # (consumer_group, topic) -> code, in order of first appearance
+    keys = {}
+    codes = array('q')
+    lags = array('q')
+    num_rows = 0
+    # Ordered set of every consumer_group seen, even with unknown lag only
+    groups = {}
+
+    for consumer_group, topic, current_offset, log_end_offset, lag in rows:
+        num_rows += 1
+        groups.setdefault(consumer_group, None)
+        # Unknown lag does not count towards lag, max or partitions
+        if lag is None:
+            continue
+        codes.append(keys.setdefault((consumer_group, topic), len(keys)))
+        lags.append(lag)
+
+    sums = {}
+    maxima = {}
+    counts = {}
+
+    if use_numpy and numpy is not None and len(codes) > 0:
+        code_array = numpy.frombuffer(codes, dtype=numpy.int64)
+        lag_array = numpy.frombuffer(lags, dtype=numpy.int64)
+
+        # Sort by code so every code is one contiguous run, then reduce each run
+        order = numpy.argsort(code_array, kind='stable')
+        sorted_codes = code_array[order]
+        sorted_lag = lag_array[order]
+        starts = numpy.flatnonzero(numpy.concatenate(
+            ([True], sorted_codes[1:] != sorted_codes[:-1])))
+
+        unique_codes = sorted_codes[starts].tolist()
+        sums = dict(zip(unique_codes, numpy.add.reduceat(sorted_lag, starts).tolist()))
+        maxima = dict(zip(unique_codes, numpy.maximum.reduceat(sorted_lag, starts).tolist()))
+        counts = dict(zip(unique_codes, numpy.diff(
+            numpy.append(starts, len(sorted_codes))).tolist()))
+    else:
+        for code, lag in zip(codes, lags):
+            if code not in sums:
+                sums[code] = lag
+                maxima[code] = lag
+                counts[code] = 1
+            else:
+                sums[code] += lag
+                maxima[code] = max(maxima[code], lag)
+                counts[code] += 1
+
+    all_groups_stats = {}
+    for consumer_group in groups:
+        all_groups_stats[consumer_group] = {}
+    for (consumer_group, topic), code in keys.items():
+        stats = {}
+        stats['lag'] = sums[code]
+        stats['max_lag'] = maxima[code]
+        stats['partitions'] = counts[code]
+        all_groups_stats[consumer_group][topic] = stats
+
+    return all_groups_stats, num_rows
@@ -0,0 +1,818 @@
+import socket
+import ssl
+import struct
+
+from common.default import *
+
+#   -----------------------------------   #
+#            KAFKA PROTOCOL CONSTANTS
+#   -----------------------------------   #
+
+API_LIST_OFFSETS = 2
+API_METADATA = 3
+API_OFFSET_FETCH = 9
+API_FIND_COORDINATOR = 10
+API_DESCRIBE_GROUPS = 15
+API_LIST_GROUPS = 16
+API_SASL_HANDSHAKE = 17
+API_VERSIONS = 18
+API_SASL_AUTHENTICATE = 36
+
+# Request versions this client knows how to encode and decode
+# (all of them use the non-flexible request header v1 / response header v0)
+# The highest version supported by both client and broker is used
+CLIENT_API_VERSIONS = {
+    API_LIST_OFFSETS: (1, 5),
+    API_METADATA: (1, 8),
+    API_OFFSET_FETCH: (2, 5),
+    API_FIND_COORDINATOR: (0, 2),
+    API_DESCRIBE_GROUPS: (0, 4),
+    API_LIST_GROUPS: (0, 2),
+    API_SASL_HANDSHAKE: (1, 1),
+    API_SASL_AUTHENTICATE: (0, 0),
+}
+
+ERROR_NONE = 0
+ERROR_UNKNOWN_TOPIC_OR_PARTITION = 3
+ERROR_LEADER_NOT_AVAILABLE = 5
+ERROR_NOT_LEADER_FOR_PARTITION = 6
+ERROR_COORDINATOR_LOAD_IN_PROGRESS = 14
+ERROR_COORDINATOR_NOT_AVAILABLE = 15
+ERROR_NOT_COORDINATOR = 16
+ERROR_GROUP_ID_NOT_FOUND = 69
+ERROR_FENCED_LEADER_EPOCH = 74
+ERROR_UNKNOWN_LEADER_EPOCH = 75
+
+COORDINATOR_ERRORS = (ERROR_COORDINATOR_LOAD_IN_PROGRESS,
+                      ERROR_COORDINATOR_NOT_AVAILABLE,
+                      ERROR_NOT_COORDINATOR)
+
+LEADER_ERRORS = (ERROR_UNKNOWN_TOPIC_OR_PARTITION,
+                 ERROR_LEADER_NOT_AVAILABLE,
+                 ERROR_NOT_LEADER_FOR_PARTITION,
+                 ERROR_FENCED_LEADER_EPOCH,
+                 ERROR_UNKNOWN_LEADER_EPOCH)
+
+# ListOffsets timestamp which requests the log-end offset
+LATEST_TIMESTAMP = -1
+
+
+class KafkaWireError(Exception):
+    """
+    Raised when a broker cannot be reached or answers with an error code
+    """
+
+    def __init__(self, msg, error_code=None):
+        Exception.__init__(self, msg)
+        self.error_code = error_code
+
+
+#   -----------------------------------   #
+#            ENCODING / DECODING
+#   -----------------------------------   #
+
+def encode_int8(value):
+    return struct.pack('>b', value)
+
+
+def encode_int16(value):
+    return struct.pack('>h', value)
+
+
+def encode_int32(value):
+    return struct.pack('>i', value)
+
+
+def encode_int64(value):
+    return struct.pack('>q', value)
+
+
+def encode_string(value):
+    if value is None:
+        return encode_int16(-1)
+    encoded = value.encode('utf-8')
+    return encode_int16(len(encoded)) + encoded
+
+
+def encode_bytes(value):
+    if value is None:
+        return encode_int32(-1)
+    return encode_int32(len(value)) + value
+
+
+def encode_array(items, encode_item):
+    # A None array is encoded as the null array (length -1)
+    if items is None:
+        return encode_int32(-1)
+    return encode_int32(len(items)) + b''.join(encode_item(x) for x in items)
+
+
+class KafkaWireReader(object):
+    """
+    Sequential decoder for a Kafka response (or request) body
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def _unpack(self, fmt, size):
+        if self.pos + size > len(self.data):
+            raise KafkaWireError('Truncated Kafka message')
+        value = struct.unpack_from(fmt, self.data, self.pos)[0]
+        self.pos += size
+        return value
+
+    def int8(self):
+        return self._unpack('>b', 1)
+
+    def int16(self):
+        return self._unpack('>h', 2)
+
+    def int32(self):
+        return self._unpack('>i', 4)
+
+    def int64(self):
+        return self._unpack('>q', 8)
+
+    def raw(self, size):
+        if self.pos + size > len(self.data):
+            raise KafkaWireError('Truncated Kafka message')
+        value = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return value
+
+    def string(self):
+        size = self.int16()
+        if size < 0:
+            return None
+        return self.raw(size).decode('utf-8')
+
+    def bytes(self):
+        size = self.int32()
+        if size < 0:
+            return None
+        return self.raw(size)
+
+    def array(self, decode_item):
+        size = self.int32()
+        if size < 0:
+            return None
+        return [decode_item() for _ in range(size)]
+
+
+#   -----------------------------------   #
+#            BROKER CONNECTION
+#   -----------------------------------   #
+
+class KafkaBrokerConnection(object):
+    """
+    One persistent socket to one broker
+
+    Negotiates API versions with ApiVersions on connect and re-connects
+    once if the socket was dropped between two requests
+    """
+
+    def __init__(self, host, port, client_id='consumerlag', timeout_sec=10,
+                 ssl_context=None, sasl_username=None, sasl_password=None):
+        self.host = host
+        self.port = int(port)
+        self.client_id = client_id
+        self.timeout_sec = timeout_sec
+        self.ssl_context = ssl_context
+        self.sasl_username = sasl_username
+        self.sasl_password = sasl_password
+        self.sock = None
+        self.correlation_id = 0
+        self.api_versions = {}
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port),
+                                        timeout=self.timeout_sec)
+        if self.ssl_context is not None:
+            sock = self.ssl_context.wrap_socket(sock, server_hostname=self.host)
+        self.sock = sock
+        self.api_versions = self._request_api_versions()
+        if self.sasl_username is not None:
+            self._sasl_plain_authenticate()
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+
+    def version(self, api_key):
+        """
+        Returns the highest version of api_key supported by client and broker
+        """
+        client_min, client_max = CLIENT_API_VERSIONS[api_key]
+        if api_key not in self.api_versions:
+            raise KafkaWireError('Broker ' + self.host + ':' + str(self.port) +
+                                 ' does not support api_key=' + str(api_key))
+        broker_min, broker_max = self.api_versions[api_key]
+        version = min(client_max, broker_max)
+        if version < max(client_min, broker_min):
+            raise KafkaWireError('No common version for api_key=' + str(api_key) +
+                                 ' broker=' + str(self.api_versions[api_key]) +
+                                 ' client=' + str(CLIENT_API_VERSIONS[api_key]))
+        return version
+
+    def _recv_exact(self, size):
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            chunk = self.sock.recv(remaining)
+            if not chunk:
+                raise OSError('Connection closed by broker')
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)
+
+    def _send_and_receive(self, api_key, api_version, body):
+        self.correlation_id = (self.correlation_id + 1) % 2147483647
+        header = encode_int16(api_key) + \
+            encode_int16(api_version) + \
+            encode_int32(self.correlation_id) + \
+            encode_string(self.client_id)
+        payload = header + body
+        self.sock.sendall(encode_int32(len(payload)) + payload)
+
+        size = struct.unpack('>i', self._recv_exact(4))[0]
+        reader = KafkaWireReader(self._recv_exact(size))
+        if reader.int32() != self.correlation_id:
+            raise KafkaWireError('Correlation id mismatch from broker ' +
+                                 self.host + ':' + str(self.port))
+        return reader
+
+    def _request_api_versions(self):
+        reader = self._send_and_receive(API_VERSIONS, 0, b'')
+        error_code = reader.int16()
+        if error_code != ERROR_NONE:
+            raise KafkaWireError('ApiVersions failed', error_code)
+        api_versions = {}
+        for api_key, min_version, max_version in reader.array(
+                lambda: (reader.int16(), reader.int16(), reader.int16())):
+            api_versions[api_key] = (min_version, max_version)
+        return api_versions
+
+    def _sasl_plain_authenticate(self):
+        reader = self._send_and_receive(API_SASL_HANDSHAKE,
+                                        self.version(API_SASL_HANDSHAKE),
+                                        encode_string('PLAIN'))
+        error_code = reader.int16()
+        if error_code != ERROR_NONE:
+            raise KafkaWireError('SASL mechanism PLAIN not enabled, broker offers ' +
+                                 str(reader.array(reader.string)), error_code)
+
+        token = b'\x00' + self.sasl_username.encode('utf-8') + \
+            b'\x00' + self.sasl_password.encode('utf-8')
+        reader = self._send_and_receive(API_SASL_AUTHENTICATE,
+                                        self.version(API_SASL_AUTHENTICATE),
+                                        encode_bytes(token))
+        error_code = reader.int16()
+        error_message = reader.string()
+        if error_code != ERROR_NONE:
+            raise KafkaWireError('SASL authentication failed: ' +
+                                 str(error_message), error_code)
+
+    def request(self, api_key, body_for_version):
+        """
+        Sends one request and returns a KafkaWireReader positioned after the
+        response header plus the version that was used
+
+        body_for_version(version) must return the encoded request body
+        """
+        for attempt in range(2):
+            try:
+                if self.sock is None:
+                    self.connect()
+                version = self.version(api_key)
+                return self._send_and_receive(api_key, version,
+                                              body_for_version(version)), version
+            except (OSError, socket.timeout) as e:
+                self.close()
+                if attempt == 1:
+                    raise KafkaWireError('Unable to reach broker ' + self.host +
+                                         ':' + str(self.port) + ' error=' + e.__str__())
+
+
+#   -----------------------------------   #
+#            CLIENT
+#   -----------------------------------   #
+
+class KafkaWireClient(object):
+    """
+    Minimal Kafka client which computes Consumer Lag without the JVM tooling
+
+    Keeps one persistent connection per broker and caches the cluster
+    metadata (partition leaders) and group coordinators between calls.
+
+    Attributes:
+        bootstrap_servers (list): ['host:port', ...]
+        client_id (str): client.id presented to the brokers
+        timeout_sec (int): socket connect/read timeout
+        security_protocol (str): PLAINTEXT, SSL, SASL_PLAINTEXT or SASL_SSL
+        ssl_cafile (str): optional CA bundle for SSL
+        sasl_username (str): SASL/PLAIN username
+        sasl_password (str): SASL/PLAIN password
+    """
+
+    def __init__(self, bootstrap_servers, client_id='consumerlag',
+                 timeout_sec=10, security_protocol='PLAINTEXT',
+                 ssl_cafile=None, sasl_username=None, sasl_password=None):
+        self.bootstrap_servers = bootstrap_servers
+        self.client_id = client_id
+        self.timeout_sec = timeout_sec
+
+        security_protocol = security_protocol.upper()
+        self.ssl_context = None
+        if security_protocol in ('SSL', 'SASL_SSL'):
+            self.ssl_context = ssl.create_default_context(cafile=ssl_cafile or None)
+        if security_protocol in ('SASL_PLAINTEXT', 'SASL_SSL'):
+            self.sasl_username = sasl_username
+            self.sasl_password = sasl_password
+        else:
+            self.sasl_username = None
+            self.sasl_password = None
+
+        # node_id -> (host, port)
+        self.brokers = {}
+        # node_id -> KafkaBrokerConnection
+        self.connections = {}
+        # (topic, partition) -> leader node_id
+        self.leaders = {}
+        # consumer_group -> coordinator node_id
+        self.coordinators = {}
+
+        # Filled by prefetch_cycle(), emptied by end_cycle()
+        # consumer_group -> {(topic, partition): committed_offset} or KafkaWireError
+        self.cycle_committed = {}
+        # (topic, partition) -> log_end_offset, shared by all groups of the cycle
+        self.cycle_log_end_offsets = {}
+
+        # Number of ListOffsets requests sent, for reporting
+        self.list_offsets_requests = 0
+
+    def _new_connection(self, host, port):
+        return KafkaBrokerConnection(host, port,
+                                     client_id=self.client_id,
+                                     timeout_sec=self.timeout_sec,
+                                     ssl_context=self.ssl_context,
+                                     sasl_username=self.sasl_username,
+                                     sasl_password=self.sasl_password)
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+        self.connections = {}
+
+    def connection(self, node_id):
+        if node_id not in self.connections:
+            if node_id not in self.brokers:
+                self.refresh_metadata(topics=[])
+            if node_id not in self.brokers:
+                raise KafkaWireError('Unknown broker node_id=' + str(node_id))
+            host, port = self.brokers[node_id]
+            self.connections[node_id] = self._new_connection(host, port)
+        return self.connections[node_id]
+
+    def _any_connection(self):
+        """
+        Returns a connection to any live broker, bootstrapping if needed
+        """
+        if len(self.connections) > 0:
+            return next(iter(self.connections.values()))
+
+        errors = []
+        for server in self.bootstrap_servers:
+            host, port = server.rsplit(':', 1)
+            connection = self._new_connection(host, port)
+            try:
+                connection.connect()
+            except (OSError, KafkaWireError) as e:
+                connection.close()
+                errors.append(server + ' ' + e.__str__())
+                continue
+            # Bootstrap connections are kept under a negative key until the
+            # metadata tells us the node_id behind them
+            self.connections[-1] = connection
+            return connection
+
+        raise KafkaWireError('Unable to reach any bootstrap server: ' + str(errors))
+
+    def _request_any(self, api_key, body_for_version):
+        connection = self._any_connection()
+        try:
+            return connection.request(api_key, body_for_version)
+        except KafkaWireError:
+            # Close and drop the connection so the next call tries another broker
+            connection.close()
+            for node_id in [k for k, v in self.connections.items() if v is connection]:
+                del self.connections[node_id]
+            raise
+
+    def refresh_metadata(self, topics=None):
+        """
+        Refreshes brokers and partition leaders
+
+        topics=None fetches every topic, topics=[] fetches brokers only
+        """
+
+        def body(version):
+            data = encode_array(topics, encode_string)
+            if version >= 4:
+                # allow_auto_topic_creation
+                data += encode_int8(0)
+            if version >= 8:
+                # include_cluster/topic_authorized_operations
+                data += encode_int8(0) + encode_int8(0)
+            return data
+
+        reader, version = self._request_any(API_METADATA, body)
+
+        if version >= 3:
+            reader.int32()  # throttle_time_ms
+
+        def decode_broker():
+            node_id = reader.int32()
+            host = reader.string()
+            port = reader.int32()
+            reader.string()  # rack
+            return node_id, host, port
+
+        brokers = reader.array(decode_broker)
+        if version >= 2:
+            reader.string()  # cluster_id
+        reader.int32()  # controller_id
+
+        def decode_partition():
+            error_code = reader.int16()
+            partition = reader.int32()
+            leader = reader.int32()
+            if version >= 7:
+                reader.int32()  # leader_epoch
+            reader.array(reader.int32)  # replica_nodes
+            reader.array(reader.int32)  # isr_nodes
+            if version >= 5:
+                reader.array(reader.int32)  # offline_replicas
+            return error_code, partition, leader
+
+        def decode_topic():
+            error_code = reader.int16()
+            name = reader.string()
+            reader.int8()  # is_internal
+            partitions = reader.array(decode_partition)
+            if version >= 8:
+                reader.int32()  # topic_authorized_operations
+            return error_code, name, partitions
+
+        topic_metadata = reader.array(decode_topic)
+
+        self.brokers = {}
+        for node_id, host, port in brokers:
+            self.brokers[node_id] = (host, port)
+
+        # Re-key the bootstrap connection once we know which node it is
+        if -1 in self.connections:
+            bootstrap = self.connections.pop(-1)
+            for node_id, (host, port) in self.brokers.items():
+                if (host, port) == (bootstrap.host, bootstrap.port) \
+                        and node_id not in self.connections:
+                    self.connections[node_id] = bootstrap
+                    break
+            else:
+                bootstrap.close()
+
+        # Forget connections to brokers which left the cluster
+        for node_id in list(self.connections):
+            if node_id not in self.brokers:
+                self.connections.pop(node_id).close()
+
+        for error_code, name, partitions in topic_metadata:
+            if error_code != ERROR_NONE:
+                continue
+            for partition_error, partition, leader in partitions:
+                if leader >= 0:
+                    self.leaders[(name, partition)] = leader
+                else:
+                    self.leaders.pop((name, partition), None)
+
+    def list_groups(self):
+        """
+        Returns the consumer groups known to every broker in the cluster
+
+        Each broker only lists the groups it coordinates,
+        so ListGroups is sent to all of them
+        """
+        self.refresh_metadata(topics=[])
+
+        groups = set()
+        for node_id in list(self.brokers):
+            reader, version = self.connection(node_id).request(
+                API_LIST_GROUPS, lambda version: b'')
+            if version >= 1:
+                reader.int32()  # throttle_time_ms
+            error_code = reader.int16()
+            if error_code != ERROR_NONE:
+                raise KafkaWireError('ListGroups failed on node_id=' +
+                                     str(node_id), error_code)
+            for group_id, protocol_type in reader.array(
+                    lambda: (reader.string(), reader.string())):
+                # Same filter as kafka-consumer-groups.sh --list
+                if protocol_type in ('consumer', ''):
+                    groups.add(group_id)
+
+        return list(groups)
+
+    def find_coordinator(self, consumer_group):
+        if consumer_group in self.coordinators:
+            return self.coordinators[consumer_group]
+
+        def body(version):
+            data = encode_string(consumer_group)
+            if version >= 1:
+                data += encode_int8(0)  # key_type GROUP
+            return data
+
+        reader, version = self._request_any(API_FIND_COORDINATOR, body)
+        error_message = None
+        if version >= 1:
+            reader.int32()  # throttle_time_ms
+        error_code = reader.int16()
+        if version >= 1:
+            error_message = reader.string()
+        node_id = reader.int32()
+        host = reader.string()
+        port = reader.int32()
+
+        if error_code != ERROR_NONE:
+            raise KafkaWireError('FindCoordinator failed for consumer_group=' +
+                                 consumer_group + ' ' + str(error_message), error_code)
+
+        self.brokers[node_id] = (host, port)
+        self.coordinators[consumer_group] = node_id
+        return node_id
+
+    def fetch_committed_offsets(self, consumer_group):
+        """
+        Returns {(topic, partition): committed_offset} for every partition
+        the consumer group has committed an offset for
+        """
+        for attempt in range(2):
+            node_id = self.find_coordinator(consumer_group)
+
+            # A null topic array asks for all committed offsets of the group
+            def body(version):
+                return encode_string(consumer_group) + encode_array(None, None)
+
+            reader, version = self.connection(node_id).request(API_OFFSET_FETCH, body)
+            if version >= 3:
+                reader.int32()  # throttle_time_ms
+
+            def decode_partition():
+                partition = reader.int32()
+                offset = reader.int64()
+                if version >= 5:
+                    reader.int32()  # committed_leader_epoch
+                reader.string()  # metadata
+                error_code = reader.int16()
+                return partition, offset, error_code
+
+            topics = reader.array(lambda: (reader.string(),
+                                           reader.array(decode_partition)))
+            error_code = reader.int16()
+
+            if error_code in COORDINATOR_ERRORS and attempt == 0:
+                # Coordinator moved or is loading, look it up again
+                self.coordinators.pop(consumer_group, None)
+                sleep(0.1)
+                continue
+            if error_code == ERROR_GROUP_ID_NOT_FOUND:
+                raise KafkaWireError('Consumer group ' + consumer_group +
+                                     ' does not exist', error_code)
+            if error_code != ERROR_NONE:
+                raise KafkaWireError('OffsetFetch failed for consumer_group=' +
+                                     consumer_group, error_code)
+
+            committed = {}
+            for topic, partitions in topics:
+                for partition, offset, partition_error in partitions:
+                    # offset -1 means nothing committed ("unknown" in the describe output)
+                    if partition_error == ERROR_NONE and offset >= 0:
+                        committed[(topic, partition)] = offset
+            return committed
+
+        raise KafkaWireError('Coordinator unavailable for consumer_group=' + consumer_group)
+
+    def group_exists(self, consumer_group):
+        """
+        Asks the group coordinator for the state of consumer_group,
+        like kafka-consumer-groups.sh does before it reports
+        "Consumer group ... does not exist"
+
+        @retval False if the coordinator knows no such group (state Dead)
+        """
+        node_id = self.find_coordinator(consumer_group)
+
+        def body(version):
+            data = encode_array([consumer_group], encode_string)
+            if version >= 3:
+                data += encode_int8(0)  # include_authorized_operations
+            return data
+
+        reader, version = self.connection(node_id).request(API_DESCRIBE_GROUPS, body)
+        if version >= 1:
+            reader.int32()  # throttle_time_ms
+
+        def decode_member():
+            reader.string()  # member_id
+            if version >= 4:
+                reader.string()  # group_instance_id
+            reader.string()  # client_id
+            reader.string()  # client_host
+            reader.bytes()  # member_metadata
+            reader.bytes()  # member_assignment
+
+        def decode_group():
+            error_code = reader.int16()
+            reader.string()  # group_id
+            state = reader.string()
+            reader.string()  # protocol_type
+            reader.string()  # protocol_data
+            reader.array(decode_member)
+            if version >= 3:
+                reader.int32()  # authorized_operations
+            return error_code, state
+
+        for error_code, state in reader.array(decode_group):
+            if error_code == ERROR_GROUP_ID_NOT_FOUND:
+                return False
+            if error_code != ERROR_NONE:
+                raise KafkaWireError('DescribeGroups failed for consumer_group=' +
+                                     consumer_group, error_code)
+            return state != 'Dead'
+        return False
+
+    def list_log_end_offsets(self, topic_partitions):
+        """
+        Returns {(topic, partition): log_end_offset}
+
+        Sends one batched ListOffsets request per partition leader
+        """
+        result = {}
+        pending = list(topic_partitions)
+
+        for attempt in range(2):
+            missing_topics = sorted(set(t for t, p in pending if (t, p) not in self.leaders))
+            if len(missing_topics) > 0:
+                self.refresh_metadata(topics=missing_topics)
+
+            # Group partitions by leader
+            by_leader = {}
+            for topic, partition in pending:
+                leader = self.leaders.get((topic, partition))
+                if leader is not None:
+                    by_leader.setdefault(leader, {}).setdefault(topic, []).append(partition)
+
+            retry = []
+            for leader, topics in by_leader.items():
+                retry += self._list_offsets_from_leader(leader, topics, result)
+
+            if len(retry) == 0:
+                break
+            # Leadership moved, drop the cached leaders and try once more
+            for topic_partition in retry:
+                self.leaders.pop(topic_partition, None)
+            pending = retry
+
+        return result
+
+    def _list_offsets_from_leader(self, leader, topics, result):
+
+        def encode_partition(partition, version):
+            data = encode_int32(partition)
+            if version >= 4:
+                data += encode_int32(-1)  # current_leader_epoch
+            return data + encode_int64(LATEST_TIMESTAMP)
+
+        def body(version):
+            data = encode_int32(-1)  # replica_id
+            if version >= 2:
+                data += encode_int8(0)  # isolation_level READ_UNCOMMITTED
+            return data + encode_array(
+                sorted(topics.items()),
+                lambda item: encode_string(item[0]) +
+                encode_array(item[1], lambda p: encode_partition(p, version)))
+
+        self.list_offsets_requests += 1
+        try:
+            reader, version = self.connection(leader).request(API_LIST_OFFSETS, body)
+        except KafkaWireError:
+            # Broker is gone, close its socket and retry all of its
+            # partitions after a metadata refresh
+            connection = self.connections.pop(leader, None)
+            if connection is not None:
+                connection.close()
+            return [(t, p) for t, partitions in topics.items() for p in partitions]
+
+        if version >= 2:
+            reader.int32()  # throttle_time_ms
+
+        def decode_partition():
+            partition = reader.int32()
+            error_code = reader.int16()
+            reader.int64()  # timestamp
+            offset = reader.int64()
+            if version >= 4:
+                reader.int32()  # leader_epoch
+            return partition, error_code, offset
+
+        retry = []
+        for topic, partitions in reader.array(lambda: (reader.string(),
+                                                       reader.array(decode_partition))):
+            for partition, error_code, offset in partitions:
+                if error_code == ERROR_NONE:
+                    result[(topic, partition)] = offset
+                elif error_code in LEADER_ERRORS:
+                    retry.append((topic, partition))
+        return retry
+
+    def prefetch_cycle(self, consumer_groups):
+        """
+        Prepares describe_lag() for a whole loop of Consumer Groups
+
+        First the committed offsets of every group are fetched, then the
+        log-end offset of every partition consumed by any of them is fetched
+        exactly once (one batched ListOffsets per leader). Topics read by many
+        groups are therefore not re-fetched for each group, and the log-end
+        offsets are never older than the committed offsets they are compared to.
+
+        @retval number of distinct partitions
+        """
+        self.end_cycle()
+
+        for consumer_group in consumer_groups:
+            try:
+                self.cycle_committed[consumer_group] = \
+                    self.fetch_committed_offsets(consumer_group)
+            except KafkaWireError as e:
+                # Raised again by describe_lag() for this group only
+                self.cycle_committed[consumer_group] = e
+
+        partitions = set()
+        for committed in self.cycle_committed.values():
+            if not isinstance(committed, KafkaWireError):
+                partitions.update(committed)
+
+        try:
+            self.cycle_log_end_offsets = self.list_log_end_offsets(sorted(partitions))
+        except KafkaWireError:
+            # describe_lag() falls back to fetching per group
+            self.end_cycle()
+            raise
+
+        return len(partitions)
+
+    def end_cycle(self):
+        self.cycle_committed = {}
+        self.cycle_log_end_offsets = {}
+
+    def describe_lag(self, consumer_group):
+        """
+        Equivalent of kafka-consumer-groups.sh --describe --group
+
+        Uses the offsets of prefetch_cycle() when the group was prefetched
+
+        A group without any committed offset is looked up with group_exists(),
+        one which is gone raises KafkaWireError "Consumer group ... does not exist"
+        (error_code ERROR_GROUP_ID_NOT_FOUND), the same words as the describe output
+
+        @retval dictionary of topic:lag summed over the topic's partitions
+        """
+        if consumer_group in self.cycle_committed:
+            committed = self.cycle_committed.pop(consumer_group)
+            if isinstance(committed, KafkaWireError):
+                raise committed
+            log_end_offsets = self.cycle_log_end_offsets
+        else:
+            committed = self.fetch_committed_offsets(consumer_group)
+            log_end_offsets = None
+
+        if len(committed) == 0:
+            if not self.group_exists(consumer_group):
+                raise KafkaWireError('Consumer group ' + consumer_group +
+                                     ' does not exist', ERROR_GROUP_ID_NOT_FOUND)
+            return {}
+        if log_end_offsets is None:
+            log_end_offsets = self.list_log_end_offsets(list(committed))
+
+        topic_lag = {}
+        for (topic, partition), offset in sorted(committed.items()):
+            if (topic, partition) not in log_end_offsets:
+                continue
+            lag = max(log_end_offsets[(topic, partition)] - offset, 0)
+            topic_lag[topic] = topic_lag.get(topic, 0) + lag
+        return topic_lag
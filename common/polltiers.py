@@ -0,0 +1,112 @@
+from common.default import *
+
+
+def select_consumer_groups_to_poll(consumer_groups_list, poll_state, loop_started_at,
+                                   poll_tiers, loop_interval_sec):
+    """
+    Picks the Consumer Groups whose poll_tiers interval has passed
+
+    poll_state holds tier, polled_at and max_lag of every Consumer Group
+    placed by update_poll_tiers(), an empty poll_tiers polls every group
+
+    Groups which were never polled (or whose last poll was abandoned)
+    are always due. Half a loop_interval_sec of tolerance keeps a group
+    with poll_every_sec: 60 from slipping to every other loop because
+    of a few milliseconds of jitter in the loop start.
+
+    @retval list of Consumer Groups to poll this loop, in list order
+    """
+
+    if len(poll_tiers) == 0:
+        return consumer_groups_list
+
+    tolerance_sec = loop_interval_sec / 2.0
+    poll_tiers_by_name = dict((x['name'], x) for x in poll_tiers)
+
+    consumer_groups_due = []
+    due_per_tier = {}
+    for consumer_group in consumer_groups_list:
+        if consumer_group not in poll_state:
+            tier = 'new'
+        else:
+            tier = poll_state[consumer_group]['tier']
+            poll_every_sec = float(poll_tiers_by_name[tier]['poll_every_sec'])
+            if loop_started_at - poll_state[consumer_group]['polled_at'] < poll_every_sec - tolerance_sec:
+                continue
+        consumer_groups_due.append(consumer_group)
+        due_per_tier[tier] = due_per_tier.get(tier, 0) + 1
+
+    log_to_disk('PollTiers',
+                msg="Due",
+                kv=kvalue(consumer_groups=len(consumer_groups_list),
+                          consumer_groups_due=len(consumer_groups_due),
+                          due_per_tier=due_per_tier))
+
+    return consumer_groups_due
+
+
+def update_poll_tiers(consumer_groups_lag, consumer_groups_list, poll_state, loop_started_at,
+                      poll_tiers, get_threshold):
+    """
+    Places each polled Consumer Group into the first tier of poll_tiers
+    whose conditions it meets, the last tier takes all the others
+
+    A tier matches when the highest topic lag of the group reaches
+    min_threshold_ratio of its threshold (get_threshold(consumer_group),
+    None when it has none), or when that lag grew by at least
+    min_growth_per_sec since the previous poll.
+    Groups which are not in consumer_groups_list anymore are dropped.
+    """
+
+    if len(poll_tiers) == 0:
+        return
+
+    for consumer_group in list(poll_state):
+        if consumer_group not in consumer_groups_list:
+            del poll_state[consumer_group]
+
+    for result in consumer_groups_lag:
+        consumer_group = result['consumer_group']
+        consumer_group_lag = result['consumer_group_lag']
+        previous = poll_state.get(consumer_group)
+
+        # Keep the tier of a group whose lag could not be obtained,
+        # the next poll follows the same interval
+        if consumer_group_lag is False or len(consumer_group_lag) == 0:
+            if previous is not None:
+                previous['polled_at'] = loop_started_at
+            continue
+
+        max_lag = max(consumer_group_lag.values())
+        growth_per_sec = 0.0
+        if previous is not None and previous['max_lag'] is not None \
+                and loop_started_at > previous['polled_at']:
+            growth_per_sec = (max_lag - previous['max_lag']) / (loop_started_at - previous['polled_at'])
+
+        threshold = get_threshold(consumer_group)
+
+        tier = poll_tiers[-1]['name']
+        for poll_tier in poll_tiers[:-1]:
+            if 'min_threshold_ratio' in poll_tier and threshold is not None \
+                    and max_lag >= float(poll_tier['min_threshold_ratio']) * threshold:
+                tier = poll_tier['name']
+                break
+            if 'min_growth_per_sec' in poll_tier \
+                    and growth_per_sec >= float(poll_tier['min_growth_per_sec']):
+                tier = poll_tier['name']
+                break
+
+        if previous is not None and previous['tier'] != tier:
+            log_to_disk('PollTiers',
+                        msg="Tier changed",
+                        kv=kvalue(consumer_group=consumer_group,
+                                  previous_tier=previous['tier'],
+                                  tier=tier,
+                                  max_lag=max_lag,
+                                  threshold=threshold,
+                                  growth_per_sec=round(growth_per_sec, 1)))
+
+        poll_state[consumer_group] = {}
+        poll_state[consumer_group]['tier'] = tier
+        poll_state[consumer_group]['polled_at'] = loop_started_at
+        poll_state[consumer_group]['max_lag'] = max_lag
@@ -0,0 +1,352 @@
+import json
+from array import array
+
+from common.default import *
+
+
+class CycleSamples(object):
+    """
+    Compact buffer of the data points collected for one push
+
+    Instead of a dictionary per series and a list per data point, every
+    data point is three 8-byte integers in parallel arrays (its series
+    number, timestamp and value). A series is its template (see
+    SeriesTemplates), which holds the
+    timeseriesId, the dimensions and the JSON of the series up to its
+    dataPoints, and is shared by every push:
+
+        templates:  [template of GroupA/topic_a, template of GroupB/topic_b]
+        series_no:  array('q', [0, 1, 0])
+        timestamps: array('q', [1520803905262, 1520803905301, 1520803920262])
+        values:     array('q', [54171, 169, 54012])
+
+    The push is rendered from these arrays, one series at a time, by
+    iter_series_json() (the body) or iter_series_dicts() (the debug log),
+    or one data point at a time by iter_lines() (Metrics API v2).
+
+    Attributes:
+        metric_type (str): 'type' of the pushed JSON
+    """
+
+    __slots__ = ('metric_type', 'templates', 'series_numbers',
+                 'series_no', 'timestamps', 'values')
+
+    def __init__(self, metric_type='Kafka'):
+        self.metric_type = metric_type
+        # Template of every series, in the order first seen
+        self.templates = []
+        # Template key -> number of its series in templates
+        self.series_numbers = {}
+        self.series_no = array('q')
+        self.timestamps = array('q')
+        self.values = array('q')
+
+    def __len__(self):
+        return len(self.series_no)
+
+    def num_series(self):
+        return len(self.templates)
+
+    def append(self, template, timestamp, value):
+        """
+        Appends one data point to the series of template, a series
+        already in the buffer gets another data point
+        """
+
+        series_no = self.series_numbers.get(template['key'])
+        if series_no is None:
+            series_no = len(self.templates)
+            self.series_numbers[template['key']] = series_no
+            self.templates.append(template)
+
+        self.series_no.append(series_no)
+        self.timestamps.append(timestamp)
+        self.values.append(value)
+
+    def iter_series(self):
+        """
+        Yields (template, data_points) per series in the order first seen,
+        data_points being (timestamp, value) pairs in the order appended
+        """
+
+        # Every series has a single data point (one loop per push)
+        if len(self.series_no) == len(self.templates):
+            for template, timestamp, value in zip(self.templates, self.timestamps, self.values):
+                yield template, ((timestamp, value),)
+            return
+
+        # Data points of several loops, grouped by series (sorted() is stable)
+        order = sorted(range(len(self.series_no)), key=self.series_no.__getitem__)
+        start = 0
+        while start < len(order):
+            series_no = self.series_no[order[start]]
+            end = start
+            while end < len(order) and self.series_no[order[end]] == series_no:
+                end += 1
+            yield self.templates[series_no], \
+                [(self.timestamps[i], self.values[i]) for i in order[start:end]]
+            start = end
+
+    def iter_series_json(self):
+        """
+        Yields the JSON bytes of every series, the same bytes as
+        json.dumps() of its dictionary
+        """
+
+        for template, data_points in self.iter_series():
+            yield template['json_prefix'] + b'[' + \
+                b', '.join([b'[%d, %d]' % data_point for data_point in data_points]) + b']}'
+
+    def iter_series_dicts(self):
+        """
+        Yields every series as the dictionary of the Dynatrace JSON
+        """
+
+        for template, data_points in self.iter_series():
+            series = {}
+            series['timeseriesId'] = template['timeseriesId']
+            series['dimensions'] = template['dimensions']
+            series['dataPoints'] = [list(data_point) for data_point in data_points]
+            yield series
+
+    def iter_lines(self, dimensions=b''):
+        """
+        Yields one line of the Metrics API v2 line protocol per data point,
+        in the order appended, the template's line_prefix followed by
+        dimensions (bytes shared by every line), the value and the timestamp:
+
+            kafka.consumerlag,group=MongoInserter,topic=perf_db_dt_wa_raw_5,custom_device=KafkaClusterTest01 54171 1520803905262
+        """
+
+        templates = self.templates
+        for series_no, timestamp, value in zip(self.series_no, self.timestamps, self.values):
+            yield templates[series_no]['line_prefix'] + dimensions + b' %d %d' % (value, timestamp)
+
+
+class SeriesTemplates(object):
+    """
+    Cache of the template of the series of every Consumer Group and topic,
+    built the first time the pair is seen, so a loop only adds
+    [timestamp, value] for it:
+
+        key:          key of the template in the cache
+        timeseriesId: 'custom:kafka.consumerlag.mongoinserter.count'
+        dimensions:   {'topic': 'perf_db_dt_wa_raw_5'}, shared by every series
+                      made from the template, never modify it
+                      (with group_dimension, metric_key is a dimension too:
+                      {'consumer_group': 'MongoInserter', 'topic': ...})
+        json_prefix:  b'{"timeseriesId": "...", "dimensions": {...}, "dataPoints": '
+        line_prefix:  b'kafka.consumerlag,group=MongoInserter,topic=perf_db_dt_wa_raw_5'
+                      (only with line_metric_key, the metric key of the line)
+
+    The cache is emptied when it holds max_size templates,
+    so groups and topics which are gone do not pile up
+
+    Attributes:
+        max_size (int): templates kept before the cache is emptied
+        line_metric_key (str): metric key of line_prefix (push_api v2),
+                               None for templates without line_prefix
+    """
+
+    def __init__(self, max_size=100000, line_metric_key=None):
+        self.max_size = max_size
+        self.line_metric_key = line_metric_key
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.cache)
+
+    def get(self, metric_syntax, metric_key, dimension_type, dimension_value, group_dimension=None):
+        """
+        @retval template of the series, the same dictionary every time
+                until the cache is emptied
+        """
+
+        template_key = (metric_syntax, metric_key, dimension_type, dimension_value, group_dimension)
+        template = self.cache.get(template_key)
+
+        if template is not None:
+            return template
+
+        if len(self.cache) >= self.max_size:
+            log_to_disk('SeriesTemplates',
+                        msg="Cache full, emptying it",
+                        kv=kvalue(series_template_cache_size=self.max_size))
+            self.cache.clear()
+
+        # metric_syntax = 'custom:kafka.consumerlag.$metric_key.count'
+        # metric_key = 'MongoInserter'
+        # dimension_type = 'topic'
+        # dimension_value = 'perf_db_dt_wa_raw_5'
+        template = {}
+        template['key'] = template_key
+        template['timeseriesId'] = metric_syntax.replace('$metric_key', metric_key.lower())
+        template['dimensions'] = {}
+        if group_dimension is not None:
+            template['dimensions'][group_dimension] = metric_key
+        template['dimensions'][dimension_type] = dimension_value
+
+        # Same bytes as json.dumps() of the series, up to its dataPoints
+        series_json = json.dumps({'timeseriesId': template['timeseriesId'],
+                                  'dimensions': template['dimensions'],
+                                  'dataPoints': []}).encode('utf-8')
+        template['json_prefix'] = series_json[:-len(b'[]}')]
+
+        # Line protocol of the series, up to its value
+        if self.line_metric_key is not None:
+            template['line_prefix'] = self.line_metric_key.encode('utf-8') + \
+                b',group=' + escape_line_dimension(metric_key) + \
+                b',' + dimension_type.encode('utf-8') + b'=' + escape_line_dimension(dimension_value)
+
+        self.cache[template_key] = template
+
+        return template
+
+
+def split_large_request(cycle_samples, byte_size_limit):
+    """
+    Yields the JSON bytes of the CycleSamples cycle_samples in parts of
+    at most byte_size_limit bytes, ready to be pushed, spooled or compressed
+
+    Every series is rendered exactly once from the samples, its template's
+    json_prefix followed by its dataPoints. A part is the envelope
+    ({"type": "Kafka", "series": [ ... ]}) around the bytes of its series
+    joined by ", ", i.e. the same bytes json.dumps() makes of the part, so
+    its size is known exactly before it is built. The series are packed
+    greedily in their order: a part is closed only when the next series
+    would not fit, so no part exceeds the limit and no fewer parts are
+    possible without reordering the series. A single series larger than
+    the limit can not be split and is sent on its own.
+    """
+
+    byte_size_limit = byte_size_limit if byte_size_limit is not None else 10000
+
+    # JSON of the request without series, {"type": "Kafka", "series": []},
+    # the series go between envelope_start and envelope_end
+    envelope = {}
+    envelope['type'] = cycle_samples.metric_type
+    envelope['series'] = []
+    envelope_json = json.dumps(envelope).encode('utf-8')
+    envelope_start = envelope_json[:-2]
+    envelope_end = envelope_json[-2:]
+    byte_size_envelope = len(envelope_json)
+    separator = b', '
+
+    # In the order of cycle_samples.templates
+    series_datas = list(cycle_samples.iter_series_json())
+    num_series = len(series_datas)
+    byte_size_total = byte_size_envelope + sum(len(data) for data in series_datas) + \
+        len(separator) * max(num_series - 1, 0)
+
+    log_to_disk('SplitRequest',
+            msg="Total Size and Byte Size Limit - ",
+            kv=kvalue(byte_size_limit=byte_size_limit,
+                      byte_size_total=byte_size_total))
+
+    if byte_size_total <= byte_size_limit:
+        # Do not split into smaller requests, yield all series at once
+        log_to_disk('SplitRequest',
+            msg="Will not proceed with splitting")
+        yield envelope_start + separator.join(series_datas) + envelope_end
+        return
+
+    log_to_disk('SplitRequest',
+        msg="Starting Split into Smaller Requests",
+        kv=kvalue(num_series=num_series,
+                  byte_size_envelope=byte_size_envelope))
+
+    def new_part(i, j):
+        data = envelope_start + separator.join(series_datas[i:j]) + envelope_end
+        log_to_disk('SplitRequest',
+            msg="Smaller Request",
+            kv=kvalue(splice_start=i, splice_end=j,
+                      byte_size_smaller_request=len(data)))
+        return data
+
+    # Greedily fill each part up to byte_size_limit
+    i = 0
+    byte_size_part = byte_size_envelope
+    for j, series_data in enumerate(series_datas):
+        byte_size_added = len(series_data) if j == i else len(separator) + len(series_data)
+        if j > i and byte_size_part + byte_size_added > byte_size_limit:
+            yield new_part(i, j)
+            i = j
+            byte_size_part = byte_size_envelope
+            byte_size_added = len(series_data)
+
+        if byte_size_envelope + len(series_data) > byte_size_limit:
+            log_to_disk('SplitRequest', lvl='WARN',
+                msg="Series larger than Byte Size Limit, sending it alone",
+                kv=kvalue(timeseries_id=cycle_samples.templates[j]['timeseriesId'],
+                          byte_size_series=byte_size_envelope + len(series_data),
+                          byte_size_limit=byte_size_limit))
+
+        byte_size_part += byte_size_added
+
+    yield new_part(i, num_series)
+
+
+def escape_line_dimension(dimension_value):
+    """
+    Returns dimension_value as a dimension value of the Metrics API v2
+    line protocol (bytes), quoted if it holds a space, comma, equal sign,
+    quote or backslash, e.g. 'Mongo Inserter' -> b'"Mongo Inserter"'
+    """
+
+    # A line break would end the line
+    value = dimension_value.replace('\r', ' ').replace('\n', ' ')
+
+    if any(c in value for c in ' ,="\\'):
+        value = '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+    return value.encode('utf-8')
+
+
+def split_metric_lines(cycle_samples, custom_device, byte_size_limit, max_lines):
+    """
+    Yields the Metrics API v2 line protocol of the CycleSamples cycle_samples
+    in parts of at most byte_size_limit bytes and max_lines lines, ready to
+    be pushed, spooled or compressed
+
+    Every data point is one line (see CycleSamples.iter_lines()), tagged
+    with the custom_device dimension. The lines are streamed from the
+    samples and joined by newlines, a part is closed when the next line
+    would not fit. A single line larger than the limit is sent on its own.
+    """
+
+    byte_size_limit = byte_size_limit if byte_size_limit is not None else 10000
+    dimensions = b',custom_device=' + escape_line_dimension(custom_device)
+
+    part = []
+    byte_size_part = 0
+    num_parts = 0
+    for line in cycle_samples.iter_lines(dimensions=dimensions):
+        byte_size_added = len(line) + 1 if len(part) > 0 else len(line)
+        if len(part) > 0 and (byte_size_part + byte_size_added > byte_size_limit or len(part) >= max_lines):
+            num_parts += 1
+            yield b'\n'.join(part)
+            part = []
+            byte_size_part = 0
+            byte_size_added = len(line)
+
+        if len(line) > byte_size_limit:
+            log_to_disk('SplitRequest', lvl='WARN',
+                msg="Line larger than Byte Size Limit, sending it alone",
+                kv=kvalue(line=line.decode('utf-8'),
+                          byte_size_line=len(line),
+                          byte_size_limit=byte_size_limit))
+
+        part.append(line)
+        byte_size_part += byte_size_added
+
+    if len(part) > 0:
+        num_parts += 1
+        yield b'\n'.join(part)
+
+    log_to_disk('SplitRequest',
+        msg="Lines split",
+        kv=kvalue(custom_device=custom_device,
+                  lines=len(cycle_samples),
+                  parts=num_parts,
+                  byte_size_limit=byte_size_limit,
+                  max_lines=max_lines))
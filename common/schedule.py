@@ -0,0 +1,78 @@
+from common.default import *
+
+
+def new_loop_schedule():
+    """
+    Schedule of the loops of the collector (or of one cluster of clusters)
+
+    slot_start is the start of the current slot (None before the first loop),
+    overruns, skipped_slots and abandoned_consumer_groups are counters
+    for the "Loop - Finished" log line
+
+    @retval dictionary for start_loop_schedule() and finish_loop_schedule()
+    """
+
+    loop_schedule = {}
+    loop_schedule['slot_start'] = None
+    loop_schedule['overruns'] = 0
+    loop_schedule['skipped_slots'] = 0
+    loop_schedule['abandoned_consumer_groups'] = 0
+
+    return loop_schedule
+
+
+def start_loop_schedule(loop_schedule):
+    """
+    Records the start of a loop, the first loop starts the first slot
+
+    @retval epoch seconds when the loop started
+    """
+
+    loop_started_at = time.time()
+
+    if loop_schedule['slot_start'] is None:
+        loop_schedule['slot_start'] = loop_started_at
+
+    return loop_started_at
+
+
+def finish_loop_schedule(loop_schedule, loop_interval_sec, loop_align_to_interval):
+    """
+    Moves the schedule to the next slot which has not started yet
+
+    Slots follow each other by exactly loop_interval_sec, so a slow loop
+    does not shift the cadence. With loop_align_to_interval they are
+    wall-clock multiples of loop_interval_sec (e.g. every full minute).
+    A loop which runs past its own slot is an overrun, every slot which
+    started while it was still running is skipped.
+
+    @retval seconds to sleep until the next loop starts
+    """
+
+    if loop_interval_sec <= 0:
+        return 0
+
+    now = time.time()
+    next_slot_start = loop_schedule['slot_start'] + loop_interval_sec
+
+    if now > next_slot_start:
+        skipped_slots = int((now - next_slot_start) // loop_interval_sec) + 1
+        loop_schedule['overruns'] += 1
+        loop_schedule['skipped_slots'] += skipped_slots
+        log_to_disk('Loop', lvl='WARN',
+                    msg="Overrun",
+                    kv=kvalue(elapsed_ms=int(round((now - loop_schedule['slot_start']) * 1000)),
+                              loop_interval_sec=loop_interval_sec,
+                              skipped_slots=skipped_slots,
+                              overruns=loop_schedule['overruns']))
+        next_slot_start += skipped_slots * loop_interval_sec
+
+    # Only moves the first slot, the following ones are aligned already
+    if loop_align_to_interval == True:
+        next_slot_start -= next_slot_start % loop_interval_sec
+        if next_slot_start <= now:
+            next_slot_start += loop_interval_sec
+
+    loop_schedule['slot_start'] = next_slot_start
+
+    return next_slot_start - now
@@ -0,0 +1,44 @@
+from common.default import *
+
+
+def create_single_metric(tenant, create_metric, create_threshold):
+    """
+    Registers the one metric of metric_mode: single on tenant, a tenant of
+    tenant_list in consumerlag.py (lock and single_metric), and then its
+    threshold: create_metric() and create_threshold() PUT them and return
+    True when they are created
+
+    Each is PUT until it is created once, afterwards this returns without
+    any API call, so it can be called every loop. A new Consumer Group is
+    just a new dimension value, so it costs no API call and the list of
+    metrics is never downloaded.
+
+    The clusters of clusters call this from their own threads, the one
+    which reserves tenant['single_metric'] under tenant['lock'] registers,
+    the others skip it meanwhile (without holding the lock during the PUTs).
+
+    @retval True once the metric and the threshold are registered
+    """
+
+    with tenant['lock']:
+        single_metric = tenant['single_metric']
+        if single_metric['metric'] and single_metric['threshold']:
+            return True
+        if single_metric['registering']:
+            return False
+        single_metric['registering'] = True
+        metric_created = single_metric['metric']
+        threshold_created = single_metric['threshold']
+
+    try:
+        if not metric_created:
+            metric_created = create_metric()
+        if metric_created and not threshold_created:
+            threshold_created = create_threshold()
+    finally:
+        with tenant['lock']:
+            single_metric['metric'] = metric_created
+            single_metric['threshold'] = threshold_created
+            single_metric['registering'] = False
+
+    return metric_created and threshold_created
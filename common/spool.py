@@ -0,0 +1,241 @@
+import base64
+import threading
+
+from common.default import *
+
+
+class PushSpool(object):
+    """
+    Append-only on-disk spool of pushes a tenant did not accept
+
+    Records are appended to numbered segment files in directory, one JSON
+    line each, and replayed oldest first:
+
+        0000000001.spool   {"custom_device": "KafkaClusterTest01", "content_encoding": null,
+                            "push_api": "v1", "spooled_at": 1520803909.3,
+                            "data": "eyJ0eXBlIjog..."}
+
+    data is the pushed body as-is (base64), so the data points keep their
+    original timestamps. The position of the next record to replay is kept
+    in replay.offset, so a restarted collector resumes where it stopped
+    (a record which was sent right before a crash may be sent once more).
+
+    When the segments grow past max_bytes the oldest segment is deleted,
+    so the newest data is kept.
+
+    Attributes:
+        directory (str): directory of the segment files, created if missing
+        max_bytes (int): disk usage of all segments before evicting the oldest
+        segment_bytes (int): size of a segment before a new one is started
+    """
+
+    def __init__(self, directory, max_bytes, segment_bytes=4 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = min(segment_bytes, max(max_bytes // 4, 1))
+        self.offset_file = os.path.join(directory, 'replay.offset')
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+        # Sequence numbers of the segment files, oldest first
+        self.segments = sorted(int(name.split('.')[0]) for name in os.listdir(directory)
+                               if name.endswith('.spool') and name.split('.')[0].isdigit())
+
+        # Byte offset of the next record to replay in the oldest segment
+        self.replay_offset = 0
+        if os.path.isfile(self.offset_file) and len(self.segments) > 0:
+            with open(self.offset_file) as f:
+                seq, offset = f.read().split()
+            if int(seq) == self.segments[0]:
+                self.replay_offset = int(offset)
+
+        # Appends after a restart go to a new segment, never after a
+        # torn write at the end of the last one
+        self.new_segment = True
+
+        self.records = 0
+        for seq in self.segments:
+            with open(self._segment_path(seq), 'rb') as f:
+                if seq == self.segments[0]:
+                    f.seek(self.replay_offset)
+                self.records += sum(1 for line in f if line.endswith(b'\n'))
+
+        if self.records > 0:
+            log_to_disk('Spool', lvl='WARN',
+                        msg="Found records to replay",
+                        kv=kvalue(directory=directory, records=self.records,
+                                  segments=len(self.segments), size_bytes=self.size_bytes()))
+
+    def _segment_path(self, seq):
+        return os.path.join(self.directory, '%010d.spool' % seq)
+
+    def _save_offset(self):
+        with open(self.offset_file + '.tmp', 'w') as f:
+            f.write('%d %d' % (self.segments[0], self.replay_offset))
+        os.replace(self.offset_file + '.tmp', self.offset_file)
+
+    def size_bytes(self):
+        return sum(os.path.getsize(self._segment_path(seq)) for seq in self.segments)
+
+    def empty(self):
+        return self.records == 0
+
+    def append(self, custom_device, data, content_encoding=None, spooled_at=None, push_api='v1'):
+        """
+        Appends one pushed body to the newest segment and syncs it to disk
+        """
+
+        line = json.dumps({'custom_device': custom_device,
+                           'content_encoding': content_encoding,
+                           'push_api': push_api,
+                           'spooled_at': spooled_at if spooled_at is not None else time.time(),
+                           'data': base64.b64encode(data).decode('ascii')}).encode('utf-8') + b'\n'
+
+        with self.lock:
+            if self.new_segment or len(self.segments) == 0 or \
+                    os.path.getsize(self._segment_path(self.segments[-1])) >= self.segment_bytes:
+                self.segments.append(self.segments[-1] + 1 if len(self.segments) > 0 else 1)
+                self.new_segment = False
+
+            with open(self._segment_path(self.segments[-1]), 'ab') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self.records += 1
+
+            self._evict()
+
+    def _evict(self):
+        # Delete the oldest segments, but never the one written to
+        while len(self.segments) > 1 and self.size_bytes() > self.max_bytes:
+            seq = self.segments.pop(0)
+            path = self._segment_path(seq)
+            with open(path, 'rb') as f:
+                f.seek(self.replay_offset)
+                evicted = sum(1 for line in f if line.endswith(b'\n'))
+            size_bytes = os.path.getsize(path)
+            os.remove(path)
+            self.records -= evicted
+            self.replay_offset = 0
+            self._save_offset()
+            log_to_disk('Spool', lvl='WARN',
+                        msg="Spool full, evicted oldest segment",
+                        kv=kvalue(directory=self.directory, segment=path,
+                                  evicted_records=evicted, segment_bytes=size_bytes,
+                                  max_bytes=self.max_bytes))
+
+    def _next_record(self):
+        with self.lock:
+            while len(self.segments) > 0:
+                with open(self._segment_path(self.segments[0]), 'rb') as f:
+                    f.seek(self.replay_offset)
+                    line = f.readline()
+                if line.endswith(b'\n'):
+                    try:
+                        return self.segments[0], self.replay_offset + len(line), json.loads(line)
+                    except ValueError as e:
+                        log_to_disk('Spool', lvl='ERROR',
+                                    msg="Skipping unreadable record",
+                                    kv=kvalue(directory=self.directory,
+                                              segment=self._segment_path(self.segments[0]),
+                                              offset=self.replay_offset,
+                                              exception=e.__repr__()))
+                        self.replay_offset += len(line)
+                        self.records -= 1
+                        continue
+                # Oldest segment is replayed (a torn write at its end is
+                # dropped), move on to the next one
+                os.remove(self._segment_path(self.segments.pop(0)))
+                self.replay_offset = 0
+                if len(self.segments) > 0:
+                    self._save_offset()
+
+            # Everything replayed, start over with an empty spool
+            self.records = 0
+            if os.path.isfile(self.offset_file):
+                os.remove(self.offset_file)
+            return None
+
+    def _advance(self, seq, offset):
+        with self.lock:
+            # The segment may have been evicted while the record was sent
+            if len(self.segments) > 0 and self.segments[0] == seq:
+                self.replay_offset = offset
+                self.records -= 1
+                self._save_offset()
+
+    def replay(self, send):
+        """
+        Replays the records oldest first through send(custom_device, data,
+        content_encoding, push_api), which returns True once the record is
+        done with (pushed, or rejected for good) and False to stop the
+        replay and keep the record for the next one. Records spooled before
+        push_api was recorded are 'v1'.
+
+        @retval tuple of (records replayed, True if the spool is empty now)
+        """
+
+        replayed = 0
+        while True:
+            next_record = self._next_record()
+            if next_record is None:
+                return replayed, self.empty()
+            seq, offset, record = next_record
+
+            if not send(record['custom_device'],
+                        base64.b64decode(record['data']),
+                        record['content_encoding'],
+                        record.get('push_api', 'v1')):
+                return replayed, False
+
+            self._advance(seq, offset)
+            replayed += 1
+
+
+def admit_push(tenant, max_pending, custom_device, datas, content_encoding=None, push_api='v1'):
+    """
+    Counts one more pending batch for tenant, a tenant of tenant_list
+    in consumerlag.py (name, lock, stats and spool)
+
+    When the tenant has max_pending batches queued already, the parts of
+    the batch are appended to its spool instead, which the next push
+    replays first. Without a spool the batch is dropped for this tenant.
+
+    @retval True if the batch is to be queued to the tenant's push thread
+    """
+
+    with tenant['lock']:
+        if tenant['stats']['pending'] < max_pending:
+            tenant['stats']['pending'] += 1
+            return True
+        if tenant['spool'] is None:
+            tenant['stats']['dropped'] += 1
+            log_to_disk('PushMetrics', lvl='WARN',
+                        msg="Tenant is behind, dropping push",
+                        kv=kvalue(tenant=tenant['name'],
+                                  custom_device=custom_device,
+                                  pending=tenant['stats']['pending'],
+                                  dropped=tenant['stats']['dropped']))
+            return False
+        pending = tenant['stats']['pending']
+
+    for data in datas:
+        tenant['spool'].append(custom_device=custom_device,
+                               data=data,
+                               content_encoding=content_encoding,
+                               push_api=push_api)
+
+    with tenant['lock']:
+        tenant['stats']['spooled'] += len(datas)
+        tenant['stats']['spool_records'] = tenant['spool'].records
+
+    log_to_disk('PushMetrics', lvl='WARN',
+                msg="Tenant is behind, spooled push",
+                kv=kvalue(tenant=tenant['name'],
+                          custom_device=custom_device,
+                          pending=pending,
+                          parts=len(datas),
+                          spool_records=tenant['spool'].records))
+
+    return False
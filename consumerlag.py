@@ -1,14 +1,27 @@
 import os
 import subprocess
-from itertools import islice
+import asyncio
+import threading
+import queue
 import requests
 import urllib.parse
 import json
+import gzip
 import pprint
-import math
+from concurrent.futures import ThreadPoolExecutor
 
 import common
 from common.default import *
+from common.kafkawire import KafkaWireClient, KafkaWireError
+from common.adminhelper import KafkaAdminHelper, KafkaAdminHelperError
+from common.describe import parse_kafka_consumer_groups_describe, sum_partition_lag, \
+    aggregate_partition_lag_columnar
+from common.spool import PushSpool, admit_push
+from common.collect import collect_in_pool
+from common.polltiers import select_consumer_groups_to_poll, update_poll_tiers
+from common.singlemetric import create_single_metric
+from common.schedule import new_loop_schedule, start_loop_schedule, finish_loop_schedule
+from common.samples import CycleSamples, SeriesTemplates, split_large_request, split_metric_lines, escape_line_dimension
 
 def obtain_kafka_consumer_groups(kafka_consumer_groups_list):
     """
@@ -69,11 +82,14 @@ def obtain_kafka_consumer_groups(kafka_consumer_groups_list):
     return sorted_list
 
 
-def obtain_kafka_consumer_lag(kafka_consumer_groups_describe, consumer_group):
+def obtain_kafka_consumer_lag(kafka_consumer_groups_describe, consumer_group, deadline=None):
     """
     Obtains the output from this Kafka utility command:
     /opt/broker/bin/kafka-consumer-groups.sh --new-consumer --describe --group
 
+    While it runs the command is registered in describe_processes,
+    so kill_describe_processes() can stop it once deadline has passed
+
     @retval dictionary of topic:lag for each topic in the consumer_group
     """
 
@@ -107,18 +123,17 @@ def obtain_kafka_consumer_lag(kafka_consumer_groups_describe, consumer_group):
                    'MongoInserter                  updatedb                       1          unknown         0               unknown         consumer-1_/10.200.200.112\n' \
                    'MongoInserter                  updatedb                       2          unknown         0               unknown         consumer-1_/10.200.200.112\n'
 
-        split_list = decode.split("\n")
+        lines = decode.split("\n")
+        process = None
 
     else:
         # This is the live production execution
 
-        string = None
-
         try:
             command = kafka_consumer_groups_describe.copy()
             command.append("--group")
             command.append(consumer_group)
-            string = subprocess.check_output(command)
+            process = subprocess.Popen(command, stdout=subprocess.PIPE)
             # string = subprocess.check_output([
             #     "/opt/broker/bin/kafka-consumer-groups.sh",
             #     "--new-consumer",
@@ -131,88 +146,891 @@ def obtain_kafka_consumer_lag(kafka_consumer_groups_describe, consumer_group):
         except Exception as e:
             print('Unable to grab lag for consumer_group='
                   + consumer_group+' error='+e.__str__())
+            return False
+
+        register_describe_process(process=process, deadline=deadline)
 
-        if string is None:
+        # Decode each line as soon as it is written by the command,
+        # nothing but the current line is kept in memory
+        lines = (line.decode('utf-8') for line in process.stdout)
+
+    # Whether for dev or for live run,
+    # lines can now be consumed one at a time
+
+    status = {'group_missing': False}
+    topic_lag, num_partitions = sum_kafka_consumer_lag(lines=lines,
+                                                       consumer_group=consumer_group,
+                                                       status=status)
+
+    if status['group_missing']:
+        expire_consumer_groups_cache(cache=consumer_groups_cache,
+                                     consumer_group=consumer_group)
+
+    if process is not None:
+        process.stdout.close()
+        process.wait()
+        unregister_describe_process(process=process)
+        if process.returncode != 0 and not status['group_missing']:
+            print('Unable to grab lag for consumer_group='
+                  + consumer_group+' returncode='+str(process.returncode))
             return False
+
+    if status['group_missing'] or num_partitions == 0:
+        #There is only the header line
+        return False
+
+    return topic_lag
+
+
+def register_describe_process(process, deadline):
+    """
+    Adds a running kafka-consumer-groups.sh --describe to describe_processes
+
+    A command started after deadline (epoch seconds) already missed
+    kill_describe_processes(), so it is killed right away
+    """
+
+    with describe_processes_lock:
+        if deadline is not None and time.time() >= deadline:
+            process.kill()
         else:
-            decode = string.decode('utf-8')
+            describe_processes.add(process)
+
+
+def unregister_describe_process(process):
+    """
+    Removes a finished kafka-consumer-groups.sh --describe from describe_processes
+    """
+
+    with describe_processes_lock:
+        describe_processes.discard(process)
+
+
+def kill_describe_processes():
+    """
+    Kills every kafka-consumer-groups.sh --describe still running,
+    their worker threads then read the end of the output and return
+
+    @retval number of commands killed
+    """
+
+    with describe_processes_lock:
+        processes = list(describe_processes)
+        describe_processes.clear()
+
+    killed = 0
+    for process in processes:
+        if process.poll() is None:
+            process.kill()
+            killed += 1
 
-            if 'does not exist' in decode:
+    return killed
+
+
+def sum_kafka_consumer_lag(lines, consumer_group, status):
+    """
+    Sums up the lag per topic of one Consumer Group
+    from the lines of kafka-consumer-groups.sh --describe --group
+
+    Reading stops at "does not exist", which sets status['group_missing']
+
+    @retval tuple of (dictionary of topic:lag, number of partition rows)
+    """
+
+    def until_group_missing(lines):
+        for line in lines:
+            if 'does not exist' in line:
                 # Check for:
                 # "Consumer group `GROUP_NAME` does not exist or is rebalancing."
-                return False
-            else:
-                # Decode, then split by \n into a list
-                split_list = decode.split("\n")
+                status['group_missing'] = True
+                return
+            yield line
+
+    rows = parse_kafka_consumer_groups_describe(until_group_missing(lines))
+
+    # Compute lag for each topic while reading
+    topic_lag = {}
+
+    if lag_aggregation == 'columnar':
+        # Collect the whole group into arrays, then reduce in one shot
+        all_groups_stats, num_partitions = aggregate_partition_lag_columnar(rows)
+        for topic_stats in all_groups_stats.values():
+            for topic, stats in topic_stats.items():
+                topic_lag[topic] = stats['lag']
+            log_to_disk('GetLag', debug=True,
+                        msg="TopicStats",
+                        kv=kvalue(consumer_group=consumer_group,
+                                  topic_stats=topic_stats))
+    else:
+        all_groups_lag, num_partitions = sum_partition_lag(print_lag_rows(rows))
+        for group_lag in all_groups_lag.values():
+            topic_lag.update(group_lag)
+
+    return topic_lag, num_partitions
+
+
+def print_lag_rows(rows):
+    """
+    Passes the parsed rows through, in Debug printing each individual lag line
+    """
+
+    for row in rows:
+        if app_conf['debug'] == True:
+            consumer_group, topic, current_offset, log_end_offset, lag = row
+            print((consumer_group+" " if consumer_group is not None else "")+topic+" "
+                  + (str(lag) if lag is not None else 'unknown'))
+        yield row
+
+
+def obtain_kafka_consumer_lag_all_groups(kafka_consumer_groups_describe):
+    """
+    Obtains the output from this Kafka utility command in one execution:
+    /opt/broker/bin/kafka-consumer-groups.sh --describe --all-groups
+
+    The output is parsed while the command is still running
+    (lag_collector: 'all_groups', requires Kafka 2.4+ tooling)
+
+    @retval dictionary of consumer_group:{topic:lag}, {} for a Consumer Group
+            without any known lag
+    """
+
+    # See app_conf['development'] setting for this
+    if app_conf['development'] == True:
+
+        # This is for simulating return data
+        decode = '\n' \
+                 'GROUP           TOPIC                PARTITION  CURRENT-OFFSET  LOG-END-OFFSET  LAG             CONSUMER-ID     HOST            CLIENT-ID\n' \
+                 'MongoInserter   perf_db_dt_wa_raw_5  0          35253984        35253997        13              consumer-3-1    /10.200.200.113 consumer-3\n' \
+                 'MongoInserter   perf_db_dt_wa_raw_5  1          74039511        74039511        0               consumer-3-1    /10.200.200.113 consumer-3\n' \
+                 'MongoInserter   synth_error          0          6932623         6932623         0               consumer-2-1    /10.200.200.113 consumer-2\n' \
+                 'MongoInserter   synth_error          1          -               0               -               consumer-2-1    /10.200.200.113 consumer-2\n' \
+                 '\n' \
+                 "Consumer group 'HARSplitter' has no active members.\n" \
+                 '\n' \
+                 'GROUP           TOPIC                PARTITION  CURRENT-OFFSET  LOG-END-OFFSET  LAG             CONSUMER-ID     HOST            CLIENT-ID\n' \
+                 'HARSplitter     har_key              0          58492           58681           189             -               -               -\n' \
+                 'HARSplitter     har_key              1          60011           60011           0               -               -               -\n' \
+                 '\n' \
+                 'GROUP           TOPIC                PARTITION  CURRENT-OFFSET  LOG-END-OFFSET  LAG             CONSUMER-ID     HOST            CLIENT-ID\n' \
+                 'SyntheticEngine psr_ca               0          1022            1276            254             consumer-1-1    /10.200.200.112 consumer-1\n' \
+                 '\n' \
+                 "Consumer group 'DynamicAnomalyEngine2' has no active members.\n"
+
+        lines = decode.split("\n")
+        process = None
+
+    else:
+        # This is the live production execution
+
+        command = kafka_consumer_groups_describe.copy()
+        command.append("--all-groups")
+
+        try:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE)
+        except Exception as e:
+            print('Unable to grab lag for all consumer groups error='+e.__str__())
+            return False
+
+        # Decode each line as soon as it is written by the command
+        lines = (line.decode('utf-8') for line in process.stdout)
 
     # Whether for dev or for live run,
-    # split_list should be available now for further processing
+    # lines can now be consumed one at a time
+
+    # Every Consumer Group of the output, also the ones without a numeric lag
+    # (no committed offset yet, no active members), so their metrics are
+    # created just like with lag_collector: 'describe'
+    seen_groups = {}
+    rows = parse_kafka_consumer_groups_describe(lines, seen_groups=seen_groups)
+
+    all_groups_lag = {}
+
+    if lag_aggregation == 'columnar':
+        # Collect the whole output into arrays, then reduce in one shot
+        all_groups_stats, num_rows = aggregate_partition_lag_columnar(rows)
+        for consumer_group, topic_stats in all_groups_stats.items():
+            all_groups_lag[consumer_group] = {}
+            for topic, stats in topic_stats.items():
+                all_groups_lag[consumer_group][topic] = stats['lag']
+            log_to_disk('GetLag', debug=True,
+                        msg="TopicStats",
+                        kv=kvalue(consumer_group=consumer_group,
+                                  topic_stats=topic_stats))
+    else:
+        # Sum up lag by group and topic while reading
+        all_groups_lag, num_rows = sum_partition_lag(print_lag_rows(rows))
+
+    if process is not None:
+        process.stdout.close()
+        if process.wait() != 0 and len(all_groups_lag) == 0:
+            print('Unable to grab lag for all consumer groups returncode='
+                  + str(process.returncode))
+            return False
 
-    # Remove empty '' from the split_list
-    group_list = list(filter(None, split_list))
+    # Without a GROUP column the rows cannot be attributed
+    all_groups_lag.pop(None, None)
 
-    if len(group_list) < 2:
-        #There is only the header line
+    for consumer_group in seen_groups:
+        all_groups_lag.setdefault(consumer_group, {})
+
+    return all_groups_lag
+
+
+def obtain_kafka_consumer_groups_client(kafka_client):
+    """
+    Obtains the Consumer Groups without kafka-consumer-groups.sh --list
+     lag_collector: 'native' -> ListGroups request to every broker
+     lag_collector: 'helper' -> "list" request to the kafka_admin_helper process
+
+    @retval sorted Python list of kafka consumer groups
+    """
+
+    try:
+        group_list = kafka_client.list_groups()
+    except (KafkaWireError, KafkaAdminHelperError) as e:
+        print('Unable to grab consumer groups: '+e.__str__())
+        return False
+
+    # Sort list
+    sorted_list = sorted(group_list)
+
+    return sorted_list
+
+
+def obtain_kafka_consumer_lag_client(kafka_client, consumer_group):
+    """
+    Obtains the lag of a Consumer Group without kafka-consumer-groups.sh --describe
+     lag_collector: 'native' -> committed offsets from the group coordinator (OffsetFetch),
+                               log-end offsets from the partition leaders (ListOffsets)
+     lag_collector: 'helper' -> "describe" request to the kafka_admin_helper process
+
+    @retval dictionary of topic:lag for each topic in the consumer_group
+    """
+
+    try:
+        topic_lag = kafka_client.describe_lag(consumer_group)
+    except (KafkaWireError, KafkaAdminHelperError) as e:
+        print('Unable to grab lag for consumer_group='
+              + consumer_group+' error='+e.__str__())
+        if 'does not exist' in e.__str__():
+            expire_consumer_groups_cache(cache=consumer_groups_cache,
+                                         consumer_group=consumer_group)
         return False
+
+    # if in Debug, print each topic lag
+    if app_conf['debug'] == True:
+        for topic, lag in topic_lag.items():
+            print(topic+" "+str(lag))
+
+    return topic_lag
+
+
+def obtain_kafka_consumer_groups_cached(cache, ttl_sec):
+    """
+    Returns the Consumer Group list from cache, and only runs the
+    list command of the configured lag_collector when the cache is
+    older than ttl_sec or was expired by a group which does not exist
+
+    If the list command fails, the previous list is used until it succeeds
+
+    @retval sorted Python list of kafka consumer groups (or False)
+    """
+
+    consumer_groups_list = get_cached_consumer_groups(cache=cache, ttl_sec=ttl_sec)
+    if consumer_groups_list is not None:
+        return consumer_groups_list
+
+    if lag_collector in ('native', 'helper'):
+        consumer_groups_list = \
+            obtain_kafka_consumer_groups_client(kafka_client=kafka_client)
     else:
+        consumer_groups_list = \
+            obtain_kafka_consumer_groups(kafka_consumer_groups_list=kafka_consumer_groups_list)
 
-        # Obtain header keys
-        header_keys = next(iter(group_list)).split()
-        header_keys = [x.lower() for x in header_keys]
-
-        # Skip header line, then create list of key:value pairs
-        # for each line
-        result = []
-        for line in islice(iter(group_list), 1, None):
-            result.append(dict(zip(header_keys, line.split())))
-
-        # Compute lag for each topic
-        topic_lag = {}
-        for line in result:
-
-            # if in Debug, print each individual lag line
-            if app_conf['debug'] == True:
-                print(line['topic']+" "+line['lag'])
-
-            # Sum up lag by topic
-            if line['lag'] == 'unknown':
-                donothing = True
-            elif line['topic'] not in topic_lag:
-                topic_lag[line['topic']] = int(line['lag'])
-            else:
-                topic_lag[line['topic']] += int(line['lag'])
+    return update_consumer_groups_cache(cache=cache,
+                                        consumer_groups_list=consumer_groups_list)
+
+
+def get_cached_consumer_groups(cache, ttl_sec):
+    """
+    @retval cached Consumer Group list, None if it has to be refreshed
+    """
 
-        return topic_lag
+    age_sec = time.time() - cache['obtained_at']
 
+    if cache['consumer_groups_list'] is not None \
+            and cache['expired'] is False and age_sec < ttl_sec:
+        log_to_disk('GetConsumerGroups',
+                    debug=True,
+                    msg="Cached",
+                    kv=kvalue(age_sec=int(age_sec), ttl_sec=ttl_sec))
+        return cache['consumer_groups_list']
 
-def append_custom_metrics(metric_syntax, metric_key,
-                          dimension_type, dimension_value,
-                          timestamp, metric_value,
-                          dict_metrics):
+    return None
 
-    # metric_syntax = 'custom:kafka.consumerlag.$metric_key.count'
-    # metric_key = 'MongoInserter'
-    metric_full_name = metric_syntax.replace('$metric_key', metric_key.lower())
-    # dimension_type = 'topic'
-    # dimension_value = 'perf_db_dt_wa_raw_5'
-    dimension = {}
-    dimension[dimension_type] = dimension_value
 
-    data = []
-    # timestamp = get_epochms()
-    # metric_value = int('0')
-    data.append([timestamp, metric_value])
+def update_consumer_groups_cache(cache, consumer_groups_list):
+    """
+    Stores a freshly obtained Consumer Group list
 
-    # metrics = {}
-    # metrics['type'] = type
-    # metrics['series'] = []
+    @retval the list to use, the last known one if consumer_groups_list is False
+    """
 
-    timeseries_entry = {}
-    timeseries_entry['timeseriesId'] = metric_full_name
-    timeseries_entry['dimensions'] = dimension
-    timeseries_entry['dataPoints'] = data
+    if consumer_groups_list is False:
+        # Keep going with the last known list
+        return cache['consumer_groups_list'] if cache['consumer_groups_list'] is not None else False
 
-    dict_metrics['series'].append(timeseries_entry)
+    cache['consumer_groups_list'] = consumer_groups_list
+    cache['obtained_at'] = time.time()
+    cache['expired'] = False
+    cache['refreshes'] += 1
+
+    return consumer_groups_list
+
+
+def expire_consumer_groups_cache(cache, consumer_group):
+    """
+    Forces obtain_kafka_consumer_groups_cached() to run the list command
+    on the next loop, e.g. when a Consumer Group does not exist anymore
+    """
+
+    if cache['expired'] is False:
+        log_to_disk('GetConsumerGroups',
+                    msg="Expiring cached list",
+                    kv=kvalue(consumer_group=consumer_group,
+                              reason='does not exist'))
+    cache['expired'] = True
+
+
+def prefetch_kafka_log_end_offsets(kafka_client, consumer_groups_list):
+    """
+    Fetches the committed offsets of all Consumer Groups and then the
+    log-end offset of each partition once for the whole loop
+    (lag_collector: 'native', kafka_shared_log_end_offsets: True)
+    """
+
+    t_start = time.time()
+    list_offsets_requests = kafka_client.list_offsets_requests
+
+    try:
+        num_partitions = kafka_client.prefetch_cycle(consumer_groups_list)
+    except KafkaWireError as e:
+        log_to_disk('GetLag', lvl='ERROR',
+                    msg="Unable to prefetch log-end offsets, fetching per Consumer Group",
+                    kv=kvalue(exception=e))
+        return False
+
+    log_to_disk('GetLag',
+                msg="Prefetch",
+                kv=kvalue(consumer_groups=len(consumer_groups_list),
+                          partitions=num_partitions,
+                          list_offsets_requests=kafka_client.list_offsets_requests - list_offsets_requests,
+                          elapsed_ms=int(round((time.time() - t_start) * 1000))))
+
+    return True
+
+
+def obtain_consumer_group_lag_timed(consumer_group, deadline=None):
+    """
+    Obtains the lag of one Consumer Group with the configured lag_collector
+    and measures how long it took
+
+    deadline (epoch seconds) is handed to obtain_kafka_consumer_lag()
+
+    @retval dictionary with consumer_group, consumer_group_lag, timestamp, elapsed_ms
+    """
+
+    log_to_disk('GetLag',
+                debug=True,
+                msg="Starting",
+                kv=kvalue(consumer_group=consumer_group,
+                          kafka_consumer_groups_describe=kafka_consumer_groups_describe))
+
+    t_start = time.time()
+
+    if lag_collector in ('native', 'helper'):
+        consumer_group_lag = \
+            obtain_kafka_consumer_lag_client(kafka_client=kafka_client,
+                                             consumer_group=consumer_group)
+    elif lag_collector == 'all_groups':
+        consumer_group_lag = all_groups_lag[consumer_group]
+    else:
+        consumer_group_lag = \
+            obtain_kafka_consumer_lag(kafka_consumer_groups_describe=kafka_consumer_groups_describe,
+                                      consumer_group=consumer_group,
+                                      deadline=deadline)
+
+    result = {}
+    result['consumer_group'] = consumer_group
+    result['consumer_group_lag'] = consumer_group_lag
+    result['timestamp'] = get_epochms()
+    result['elapsed_ms'] = int(round((time.time() - t_start) * 1000))
+
+    return result
+
+
+def obtain_consumer_groups_lag(consumer_groups_list, describe_concurrency, deadline=None,
+                               on_result=None):
+    """
+    Obtains the lag of every Consumer Group
+
+    With lag_collector: 'describe', up to describe_concurrency
+    kafka-consumer-groups.sh --describe commands run at the same time
+    in describe_executor, which is shared by every loop.
+    The native client shares one socket per broker and the helper process
+    answers one request at a time, so both stay serial.
+
+    Consumer Groups which are not finished by deadline (epoch seconds)
+    are abandoned and left out of the results. With 'describe' the
+    commands not started yet are cancelled and the running ones are
+    killed, so no command outlives its loop. 'native' and 'helper'
+    stop before the next group, a single request is bounded by its timeout.
+
+    on_result is called with every result as soon as it is ready
+    (in completion order, on the calling thread), see collect_in_pool().
+
+    @retval list of obtain_consumer_group_lag_timed() results
+            in the order of consumer_groups_list
+    """
+
+    if lag_collector == 'native' and kafka_shared_log_end_offsets == True:
+        prefetch_kafka_log_end_offsets(kafka_client=kafka_client,
+                                       consumer_groups_list=consumer_groups_list)
+
+    if lag_collector == 'describe' and \
+            (deadline is not None or (describe_concurrency > 1 and len(consumer_groups_list) > 1)):
+        results, deadline_reached = \
+            collect_in_pool(executor=describe_executor,
+                            obtain=lambda consumer_group: obtain_consumer_group_lag_timed(consumer_group,
+                                                                                          deadline),
+                            items=consumer_groups_list,
+                            deadline=deadline,
+                            on_result=on_result)
+        if deadline_reached:
+            killed = kill_describe_processes()
+            if killed > 0:
+                log_to_disk('GetLag', lvl='WARN',
+                            msg="Killed describe commands",
+                            kv=kvalue(killed=killed))
+    else:
+        results = []
+        for consumer_group in consumer_groups_list:
+            if deadline is not None and time.time() >= deadline:
+                break
+            results.append(obtain_consumer_group_lag_timed(consumer_group))
+            if on_result is not None:
+                on_result(results[-1])
+
+    if lag_collector == 'native':
+        kafka_client.end_cycle()
+
+    return results
+
+
+def get_consumer_group_threshold(consumer_group):
+    """
+    Obtains the threshold value of a Consumer Group from threshold_list,
+    the override of the group if there is one, otherwise default_threshold
+
+    @retval threshold as float, None if there is none
+    """
+
+    threshold_value = None
+    for threshold_definition in app_conf['threshold_list']:
+        if threshold_definition['consumer_group'] == consumer_group:
+            return float(threshold_definition['threshold'])
+        if threshold_definition['consumer_group'] == app_conf['default_threshold']:
+            threshold_value = float(threshold_definition['threshold'])
+
+    return threshold_value
+
+
+async def run_kafka_command_async(command, on_line):
+    """
+    Runs a kafka-consumer-groups.sh command as an asyncio subprocess,
+    so waiting for it does not block the other clusters
+
+    on_line is called with each decoded output line as soon as it is read,
+    nothing but the current line is kept in memory
+
+    A command cancelled by loop_deadline_sec is killed
+
+    @retval returncode, None if the command could not be started
+    """
+
+    try:
+        process = await asyncio.create_subprocess_exec(*command,
+                                                       stdout=asyncio.subprocess.PIPE)
+    except Exception as e:
+        print('Unable to run command='+str(command)+' error='+e.__str__())
+        return None
+
+    try:
+        async for line in process.stdout:
+            on_line(line.decode('utf-8'))
+        await process.wait()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+
+    return process.returncode
+
+
+async def obtain_kafka_consumer_groups_async(cluster_state):
+    """
+    Asyncio version of obtain_kafka_consumer_groups_cached() for one cluster of clusters
+
+    @retval sorted Python list of kafka consumer groups (or False)
+    """
+
+    cache = cluster_state['consumer_groups_cache']
+    consumer_groups_list = get_cached_consumer_groups(cache=cache,
+                                                      ttl_sec=consumer_groups_list_ttl_sec)
+    if consumer_groups_list is not None:
+        return consumer_groups_list
+
+    kafka_consumer_groups_list = cluster_state['cluster']['kafka_consumer_groups_list']
+
+    # See app_conf['development'] setting for this
+    if app_conf['development'] == True:
+        consumer_groups_list = \
+            obtain_kafka_consumer_groups(kafka_consumer_groups_list=kafka_consumer_groups_list)
+    else:
+        lines = []
+        returncode = await run_kafka_command_async(kafka_consumer_groups_list, on_line=lines.append)
+        if returncode != 0:
+            print('Unable to grab consumer groups for cluster='
+                  + cluster_state['name']+' returncode='+str(returncode))
+            consumer_groups_list = False
+        else:
+            consumer_groups_list = sorted(filter(None, (x.strip() for x in lines)))
+
+    return update_consumer_groups_cache(cache=cache,
+                                        consumer_groups_list=consumer_groups_list)
+
+
+async def obtain_kafka_consumer_lag_async(cluster_state, consumer_group):
+    """
+    Asyncio version of obtain_kafka_consumer_lag() for one cluster of clusters
+
+    The lines are handed over to sum_kafka_consumer_lag() in a worker thread
+    while the command is still writing them
+
+    @retval dictionary of topic:lag for each topic in the consumer_group
+    """
+
+    kafka_consumer_groups_describe = cluster_state['cluster']['kafka_consumer_groups_describe']
+
+    # See app_conf['development'] setting for this
+    if app_conf['development'] == True:
+        return obtain_kafka_consumer_lag(kafka_consumer_groups_describe=kafka_consumer_groups_describe,
+                                         consumer_group=consumer_group)
+
+    command = kafka_consumer_groups_describe.copy()
+    command.append("--group")
+    command.append(consumer_group)
+    lines = queue.Queue()
+    status = {'group_missing': False}
+    summed = asyncio.get_event_loop().run_in_executor(cluster_state['executor'],
+                                                      sum_kafka_consumer_lag,
+                                                      iter(lines.get, None),
+                                                      consumer_group,
+                                                      status)
+    try:
+        returncode = await run_kafka_command_async(command, on_line=lines.put)
+    finally:
+        # End of the lines, also when the command was cancelled
+        lines.put(None)
+
+    topic_lag, num_partitions = await summed
+
+    if status['group_missing']:
+        expire_consumer_groups_cache(cache=cluster_state['consumer_groups_cache'],
+                                     consumer_group=consumer_group)
+        return False
+
+    if returncode != 0:
+        print('Unable to grab lag for cluster='+cluster_state['name']+' consumer_group='
+              + consumer_group+' returncode='+str(returncode))
+        return False
+
+    if num_partitions == 0:
+        #There is only the header line
+        return False
+
+    return topic_lag
+
+
+async def obtain_consumer_group_lag_async(cluster_state, consumer_group, semaphore):
+    """
+    @retval dictionary with consumer_group, consumer_group_lag, timestamp, elapsed_ms
+            like obtain_consumer_group_lag_timed()
+    """
+
+    # At most describe_concurrency commands per cluster at the same time
+    async with semaphore:
+        t_start = time.time()
+        consumer_group_lag = await obtain_kafka_consumer_lag_async(cluster_state=cluster_state,
+                                                                   consumer_group=consumer_group)
+
+    result = {}
+    result['consumer_group'] = consumer_group
+    result['consumer_group_lag'] = consumer_group_lag
+    result['timestamp'] = get_epochms()
+    result['elapsed_ms'] = int(round((time.time() - t_start) * 1000))
+
+    return result
+
+
+def create_cluster_metrics(cluster_state, consumer_groups_list):
+    """
+    Creates the metric of every Consumer Group of one cluster on every tenant
+    of tenant_list, and on its 1st loop the thresholds (with overwrite).
+    Blocking, runs in a thread.
+    """
+
+    for tenant in tenant_list:
+
+        dt_metrics_list = obtain_timeseries_metrics(
+            url_tenant=tenant['url_tenant'],
+            f_headers=tenant['f_headers'],
+            log_category='APICall',
+            error_msg="unable to obtain metrics list",
+            log_key='url_tenant',
+            log_value=tenant['url_tenant'])
+
+        for consumer_group in consumer_groups_list:
+            create_kafkalag_metric(
+                url_tenant=tenant['url_tenant'],
+                f_headers=tenant['f_headers'],
+                dt_metrics_list=dt_metrics_list,
+                consumer_group=consumer_group,
+                log_category='APICall',
+                error_msg="unable to create metric",
+                log_key='url_tenant',
+                log_value=tenant['url_tenant'])
+
+        if cluster_state['num_loops'] == 1:
+            threshold_list = get_tenant_threshold_list(
+                url_tenant=tenant['url_tenant'],
+                f_headers=tenant['f_headers'],
+                log_category='GetThresholds',
+                error_msg="unable to get thresholds",
+                log_key='url_tenant',
+                log_value=tenant['url_tenant'],
+                search_threshold='kafka')
+
+            for consumer_group in consumer_groups_list:
+                create_kafka_custom_threshold(
+                    url_tenant=tenant['url_tenant'],
+                    f_headers=tenant['f_headers'],
+                    dt_threshold_list=threshold_list,
+                    consumer_group=consumer_group,
+                    log_category='CreateThresholds',
+                    error_msg="unable to create threshold",
+                    log_key='consumer_group',
+                    log_value=consumer_group,
+                    overwrite=True)
+
+
+async def run_cluster_loop(cluster_state):
+    """
+    The main loop of consumerlag.py for one cluster of clusters
+
+    Waiting for the Kafka commands is done on the event loop, the calls
+    to Dynatrace and the summing of the describe output run in the
+    threads of cluster_state['executor']
+    """
+
+    cluster = cluster_state['cluster']
+    loop_schedule = cluster_state['loop_schedule']
+    push_batch = new_push_batch(custom_device=cluster['custom_device'])
+
+    while True:
+
+        # All clusters log to the same logfile, tagged with cluster=
+        update_app_logfile()
+
+        cluster_state['num_loops'] += 1
+        num_loops = cluster_state['num_loops']
+
+        loop_started_at = start_loop_schedule(loop_schedule=loop_schedule)
+
+        log_to_disk('Loop',
+                    msg="Starting",
+                    kv=kvalue(cluster=cluster_state['name'],
+                              custom_device=cluster['custom_device']))
+
+        consumer_groups_list = await obtain_kafka_consumer_groups_async(cluster_state=cluster_state)
+
+        log_to_disk('GetConsumerGroups',
+                    msg="Results",
+                    kv=kvalue(cluster=cluster_state['name'],
+                              consumer_groups_list=consumer_groups_list,
+                              list_refreshes=cluster_state['consumer_groups_cache']['refreshes']))
+
+        # Nothing to describe this loop if no list could be obtained yet
+        if consumer_groups_list is False:
+            consumer_groups_list = []
+
+        # Only interact with Dynatrace if a) not using the sample data, and b) not set to kafka_only
+        # (push_api v2 has no metrics to register)
+        if app_conf['development'] != True and app_conf['kafka_only'] != True and push_api == 'v1':
+            # metric_mode: single registers its one metric every loop until it is registered
+            if metric_mode == 'single':
+                await asyncio.get_event_loop().run_in_executor(cluster_state['executor'],
+                                                               register_single_metric,
+                                                               tenant_list)
+            elif num_loops == 1 or num_loops % check_metrics_every_x_loops == 0:
+                await asyncio.get_event_loop().run_in_executor(cluster_state['executor'],
+                                                               create_cluster_metrics,
+                                                               cluster_state,
+                                                               consumer_groups_list)
+
+        consumer_groups_due = select_consumer_groups_to_poll(consumer_groups_list=consumer_groups_list,
+                                                             poll_state=cluster_state['poll_state'],
+                                                             loop_started_at=loop_started_at,
+                                                             poll_tiers=poll_tiers,
+                                                             loop_interval_sec=loop_interval_sec)
+
+        semaphore = asyncio.Semaphore(describe_concurrency)
+        tasks = [asyncio.ensure_future(obtain_consumer_group_lag_async(cluster_state=cluster_state,
+                                                                       consumer_group=consumer_group,
+                                                                       semaphore=semaphore))
+                 for consumer_group in consumer_groups_due]
+
+        if len(tasks) > 0:
+            done, not_done = await asyncio.wait(
+                tasks,
+                timeout=max(loop_started_at + loop_deadline_sec - time.time(), 0)
+                if loop_deadline_sec > 0 else None)
+            # Abandoned by loop_deadline_sec, their commands are killed
+            for task in not_done:
+                task.cancel()
+            await asyncio.gather(*not_done, return_exceptions=True)
+
+        consumer_groups_lag = [task.result() for task in tasks if task.done() and not task.cancelled()]
+
+        update_poll_tiers(consumer_groups_lag=consumer_groups_lag,
+                          consumer_groups_list=consumer_groups_list,
+                          poll_state=cluster_state['poll_state'],
+                          loop_started_at=loop_started_at,
+                          poll_tiers=poll_tiers,
+                          get_threshold=get_consumer_group_threshold)
+
+        if len(consumer_groups_lag) < len(consumer_groups_due):
+            finished = set(x['consumer_group'] for x in consumer_groups_lag)
+            abandoned = [x for x in consumer_groups_due if x not in finished]
+            loop_schedule['abandoned_consumer_groups'] += len(abandoned)
+            log_to_disk('GetLag', lvl='WARN',
+                        msg="Deadline reached",
+                        kv=kvalue(cluster=cluster_state['name'],
+                                  loop_deadline_sec=loop_deadline_sec,
+                                  abandoned=abandoned,
+                                  abandoned_consumer_groups=loop_schedule['abandoned_consumer_groups']))
+
+        for result in consumer_groups_lag:
+            consumer_group_lag = result['consumer_group_lag']
+
+            log_to_disk('GetLag',
+                        msg="Results",
+                        kv=kvalue(cluster=cluster_state['name'],
+                                  consumer_group=result['consumer_group'],
+                                  consumer_group_lag=consumer_group_lag,
+                                  elapsed_ms=result['elapsed_ms']))
+
+            # consumer_group_lag could return False or be 0 records
+            if consumer_group_lag is not False and len(consumer_group_lag) > 0:
+                append_consumer_group_samples(cycle_samples=push_batch['samples'],
+                                              consumer_group=result['consumer_group'],
+                                              consumer_group_lag=consumer_group_lag,
+                                              timestamp=result['timestamp'])
+
+        # push_queue may block when the sender is behind, so not on the event loop
+        await asyncio.get_event_loop().run_in_executor(cluster_state['executor'],
+                                                       finish_loop_push_batch, push_batch)
+
+        sleep_sec = finish_loop_schedule(loop_schedule=loop_schedule,
+                                         loop_interval_sec=loop_interval_sec,
+                                         loop_align_to_interval=loop_align_to_interval)
+
+        log_to_disk('Loop',
+                    msg="Finished",
+                    kv=kvalue(cluster=cluster_state['name'], num_loops=num_loops,
+                              loop_elapsed_ms=int(round((time.time() - loop_started_at) * 1000)),
+                              sleep_ms=int(round(sleep_sec * 1000)),
+                              overruns=loop_schedule['overruns'],
+                              skipped_slots=loop_schedule['skipped_slots']))
+
+        if app_conf['development'] == True:
+            return
+
+        await asyncio.sleep(sleep_sec)
+
+
+async def run_clusters(clusters):
+    """
+    Runs the loop of every cluster of clusters concurrently on one event loop
+    """
+
+    cluster_states = []
+    for cluster in clusters:
+        cluster_state = {}
+        cluster_state['cluster'] = cluster
+        cluster_state['name'] = cluster['name'] if 'name' in cluster else cluster['custom_device']
+        cluster_state['num_loops'] = 0
+        cluster_state['poll_state'] = {}
+
+        cluster_state['consumer_groups_cache'] = {}
+        cluster_state['consumer_groups_cache']['consumer_groups_list'] = None
+        cluster_state['consumer_groups_cache']['obtained_at'] = 0
+        cluster_state['consumer_groups_cache']['expired'] = False
+        cluster_state['consumer_groups_cache']['refreshes'] = 0
+
+        cluster_state['loop_schedule'] = new_loop_schedule()
+
+        # Threads of this cluster only, so a slow cluster cannot starve the others
+        # (one summing thread per running describe command)
+        cluster_state['executor'] = ThreadPoolExecutor(max_workers=describe_concurrency)
+
+        cluster_states.append(cluster_state)
+
+    update_app_logfile()
+    log_to_disk('Clusters',
+                msg="Starting",
+                kv=kvalue(clusters=[x['name'] for x in cluster_states]))
+
+    try:
+        await asyncio.gather(*[run_cluster_loop(cluster_state=x) for x in cluster_states])
+    finally:
+        for cluster_state in cluster_states:
+            cluster_state['executor'].shutdown(wait=False)
+
+
+def append_consumer_group_samples(cycle_samples, consumer_group,
+                                  consumer_group_lag, timestamp):
+    """
+    Appends the lag of every topic of consumer_group to cycle_samples,
+    as custom:kafka.consumerlag.<consumer_group>.count with a topic dimension,
+    or with metric_mode: single as custom:kafka.consumerlag.count with
+    consumer_group and topic dimensions
+    """
+
+    if metric_mode == 'single':
+        metric_syntax = 'custom:kafka.consumerlag.count'
+        group_dimension = 'consumer_group'
+    else:
+        metric_syntax = 'custom:kafka.consumerlag.$metric_key.count'
+        group_dimension = None
+
+    for topic_name, topic_value in consumer_group_lag.items():
+        template = series_templates.get(metric_syntax=metric_syntax,
+                                        metric_key=consumer_group,
+                                        dimension_type='topic',
+                                        dimension_value=topic_name,
+                                        group_dimension=group_dimension)
+        cycle_samples.append(template, timestamp, topic_value)
 
 
 def obtain_timeseries_metrics(url_tenant, f_headers,
@@ -227,7 +1045,7 @@ def obtain_timeseries_metrics(url_tenant, f_headers,
     response = None
 
     try:
-        response = requests.get(f_url, headers=f_headers)
+        response = http_request('get', f_url, headers=f_headers)
     except requests.exceptions.RequestException as e:
         log_to_disk(log_category, lvl='ERROR',
                     msg="RequestsError "+log_key+"="+log_value,
@@ -246,11 +1064,19 @@ def create_kafkalag_metric(url_tenant, f_headers,
                            log_category, error_msg,
                            log_key, log_value):
 
-    # Define metric name with standard convention
-    metric_unique = \
-        'custom:kafka.consumerlag.' + \
-        consumer_group.lower() + \
-        '.count'
+    # Define metric name with standard convention,
+    # consumer_group None is the one metric of metric_mode: single
+    if consumer_group is None:
+        metric_unique = 'custom:kafka.consumerlag.count'
+        display_name = 'Lag - Consumer Groups'
+        dimensions = '"consumer_group", "topic"'
+    else:
+        metric_unique = \
+            'custom:kafka.consumerlag.' + \
+            consumer_group.lower() + \
+            '.count'
+        display_name = 'Lag - ' + consumer_group
+        dimensions = '"topic"'
 
     # Check if metric already exists
     if metric_unique in [x['timeseriesId'] for x in dt_metrics_list]:
@@ -265,10 +1091,10 @@ def create_kafkalag_metric(url_tenant, f_headers,
         # metric does not exist in Dynatrace yet
         # proceed with creating
         definition = '{' \
-                 '"displayName" : "Lag - ' + consumer_group + '",' \
+                 '"displayName" : "' + display_name + '",' \
                  '"unit" : "Count",' \
-                 '"dimensions": [' \
-                 '"topic"' \
+                 '"dimensions": [' + \
+                 dimensions + \
                  '],' \
                  '"types": [' \
                  '"Kafka"' \
@@ -291,7 +1117,7 @@ def create_kafkalag_metric(url_tenant, f_headers,
         response = None
 
         try:
-            response = requests.put(url=f_url, headers=f_headers,
+            response = http_request('put', f_url, headers=f_headers,
                                     json=json_definition)
         except requests.exceptions.RequestException as e:
             log_to_disk(log_category, lvl='ERROR',
@@ -314,6 +1140,43 @@ def create_kafkalag_metric(url_tenant, f_headers,
             return f_dict
 
 
+def register_single_metric(tenant_list):
+    """
+    create_single_metric() on every tenant of tenant_list, with the PUTs of
+    custom:kafka.consumerlag.count (consumer_group and topic dimensions)
+    and of its threshold (default_threshold, with overwrite)
+
+    @retval True once both are registered on every tenant
+    """
+
+    registered = True
+
+    for tenant in tenant_list:
+        registered = create_single_metric(
+            tenant,
+            create_metric=lambda: create_kafkalag_metric(
+                url_tenant=tenant['url_tenant'],
+                f_headers=tenant['f_headers'],
+                dt_metrics_list=[],
+                consumer_group=None,
+                log_category='APICall',
+                error_msg="unable to create metric",
+                log_key='url_tenant',
+                log_value=tenant['url_tenant']) is not False,
+            create_threshold=lambda: create_kafka_custom_threshold(
+                url_tenant=tenant['url_tenant'],
+                f_headers=tenant['f_headers'],
+                dt_threshold_list=[],
+                consumer_group=None,
+                log_category='CreateThresholds',
+                error_msg="unable to create threshold",
+                log_key='url_tenant',
+                log_value=tenant['url_tenant'],
+                overwrite=True) is True) and registered
+
+    return registered
+
+
 def get_threshold_definitions(app_conf):
 
     threshold_list = None
@@ -337,14 +1200,22 @@ def create_kafka_custom_threshold(url_tenant, f_headers,
                                   log_key, log_value,
                                   overwrite=False):
 
-    # Define metric unique name for 'timeseriesId'
-    metric_unique = \
-        'custom:kafka.consumerlag.' + \
-        consumer_group.lower() + \
-        '.count'
+    # Define metric unique name for 'timeseriesId',
+    # consumer_group None is the one metric of metric_mode: single
+    # (default_threshold for every Consumer Group, $consumer_group reads 'Kafka')
+    if consumer_group is None:
+        metric_unique = 'custom:kafka.consumerlag.count'
+        threshold_unique = 'kafka.consumerlag'
+        consumer_group_label = 'Kafka'
+    else:
+        metric_unique = \
+            'custom:kafka.consumerlag.' + \
+            consumer_group.lower() + \
+            '.count'
+        threshold_unique = 'kafka.consumerlag.' + consumer_group.lower()
+        consumer_group_label = consumer_group
 
     # Define threshold_url
-    threshold_unique = 'kafka.consumerlag.' + consumer_group.lower()
     uri_threshold = '/api/v1/thresholds/' + threshold_unique
     f_url = urllib.parse.urljoin(url_tenant, uri_threshold)
 
@@ -412,15 +1283,15 @@ def create_kafka_custom_threshold(url_tenant, f_headers,
                     # Grab default threshold
                     threshold = threshold_definition
                     # but then replace the 'consumer_group'
-                    threshold['consumer_group'] = consumer_group
+                    threshold['consumer_group'] = consumer_group_label
 
         # Determine if we are going to replace text
         if '$consumer_group' in threshold['eventName']:
             string = threshold['eventName']
-            threshold['eventName'] = string.replace('$consumer_group', consumer_group)
+            threshold['eventName'] = string.replace('$consumer_group', consumer_group_label)
         if '$consumer_group' in threshold['description']:
             string = threshold['description']
-            threshold['description'] = string.replace('$consumer_group', consumer_group)
+            threshold['description'] = string.replace('$consumer_group', consumer_group_label)
 
         # Grab the metric_unique name for the timeseriesId
         threshold['timeseriesId'] = metric_unique
@@ -459,6 +1330,7 @@ def create_kafka_custom_threshold(url_tenant, f_headers,
                                       requests_status_code=requests_status_code,
                                       requests_content=requests_content
                                       ))
+                return True
             else:
                 log_to_disk(log_category,
                             lvl='ERROR',
@@ -469,6 +1341,7 @@ def create_kafka_custom_threshold(url_tenant, f_headers,
                                       requests_status_code=requests_status_code,
                                       requests_content=requests_content
                                       ))
+                return False
 
 
 
@@ -576,63 +1449,36 @@ def get_tenant_threshold_list(url_tenant, f_headers,
 
         return return_list
 
-def split_large_request(dict_metrics, byte_size_limit):
-
-    byte_size_limit = byte_size_limit if byte_size_limit is not None else 10000
-    byte_size_total = len(json.dumps(dict_metrics).encode('utf-8'))
-    log_to_disk('SplitRequest',
-            msg="Total Size and Byte Size Limit - ",
-            kv=kvalue(byte_size_limit=byte_size_limit,
-                      byte_size_total=byte_size_total))
-
-    if byte_size_total < byte_size_limit:
-        # Do not split into smaller requests, yield original dict_metrics
-        log_to_disk('SplitRequest',
-            msg="Will not proceed with splitting")
-        yield dict_metrics
-
-    else:
-        # Ensure we have a 'series' key
-        if 'series' in dict_metrics:
-            
-            # Determine length of series and number of divisions
-            num_series = len(dict_metrics['series'])
-            num_splits = int( math.ceil(byte_size_total / byte_size_limit) )
-            increment = int( math.ceil(num_series / num_splits) )
-            log_to_disk('SplitRequest',
-                msg="Starting Split into Smaller Requests",
-                kv=kvalue(num_splits=num_splits,
-                          num_series=num_series,
-                          increment=increment))
-
-            # Iterate through splits and yield
-            i = 0
-            while i < num_series:
-                j = i + increment
-                j = j if j < num_series else num_series
-                new_dict = {}
-                new_dict['type'] = dict_metrics['type']
-                new_dict['series'] = dict_metrics['series'][i:j]
-                byte_size_smaller_request=len(json.dumps(new_dict).encode('utf-8'))
-                log_to_disk('SplitRequest',
-                msg="Smaller Request",
-                kv=kvalue(splice_start=i,splice_end=j,byte_size_smaller_request=byte_size_smaller_request))
-
-                i+=increment
-                yield new_dict
-
 def push_custom_metrics(url_tenant, f_headers,
                         custom_device, dict_metrics,
                         log_category, error_msg,
-                        log_key, log_value):
+                        log_key, log_value, data=None,
+                        content_encoding=None, push_api='v1'):
+    """
+    Pushes dict_metrics, or data (dict_metrics already serialized to
+    JSON bytes), to the custom_device
+
+    With push_api='v2', data are lines of the Metrics API v2 line protocol
+    (see split_metric_lines()), pushed to the metrics ingest endpoint
+
+    With content_encoding='gzip', data must already be gzip compressed
+
+    @retval HTTP status code, False if the request failed
+    """
 
     # Define destination URL
-    f_url = url_tenant + \
-            '/api/v1/entity/infrastructure/custom/' + \
-            custom_device
+    if push_api == 'v2':
+        f_url = url_tenant + '/api/v2/metrics/ingest'
+        content_type = 'text/plain; charset=utf-8'
+    else:
+        f_url = url_tenant + \
+                '/api/v1/entity/infrastructure/custom/' + \
+                custom_device
+        content_type = 'application/json'
 
     # Load JSON
-    json_metrics = json.loads(json.dumps(dict_metrics))
+    if data is None:
+        data = json.dumps(dict_metrics).encode('utf-8')
 
     # See app_conf['development'] setting for this
     if app_conf['development'] == True:
@@ -655,8 +1501,11 @@ def push_custom_metrics(url_tenant, f_headers,
         response = None
 
         try:
-            response = requests.post(url=f_url, headers=f_headers,
-                                    json=json_metrics)
+            post_headers = dict(f_headers)
+            post_headers['Content-Type'] = content_type
+            if content_encoding is not None:
+                post_headers['Content-Encoding'] = content_encoding
+            response = http_request('post', f_url, headers=post_headers, data=data)
         except requests.exceptions.RequestException as e:
             log_to_disk(log_category, lvl='ERROR',
                         msg="RequestsError " + log_key + "=" + log_value,
@@ -670,6 +1519,16 @@ def push_custom_metrics(url_tenant, f_headers,
         if response is not None:
 
             requests_content = response.content.decode('utf-8')
+
+            # Non-HTTP 200 response
+            if response.status_code >= 400:
+                log_to_disk(log_category, lvl="ERROR",
+                            msg=error_msg + " " + log_key + "=" + log_value,
+                            kv=kvalue(custom_device=custom_device,
+                                      requests_status_code=response.status_code,
+                                      requests_content=requests_content))
+                return response.status_code
+
             log_to_disk(log_category,
                         msg="Metrics pushed successfully" + \
                             " " + log_key + "=" + log_value,
@@ -678,6 +1537,429 @@ def push_custom_metrics(url_tenant, f_headers,
                                   requests_status_code=response.status_code,
                                   requests_content=requests_content)
                         )
+            return response.status_code
+
+
+def new_push_batch(custom_device):
+    """
+    @retval empty batch of metrics for the custom_device
+    """
+
+    push_batch = {}
+    push_batch['custom_device'] = custom_device
+    push_batch['samples'] = CycleSamples(metric_type='Kafka')
+    push_batch['consumer_groups'] = 0
+    push_batch['loops'] = 0
+    push_batch['batches'] = 0
+    return push_batch
+
+
+def append_consumer_group_result(result, push_batch):
+    """
+    Logs the lag of one Consumer Group and appends its metrics to push_batch
+
+    With push_batch_consumer_groups, the batch is handed to the push sender
+    as soon as it holds that many Consumer Groups, so the push overlaps
+    the collection of the remaining groups (not with push_every_loops,
+    which keeps the batch for several loops)
+    """
+
+    consumer_group = result['consumer_group']
+    consumer_group_lag = result['consumer_group_lag']
+
+    log_to_disk('GetLag',
+                msg="Results",
+                kv=kvalue(consumer_group=consumer_group,
+                          consumer_group_lag=consumer_group_lag,
+                          elapsed_ms=result['elapsed_ms']))
+
+    # consumer_group_lag could return False or be 0 records
+    if consumer_group_lag is not False and len(consumer_group_lag) > 0:
+        append_consumer_group_samples(cycle_samples=push_batch['samples'],
+                                      consumer_group=consumer_group,
+                                      consumer_group_lag=consumer_group_lag,
+                                      timestamp=result['timestamp'])
+
+    push_batch['consumer_groups'] += 1
+
+    if push_batch_consumer_groups > 0 and push_every_loops <= 1 and \
+            push_batch['consumer_groups'] >= push_batch_consumer_groups:
+        flush_push_batch(push_batch)
+
+
+def finish_loop_push_batch(push_batch):
+    """
+    Counts a finished loop in push_batch and hands the batch to the push
+    sender every push_every_loops loops, so each series carries the data
+    points of several loops in one request (always in development)
+    """
+
+    push_batch['loops'] += 1
+
+    if push_batch['loops'] >= push_every_loops or app_conf['development'] == True:
+        flush_push_batch(push_batch)
+
+
+def flush_push_batch(push_batch):
+    """
+    Hands the metrics of push_batch to the push sender and empties it
+    """
+
+    if len(push_batch['samples']) > 0:
+
+        # Debug logging, one line per line protocol line rendered from the samples
+        if common.default.app_debug is True and push_api == 'v2':
+            dimensions = b',custom_device=' + escape_line_dimension(push_batch['custom_device'])
+            for line in push_batch['samples'].iter_lines(dimensions=dimensions):
+                log_to_disk('PushMetrics',
+                            debug=True,
+                            msg="Line",
+                            kv=kvalue(line=line.decode('utf-8')))
+
+        # Debug logging, one line per series rendered from the samples
+        elif common.default.app_debug is True:
+            log_to_disk('PushMetrics',
+                        debug=True,
+                        msg="JSON",
+                        kv=kvalue(type=push_batch['samples'].metric_type,
+                                  series=push_batch['samples'].num_series(),
+                                  data_points=len(push_batch['samples'])))
+            for series in push_batch['samples'].iter_series_dicts():
+                log_to_disk('PushMetrics',
+                            debug=True,
+                            msg="JSON",
+                            kv=kvalue(series=series))
+
+        # Only interact with Dynatrace if a) not using the sample data, and b) not set to kafka_only
+        if app_conf['development'] != True and app_conf['kafka_only'] != True:
+            queue_metrics_push(custom_device=push_batch['custom_device'],
+                               cycle_samples=push_batch['samples'])
+
+        push_batch['batches'] += 1
+
+    push_batch['samples'] = CycleSamples(metric_type='Kafka')
+    push_batch['consumer_groups'] = 0
+    push_batch['loops'] = 0
+
+
+def queue_metrics_push(custom_device, cycle_samples):
+    """
+    Queues the CycleSamples of a batch for run_push_sender()
+
+    push_queue is bounded: when push_queue_size batches are waiting
+    the collector blocks here until the sender caught up
+    """
+
+    item = {}
+    item['custom_device'] = custom_device
+    item['cycle_samples'] = cycle_samples
+    item['queued_at'] = time.time()
+    push_queue.put(item)
+
+
+def run_push_sender():
+    """
+    Background push sender, drains push_queue while the next
+    Consumer Groups are collected: splits every batch as JSON by
+    send_byte_size_limit (or as lines by push_v2_byte_size_limit with
+    push_api v2) and queues the parts to every tenant
+    """
+
+    while True:
+        item = push_queue.get()
+        try:
+            if push_api == 'v2':
+                datas = list(split_metric_lines(item['cycle_samples'],
+                                                custom_device=item['custom_device'],
+                                                byte_size_limit=push_v2_byte_size_limit,
+                                                max_lines=push_v2_max_lines))
+            else:
+                datas = list(split_large_request(item['cycle_samples'],
+                                                 byte_size_limit=send_byte_size_limit))
+            push_metrics_to_tenants(tenant_list=tenant_list,
+                                    custom_device=item['custom_device'],
+                                    datas=datas,
+                                    push_api=push_api)
+            log_to_disk('PushMetrics',
+                        debug=True,
+                        msg="Sender",
+                        kv=kvalue(custom_device=item['custom_device'],
+                                  parts=len(datas),
+                                  queued_ms=int(round((time.time() - item['queued_at']) * 1000)),
+                                  queue_depth=push_queue.qsize()))
+        except Exception as e:
+            log_to_disk('PushMetrics', lvl='ERROR',
+                        msg="Sender unable to push batch",
+                        kv=kvalue(custom_device=item['custom_device'],
+                                  exception=e.__repr__()))
+        finally:
+            push_queue.task_done()
+
+
+def push_metrics_to_tenants(tenant_list, custom_device, datas, push_api='v1'):
+    """
+    Queues the parts of one batch (JSON bytes from split_large_request(),
+    or lines from split_metric_lines() with push_api v2) to every tenant
+    of tenant_list, every tenant pushes the same bytes
+
+    Each tenant has its own push thread, so neither a slow tenant nor its
+    retries hold up the other tenants or the next loop. When a tenant has
+    push_max_pending batches queued already, the new one is spooled for it
+    (push_spool_dir), or dropped without a spool, see admit_push().
+
+    With push_gzip the parts are compressed once here. They were split
+    by their uncompressed size, which is what Dynatrace limits.
+    """
+
+    content_encoding = None
+
+    if push_gzip:
+        byte_size_json = sum(len(data) for data in datas)
+        datas = [gzip.compress(data, compresslevel=push_gzip_level) for data in datas]
+        content_encoding = 'gzip'
+        byte_size_gzip = sum(len(data) for data in datas)
+        log_to_disk('PushMetrics',
+                    debug=True,
+                    msg="Compressed",
+                    kv=kvalue(custom_device=custom_device,
+                              parts=len(datas),
+                              byte_size_json=byte_size_json,
+                              byte_size_gzip=byte_size_gzip,
+                              ratio=round(byte_size_gzip / float(max(byte_size_json, 1)), 3)))
+
+    for tenant in tenant_list:
+        if not admit_push(tenant=tenant,
+                          max_pending=push_max_pending,
+                          custom_device=custom_device,
+                          datas=datas,
+                          content_encoding=content_encoding,
+                          push_api=push_api):
+            continue
+
+        tenant['executor'].submit(push_batch_to_tenant, tenant, custom_device, datas,
+                                  content_encoding, push_api)
+
+
+def push_batch_to_tenant(tenant, custom_device, datas, content_encoding=None, push_api='v1'):
+    """
+    Pushes the parts of one batch to one tenant, up to push_max_in_flight
+    parts at the same time. Runs on the tenant's thread.
+
+    The parts of a batch hold different series, so their order does not
+    matter. Batches stay in order: the next one only starts when every
+    part of this one is done, so the data points of a series never
+    reach Dynatrace older than the ones already pushed.
+
+    With push_spool_dir, parts which still fail after their retries are
+    spooled to disk. Spooled parts are replayed first, and while they
+    can not all be replayed new batches are spooled behind them, so
+    the order holds across an outage as well.
+    """
+
+    t_start = time.time()
+
+    if tenant['spool'] is not None and not tenant['spool'].empty():
+        replayed, replay_status_code = replay_spool_to_tenant(tenant)
+
+        if not tenant['spool'].empty():
+            for data in datas:
+                tenant['spool'].append(custom_device=custom_device,
+                                       data=data,
+                                       content_encoding=content_encoding,
+                                       push_api=push_api)
+
+            with tenant['lock']:
+                tenant['stats']['pending'] -= 1
+                tenant['stats']['parts'] += len(datas)
+                tenant['stats']['spooled'] += len(datas)
+                tenant['stats']['spool_records'] = tenant['spool'].records
+                tenant['stats']['last_elapsed_ms'] = int(round((time.time() - t_start) * 1000))
+
+            log_to_disk('PushMetrics', lvl='WARN',
+                        msg="Spool not replayed yet, spooled batch",
+                        kv=kvalue(tenant=tenant['name'],
+                                  custom_device=custom_device,
+                                  parts=len(datas),
+                                  replayed=replayed,
+                                  replay_status_code=replay_status_code,
+                                  spool_records=tenant['spool'].records))
+            return
+
+    futures = [tenant['part_executor'].submit(push_part_to_tenant, tenant, custom_device,
+                                              data, content_encoding, push_api)
+               for data in datas]
+    part_results = [future.result() for future in futures]
+
+    status_codes = {}
+    failed_parts = 0
+    spooled = 0
+    retries = 0
+    for data, (status_code, part_retries) in zip(datas, part_results):
+        status_codes[status_code] = status_codes.get(status_code, 0) + 1
+        retries += part_retries
+        if status_code is False or (status_code is not None and status_code >= 400):
+            failed_parts += 1
+            if tenant['spool'] is not None and retryable_push_status(status_code):
+                tenant['spool'].append(custom_device=custom_device,
+                                       data=data,
+                                       content_encoding=content_encoding,
+                                       push_api=push_api)
+                spooled += 1
+
+    elapsed_ms = int(round((time.time() - t_start) * 1000))
+
+    with tenant['lock']:
+        tenant['stats']['pending'] -= 1
+        tenant['stats']['parts'] += len(datas)
+        tenant['stats']['failed_parts'] += failed_parts
+        tenant['stats']['retries'] += retries
+        tenant['stats']['spooled'] += spooled
+        tenant['stats']['spool_records'] = tenant['spool'].records if tenant['spool'] is not None else 0
+        tenant['stats']['last_elapsed_ms'] = elapsed_ms
+        if failed_parts > 0:
+            tenant['stats']['failures'] += 1
+        else:
+            tenant['stats']['pushes'] += 1
+
+    log_to_disk('PushMetrics',
+                lvl='INFO' if failed_parts == 0 else 'ERROR',
+                msg="Batch pushed" if failed_parts == 0 else "Batch partly failed",
+                kv=kvalue(tenant=tenant['name'],
+                          custom_device=custom_device,
+                          parts=len(datas),
+                          failed_parts=failed_parts,
+                          status_codes=status_codes,
+                          retries=retries,
+                          spooled=spooled,
+                          elapsed_ms=elapsed_ms))
+
+
+def push_part_to_tenant(tenant, custom_device, data, content_encoding=None, push_api='v1'):
+    """
+    Pushes one serialized part to one tenant, retrying connection
+    errors and HTTP 5xx push_retries times. A 429 is returned right away,
+    http_request() already retried it http_rate_retries times.
+
+    @retval tuple of (last status code or False, number of retries)
+    """
+
+    retries = 0
+
+    while True:
+        status_code = push_custom_metrics(url_tenant=tenant['url_tenant'],
+                                          f_headers=tenant['f_headers'],
+                                          custom_device=custom_device,
+                                          dict_metrics=None,
+                                          log_category='APICall',
+                                          error_msg="unable to push metrics",
+                                          log_key='tenant',
+                                          log_value=tenant['name'],
+                                          data=data,
+                                          content_encoding=content_encoding,
+                                          push_api=push_api)
+
+        if status_code == 429 or not retryable_push_status(status_code) or retries >= push_retries:
+            return status_code, retries
+        retries += 1
+        sleep(retries)
+
+
+def retryable_push_status(status_code):
+    """
+    @retval True for pushes worth sending again: connection errors (False),
+            HTTP 429 and 5xx
+    """
+
+    return status_code is False or \
+        (status_code is not None and (status_code == 429 or status_code >= 500))
+
+
+def replay_spool_to_tenant(tenant):
+    """
+    Replays the tenant's spool oldest first, one push per part without
+    retries, for at most push_spool_replay_sec. Runs on the tenant's thread.
+
+    A part the tenant rejects for good (HTTP 4xx other than 429) is dropped
+    from the spool, a retryable failure stops the replay until the next batch.
+
+    @retval tuple of (parts replayed, status code which stopped the replay or None)
+    """
+
+    replay_deadline = time.time() + push_spool_replay_sec
+    replay = {'status_code': None}
+
+    def send(custom_device, data, content_encoding, push_api):
+        if time.time() >= replay_deadline:
+            return False
+
+        status_code = push_custom_metrics(url_tenant=tenant['url_tenant'],
+                                          f_headers=tenant['f_headers'],
+                                          custom_device=custom_device,
+                                          dict_metrics=None,
+                                          log_category='APICall',
+                                          error_msg="unable to replay spooled metrics",
+                                          log_key='tenant',
+                                          log_value=tenant['name'],
+                                          data=data,
+                                          content_encoding=content_encoding,
+                                          push_api=push_api)
+
+        if retryable_push_status(status_code):
+            replay['status_code'] = status_code
+            return False
+        return True
+
+    replayed, spool_empty = tenant['spool'].replay(send)
+
+    with tenant['lock']:
+        tenant['stats']['replayed'] += replayed
+        tenant['stats']['spool_records'] = tenant['spool'].records
+
+    if replayed > 0 or spool_empty:
+        log_to_disk('PushMetrics',
+                    lvl='INFO' if spool_empty else 'WARN',
+                    msg="Spool replayed" if spool_empty else "Spool partly replayed",
+                    kv=kvalue(tenant=tenant['name'],
+                              replayed=replayed,
+                              spool_records=tenant['spool'].records,
+                              status_code=replay['status_code']))
+
+    return replayed, replay['status_code']
+
+
+def get_rate_limit_cycle_stats(rate_limit_last):
+    """
+    Growth of common.default.http_rate_stats (all threads and tenants)
+    since the copy rate_limit_last was taken at the end of the previous
+    loop, then updates rate_limit_last. The background pushes of the
+    previous loop are counted as well.
+
+    The counters are process-wide, so only the single-cluster loop reports
+    them; the loops of clusters would each count the calls of all clusters.
+
+    @retval dictionary of throttled_ms, throttled and rate_limited
+    """
+
+    rate_stats = dict(common.default.http_rate_stats)
+    cycle_stats = {}
+    cycle_stats['throttled_ms'] = \
+        int(round((rate_stats['throttled_sec'] - rate_limit_last['throttled_sec']) * 1000))
+    cycle_stats['throttled'] = rate_stats['throttled'] - rate_limit_last['throttled']
+    cycle_stats['rate_limited'] = rate_stats['rate_limited'] - rate_limit_last['rate_limited']
+    rate_limit_last.update(rate_stats)
+    return cycle_stats
+
+
+def update_app_logfile():
+    """
+    Points log_to_disk() to today's logfile: app_name_2017-11-06.log
+    """
+
+    app_logfile_string = common.default.app_name.lower() + \
+                         "_" + str(get_date()) + ".log"
+
+    common.default.app_logfile = os.path.join(common.default.app_logdir,
+                                              app_logfile_string)
 
 
 def get_epochms(offset_sec="0"):
@@ -709,11 +1991,172 @@ headers = authentication['headers']
 f_headers = json.loads(headers.replace("'", '"'))
 
 url_tenant = app_conf['url_tenant']
+
+configure_http(app_conf)
+
+# Retries of a failed push per tenant (connection errors and HTTP 5xx, a 429 is retried by http_request())
+push_retries = int(app_conf['push_retries']) if 'push_retries' in app_conf else 2
+
+# Pushes queued per tenant before new ones are dropped for that tenant
+push_max_pending = int(app_conf['push_max_pending']) if 'push_max_pending' in app_conf else 10
+
+# Parts of one split push uploaded at the same time per tenant
+push_max_in_flight = int(app_conf['push_max_in_flight']) if 'push_max_in_flight' in app_conf else 4
+
+# Gzip compress pushed parts (Content-Encoding: gzip), parts are still
+# split by their uncompressed size
+push_gzip = app_conf['push_gzip'] if 'push_gzip' in app_conf else False
+push_gzip_level = int(app_conf['push_gzip_level']) if 'push_gzip_level' in app_conf else 6
+
+# Spool parts a tenant did not accept to disk and replay them once it
+# recovers (one sub-directory per tenant), disabled without push_spool_dir
+push_spool_dir = app_conf['push_spool_dir'] if 'push_spool_dir' in app_conf else None
+push_spool_max_mb = float(app_conf['push_spool_max_mb']) if 'push_spool_max_mb' in app_conf else 100
+push_spool_replay_sec = float(app_conf['push_spool_replay_sec']) if 'push_spool_replay_sec' in app_conf else 10
+
+# Every entry of authentication_list is a tenant the metrics are pushed to,
+# with its own url_tenant (default: the url_tenant above)
+# The list is shared with other applications, only type: 'dynatrace' entries are tenants
+tenant_list = []
+for tenant_authentication in authentication_list:
+    if tenant_authentication.get('type') != 'dynatrace':
+        continue
+    tenant = {}
+    tenant['name'] = tenant_authentication['unique_name']
+    tenant['url_tenant'] = tenant_authentication['url_tenant'] \
+        if 'url_tenant' in tenant_authentication else url_tenant
+    tenant['f_headers'] = json.loads(tenant_authentication['headers'].replace("'", '"'))
+    # One push thread per tenant, so a slow tenant only delays itself,
+    # which uploads the parts of each batch push_max_in_flight at a time
+    tenant['executor'] = ThreadPoolExecutor(max_workers=1)
+    tenant['part_executor'] = ThreadPoolExecutor(max_workers=push_max_in_flight)
+    tenant['lock'] = threading.Lock()
+    # Opened in SCRIPT ACTIONS, once logging is set up
+    tenant['spool'] = None
+    # Registered metric and threshold of metric_mode: single, see create_single_metric()
+    tenant['single_metric'] = {'metric': False, 'threshold': False, 'registering': False}
+    tenant['stats'] = {}
+    tenant['stats']['pushes'] = 0
+    tenant['stats']['failures'] = 0
+    tenant['stats']['parts'] = 0
+    tenant['stats']['failed_parts'] = 0
+    tenant['stats']['retries'] = 0
+    tenant['stats']['dropped'] = 0
+    tenant['stats']['pending'] = 0
+    tenant['stats']['spooled'] = 0
+    tenant['stats']['replayed'] = 0
+    tenant['stats']['spool_records'] = 0
+    tenant['stats']['last_elapsed_ms'] = 0
+    tenant_list.append(tenant)
+
+# Batches of metrics waiting for the background push sender (the collector waits when it is full)
+push_queue_size = int(app_conf['push_queue_size']) if 'push_queue_size' in app_conf else 4
+push_queue = queue.Queue(maxsize=push_queue_size)
+
+# Hand the metrics to the push sender every X Consumer Groups (0 = once per loop)
+push_batch_consumer_groups = int(app_conf['push_batch_consumer_groups']) \
+    if 'push_batch_consumer_groups' in app_conf else 0
+
+# Push every X loops, each series with the data points of X loops
+push_every_loops = int(app_conf['push_every_loops']) if 'push_every_loops' in app_conf else 1
+
+# 'v1' (custom device timeseries, one registered metric per Consumer Group)
+# or 'v2' (Metrics API v2 line protocol, nothing to register)
+push_api = app_conf['push_api'] if 'push_api' in app_conf else 'v1'
+push_v2_metric_key = app_conf['push_v2_metric_key'] if 'push_v2_metric_key' in app_conf else 'kafka.consumerlag'
+push_v2_max_lines = int(app_conf['push_v2_max_lines']) if 'push_v2_max_lines' in app_conf else 1000
+# The Metrics API v2 accepts far larger bodies than the v1 custom device API
+push_v2_byte_size_limit = int(app_conf['push_v2_byte_size_limit']) \
+    if 'push_v2_byte_size_limit' in app_conf else 1000000
+
+# push_api v1: 'per_group' (one custom:kafka.consumerlag.<group>.count metric and threshold
+# per Consumer Group) or 'single' (one custom:kafka.consumerlag.count metric with
+# consumer_group and topic dimensions, registered once)
+metric_mode = app_conf['metric_mode'] if 'metric_mode' in app_conf else 'per_group'
+
+# Series templates per Consumer Group and topic, see SeriesTemplates
+series_template_cache_size = int(app_conf['series_template_cache_size']) \
+    if 'series_template_cache_size' in app_conf else 100000
+series_templates = SeriesTemplates(max_size=series_template_cache_size,
+                                   line_metric_key=push_v2_metric_key if push_api == 'v2' else None)
+
+push_sender = threading.Thread(target=run_push_sender)
+push_sender.daemon = True
+push_sender.start()
 kafka_consumer_groups_list = app_conf['kafka_consumer_groups_list']
 kafka_consumer_groups_describe = app_conf['kafka_consumer_groups_describe']
 endpoint_custom_device = app_conf['custom_device']
 check_metrics_every_x_loops = int(app_conf['check_metrics_every_x_loops'])
 
+# 'describe' (kafka-consumer-groups.sh per Consumer Group),
+# 'all_groups' (one kafka-consumer-groups.sh --all-groups per loop),
+# 'native' (Kafka protocol) or 'helper' (persistent kafka_admin_helper process)
+lag_collector = app_conf['lag_collector'] if 'lag_collector' in app_conf else 'describe'
+
+# 'streaming' (sum line by line) or 'columnar' (NumPy arrays, adds max_lag and partitions)
+lag_aggregation = app_conf['lag_aggregation'] if 'lag_aggregation' in app_conf else 'streaming'
+
+# Number of kafka-consumer-groups.sh --describe commands running in parallel
+describe_concurrency = int(app_conf['describe_concurrency']) if 'describe_concurrency' in app_conf else 1
+
+# Worker threads of the --describe commands, and the commands they are running
+describe_executor = ThreadPoolExecutor(max_workers=describe_concurrency)
+describe_processes = set()
+describe_processes_lock = threading.Lock()
+
+# Re-use the Consumer Group list for this many seconds (0 = run the list command every loop)
+consumer_groups_list_ttl_sec = int(app_conf['consumer_groups_list_ttl_sec']) \
+    if 'consumer_groups_list_ttl_sec' in app_conf else 0
+
+consumer_groups_cache = {}
+consumer_groups_cache['consumer_groups_list'] = None
+consumer_groups_cache['obtained_at'] = 0
+consumer_groups_cache['expired'] = False
+consumer_groups_cache['refreshes'] = 0
+
+# Fetch each partition's log-end offset once per loop for all Consumer Groups
+kafka_shared_log_end_offsets = app_conf['kafka_shared_log_end_offsets'] \
+    if 'kafka_shared_log_end_offsets' in app_conf else True
+
+# Start a loop every loop_interval_sec (0 = back-to-back, as soon as the previous one finished)
+loop_interval_sec = int(app_conf['loop_interval_sec']) if 'loop_interval_sec' in app_conf else 0
+
+# Start the loops on wall-clock multiples of loop_interval_sec
+loop_align_to_interval = app_conf['loop_align_to_interval'] \
+    if 'loop_align_to_interval' in app_conf else False
+
+# Abandon Consumer Groups without lag after this many seconds of a loop (0 = no deadline)
+loop_deadline_sec = int(app_conf['loop_deadline_sec']) if 'loop_deadline_sec' in app_conf else 0
+
+loop_schedule = new_loop_schedule()
+
+# Tiers of poll intervals, hottest first, the last one takes all remaining Consumer Groups
+# (empty = poll every Consumer Group every loop, not used with lag_collector: 'all_groups')
+poll_tiers = app_conf['poll_tiers'] if 'poll_tiers' in app_conf and lag_collector != 'all_groups' else []
+
+# Consumer Group -> tier, polled_at and max_lag of the last poll
+poll_state = {}
+
+# Several Kafka clusters in one process (see run_clusters()), each with its own
+# kafka_consumer_groups_list, kafka_consumer_groups_describe and custom_device
+clusters = app_conf['clusters'] if 'clusters' in app_conf and app_conf['clusters'] else []
+
+# The clusters always use their kafka_consumer_groups_describe commands
+kafka_client = None
+if lag_collector == 'native' and len(clusters) == 0:
+    kafka_client = KafkaWireClient(
+        bootstrap_servers=app_conf['kafka_bootstrap_servers'],
+        timeout_sec=int(app_conf.get('kafka_request_timeout_sec', 10)),
+        security_protocol=app_conf.get('kafka_security_protocol', 'PLAINTEXT'),
+        ssl_cafile=app_conf.get('kafka_ssl_cafile'),
+        sasl_username=app_conf.get('kafka_sasl_username'),
+        sasl_password=app_conf.get('kafka_sasl_password'))
+elif lag_collector == 'helper' and len(clusters) == 0:
+    # Started on the first request, restarted automatically if it dies
+    kafka_client = KafkaAdminHelper(
+        command=app_conf['kafka_admin_helper'],
+        timeout_sec=int(app_conf.get('kafka_admin_helper_timeout_sec', 60)))
+
 
 # DEV AND DEBUG VARIABLES
 
@@ -732,36 +2175,47 @@ else:
 #            SCRIPT ACTIONS
 #   -----------------------------------   #
 
+# Open the spool of every tenant, replayed with the first push
+if push_spool_dir and app_conf['development'] != True and app_conf['kafka_only'] != True:
+    update_app_logfile()
+    for tenant in tenant_list:
+        tenant['spool'] = PushSpool(directory=os.path.join(push_spool_dir, tenant['name']),
+                                    max_bytes=int(push_spool_max_mb * 1024 * 1024))
+        tenant['stats']['spool_records'] = tenant['spool'].records
+
+if len(clusters) > 0:
+    # One asyncio event loop collects every cluster,
+    # the single-cluster loop below is not used
+    event_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(event_loop)
+    event_loop.run_until_complete(run_clusters(clusters))
+    sys.exit(0)
 
 # Initialize number of loops
 num_loops = 0
+rate_limit_last = dict(common.default.http_rate_stats)
+
+# INITIALIZE METRIC_BUILD VARIABLE
+
+# Filled while the Consumer Groups are collected, see append_consumer_group_result(),
+# and kept for push_every_loops loops
+push_batch = new_push_batch(custom_device=endpoint_custom_device)
 
 # Loop indefinitely
 while True:
 
     # Get Logfile name
-    # app_name_2017-11-06.log
-    app_logfile_string = common.default.app_name.lower() + \
-                         "_" + str(get_date()) + ".log"
-
-    common.default.app_logfile = os.path.join(common.default.app_logdir,
-                                              app_logfile_string)
+    update_app_logfile()
 
     # Increase number of loops
     num_loops += 1
 
+    loop_started_at = start_loop_schedule(loop_schedule=loop_schedule)
+
     log_to_disk('Loop',
                 msg="Starting",
                 kv=kvalue(url_tenant=url_tenant))
 
-    # INITIALIZE METRIC_BUILD VARIABLE
-
-    custom_metric_type = 'Kafka'
-
-    metrics_to_push = {}
-    metrics_to_push['type'] = custom_metric_type
-    metrics_to_push['series'] = []
-
 
     #TODO: Add a heartbeat metric here (and add to dynatrace-validate-timeseries)
 
@@ -769,133 +2223,193 @@ while True:
     #  Grab Consumer Group List
     log_to_disk('GetConsumerGroups',
                 msg="Starting",
-                kv=kvalue(kafka_consumer_groups_list=kafka_consumer_groups_list))
-
-    consumer_groups_list = \
-        obtain_kafka_consumer_groups(kafka_consumer_groups_list=kafka_consumer_groups_list)
+                kv=kvalue(kafka_consumer_groups_list=kafka_consumer_groups_list,
+                          lag_collector=lag_collector))
+
+    if lag_collector == 'all_groups':
+        # One --describe --all-groups execution provides both
+        # the Consumer Group list and the lag of every group
+        all_groups_lag = \
+            obtain_kafka_consumer_lag_all_groups(kafka_consumer_groups_describe=kafka_consumer_groups_describe)
+        if all_groups_lag is not False:
+            consumer_groups_list = sorted(all_groups_lag)
+        else:
+            consumer_groups_list = False
+    else:
+        # Only runs the list command every consumer_groups_list_ttl_sec
+        consumer_groups_list = \
+            obtain_kafka_consumer_groups_cached(cache=consumer_groups_cache,
+                                                ttl_sec=consumer_groups_list_ttl_sec)
 
     log_to_disk('GetConsumerGroups',
                 msg="Results",
-                kv=kvalue(consumer_groups_list=consumer_groups_list))
+                kv=kvalue(consumer_groups_list=consumer_groups_list,
+                          list_refreshes=consumer_groups_cache['refreshes']))
+
+    # Nothing to describe this loop if no list could be obtained yet
+    if consumer_groups_list is False:
+        consumer_groups_list = []
+
+    # metric_mode: single has one metric for every Consumer Group, nothing to check per group,
+    # it is registered every loop until it is registered (push_api v2 has no metrics to register)
+    if metric_mode == 'single' and push_api == 'v1':
+
+        # Only interact with Dynatrace if a) not using the sample data, and b) not set to kafka_only
+        if app_conf['development'] != True and app_conf['kafka_only'] != True:
+            register_single_metric(tenant_list)
 
     # If we have run check_metrics_every_x_loops,
     # then we will check for the existence of each metric
-    if num_loops == 1 or num_loops % check_metrics_every_x_loops == 0:
+    elif (num_loops == 1 or num_loops % check_metrics_every_x_loops == 0) and push_api == 'v1':
 
         # Only interact with Dynatrace if a) not using the sample data, and b) not set to kafka_only
         if app_conf['development'] != True and app_conf['kafka_only'] != True:
 
-            # Grab current list of metrics
-            dt_metrics_list = obtain_timeseries_metrics(
-                url_tenant=url_tenant,
-                f_headers=f_headers,
-                log_category='APICall',
-                error_msg="unable to obtain metrics list",
-                log_key='url_tenant',
-                log_value=url_tenant)
+            # Every tenant of tenant_list needs its own metrics and thresholds
+            for tenant in tenant_list:
 
-            # Iterate through Consumer Groups
-            for consumer_group in consumer_groups_list:
-                # Create the metric
-                create_metric_response = create_kafkalag_metric(
-                    url_tenant=url_tenant,
-                    f_headers=f_headers,
-                    dt_metrics_list=dt_metrics_list,
-                    consumer_group=consumer_group,
+                # Grab current list of metrics
+                dt_metrics_list = obtain_timeseries_metrics(
+                    url_tenant=tenant['url_tenant'],
+                    f_headers=tenant['f_headers'],
                     log_category='APICall',
-                    error_msg="unable to create metric",
+                    error_msg="unable to obtain metrics list",
                     log_key='url_tenant',
-                    log_value=url_tenant)
+                    log_value=tenant['url_tenant'])
+
+                # Iterate through Consumer Groups
+                for consumer_group in consumer_groups_list:
+                    # Create the metric
+                    create_metric_response = create_kafkalag_metric(
+                        url_tenant=tenant['url_tenant'],
+                        f_headers=tenant['f_headers'],
+                        dt_metrics_list=dt_metrics_list,
+                        consumer_group=consumer_group,
+                        log_category='APICall',
+                        error_msg="unable to create metric",
+                        log_key='url_tenant',
+                        log_value=tenant['url_tenant'])
 
     # On the 1st execution,
-    # Always create thresholds (with overwrite)
-    if num_loops == 1:
+    # Always create thresholds (with overwrite), they belong to the push_api v1 metrics
+    # (metric_mode: single creates its threshold with its metric)
+    if num_loops == 1 and push_api == 'v1' and metric_mode != 'single':
 
         # Only interact with Dynatrace if a) not using the sample data, and b) not set to kafka_only
         if app_conf['development'] != True and app_conf['kafka_only'] != True:
 
-            # Retrieve current threshold list
-            threshold_list = get_tenant_threshold_list(
-                url_tenant=url_tenant,
-                f_headers=f_headers,
-                log_category='GetThresholds',
-                error_msg="unable to get thresholds",
-                log_key='url_tenant',
-                log_value=url_tenant,
-                search_threshold='kafka'
-            )
-
-            # Create thresholds (with overwrite)
-            create_kafka_custom_threshold(
-                url_tenant=url_tenant,
-                f_headers=f_headers,
-                dt_threshold_list=threshold_list,
-                consumer_group=consumer_group,
-                log_category='CreateThresholds',
-                error_msg="unable to create threshold",
-                log_key='consumer_group',
-                log_value=consumer_group,
-                overwrite=True)
+            # Thresholds are per tenant as well
+            for tenant in tenant_list:
+
+                # Retrieve current threshold list
+                threshold_list = get_tenant_threshold_list(
+                    url_tenant=tenant['url_tenant'],
+                    f_headers=tenant['f_headers'],
+                    log_category='GetThresholds',
+                    error_msg="unable to get thresholds",
+                    log_key='url_tenant',
+                    log_value=tenant['url_tenant'],
+                    search_threshold='kafka'
+                )
+
+                # Create the threshold of every Consumer Group (with overwrite)
+                for consumer_group in consumer_groups_list:
+                    create_kafka_custom_threshold(
+                        url_tenant=tenant['url_tenant'],
+                        f_headers=tenant['f_headers'],
+                        dt_threshold_list=threshold_list,
+                        consumer_group=consumer_group,
+                        log_category='CreateThresholds',
+                        error_msg="unable to create threshold",
+                        log_key='consumer_group',
+                        log_value=consumer_group,
+                        overwrite=True)
 
 
     # Continue with processing
     # Grab topics and sum consumer lag by topic
-    for consumer_group in consumer_groups_list:
-        log_to_disk('GetLag',
-                    debug=True,
-                    msg="Starting",
-                    kv=kvalue(consumer_group=consumer_group,
-                                kafka_consumer_groups_describe=kafka_consumer_groups_describe))
-        consumer_group_lag = \
-            obtain_kafka_consumer_lag(kafka_consumer_groups_describe=kafka_consumer_groups_describe,
-                                      consumer_group=consumer_group)
-
+    consumer_groups_due = select_consumer_groups_to_poll(consumer_groups_list=consumer_groups_list,
+                                                         poll_state=poll_state,
+                                                         loop_started_at=loop_started_at,
+                                                         poll_tiers=poll_tiers,
+                                                         loop_interval_sec=loop_interval_sec)
+
+    # Only a push of every push_batch_consumer_groups takes the results in completion order,
+    # otherwise they are appended in the order of the Consumer Group list
+    stream_results = push_batch_consumer_groups > 0 and push_every_loops <= 1
+
+    t_lag_start = time.time()
+    consumer_groups_lag = obtain_consumer_groups_lag(consumer_groups_list=consumer_groups_due,
+                                                     describe_concurrency=describe_concurrency,
+                                                     deadline=loop_started_at + loop_deadline_sec
+                                                     if loop_deadline_sec > 0 else None,
+                                                     on_result=(lambda result:
+                                                                append_consumer_group_result(result, push_batch))
+                                                     if stream_results else None)
+    lag_elapsed_ms = int(round((time.time() - t_lag_start) * 1000))
+
+    if not stream_results:
+        for result in consumer_groups_lag:
+            append_consumer_group_result(result, push_batch)
+
+    update_poll_tiers(consumer_groups_lag=consumer_groups_lag,
+                      consumer_groups_list=consumer_groups_list,
+                      poll_state=poll_state,
+                      loop_started_at=loop_started_at,
+                      poll_tiers=poll_tiers,
+                      get_threshold=get_consumer_group_threshold)
+
+    # Push what we have, the abandoned Consumer Groups get no sample this loop
+    if len(consumer_groups_lag) < len(consumer_groups_due):
+        finished = set(x['consumer_group'] for x in consumer_groups_lag)
+        abandoned = [x for x in consumer_groups_due if x not in finished]
+        loop_schedule['abandoned_consumer_groups'] += len(abandoned)
+        log_to_disk('GetLag', lvl='WARN',
+                    msg="Deadline reached",
+                    kv=kvalue(loop_deadline_sec=loop_deadline_sec,
+                              abandoned=abandoned,
+                              abandoned_consumer_groups=loop_schedule['abandoned_consumer_groups']))
+
+    # Per-group latency summary, used to tune describe_concurrency
+    if len(consumer_groups_lag) > 0:
+        slowest = max(consumer_groups_lag, key=lambda x: x['elapsed_ms'])
         log_to_disk('GetLag',
-                    msg="Results",
-                    kv=kvalue(consumer_group=consumer_group,
-                              consumer_group_lag=consumer_group_lag))
-
-        # consumer_group_lag could return False or be 0 records
-        if consumer_group_lag is not False and len(consumer_group_lag) > 0:
-            for k, v in consumer_group_lag.items():
-
-                topic_name = k
-                topic_value = v
-
-                append_custom_metrics(
-                    metric_syntax='custom:kafka.consumerlag.$metric_key.count',
-                    metric_key=consumer_group,
-                    dimension_type='topic',
-                    dimension_value=topic_name,
-                    timestamp=get_epochms(),
-                    metric_value=topic_value,
-                    dict_metrics=metrics_to_push)
-
-    # Debug logging
-    log_to_disk('PushMetrics',
-                debug=True,
-                msg="JSON",
-                kv=kvalue(metrics_to_push=metrics_to_push))
+                    msg="Summary",
+                    kv=kvalue(consumer_groups=len(consumer_groups_lag),
+                              describe_concurrency=describe_concurrency,
+                              lag_elapsed_ms=lag_elapsed_ms,
+                              sum_elapsed_ms=sum(x['elapsed_ms'] for x in consumer_groups_lag),
+                              max_elapsed_ms=slowest['elapsed_ms'],
+                              slowest_consumer_group=slowest['consumer_group']))
+
+    # Hand the rest to the push sender (every push_every_loops loops),
+    # which splits and pushes it while the next loop is already collecting
+    finish_loop_push_batch(push_batch)
 
     # Only interact with Dynatrace if a) not using the sample data, and b) not set to kafka_only
     if app_conf['development'] != True and app_conf['kafka_only'] != True:
 
-        # Split metrics
-        for final_metrics in split_large_request(metrics_to_push, byte_size_limit=send_byte_size_limit):
-            push_custom_metrics(url_tenant=url_tenant,
-                                f_headers=f_headers,
-                                custom_device=endpoint_custom_device,
-                                dict_metrics=final_metrics,
-                                log_category='APICall',
-                                error_msg="unable to push metrics",
-                                log_key='url_tenant',
-                                log_value=url_tenant
-                                )
+        log_to_disk('PushMetrics',
+                    msg="Tenants",
+                    kv=kvalue(tenant_stats=dict((x['name'], x['stats'].copy()) for x in tenant_list)))
+
+    loop_elapsed_ms = int(round((time.time() - loop_started_at) * 1000))
+
+    sleep_sec = finish_loop_schedule(loop_schedule=loop_schedule,
+                                     loop_interval_sec=loop_interval_sec,
+                                     loop_align_to_interval=loop_align_to_interval)
 
     log_to_disk('Loop',
                 msg="Finished",
-                kv=kvalue(url_tenant=url_tenant, num_loops=num_loops))
+                kv=kvalue(url_tenant=url_tenant, num_loops=num_loops,
+                          loop_elapsed_ms=loop_elapsed_ms,
+                          sleep_ms=int(round(sleep_sec * 1000)),
+                          overruns=loop_schedule['overruns'],
+                          skipped_slots=loop_schedule['skipped_slots'],
+                          **get_rate_limit_cycle_stats(rate_limit_last)))
 
     if app_conf['development'] == True:
         break
 
+    sleep(sleep_sec)
+
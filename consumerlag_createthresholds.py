@@ -32,21 +32,11 @@ def try_request(f_url, f_headers, log_category, error_msg,
     # Attempt requests
     response = None
 
-    # Determine method type
-    if m == "get":
-        requests_type = requests.get
-    if m == "post":
-        requests_type = requests.post
-    if m == "put":
-        requests_type = requests.put
-    if m == "delete":
-        requests_type = requests.delete
-
     try:
         if json_data == "":
-            response = requests_type(f_url, headers=f_headers)
+            response = http_request(m, f_url, headers=f_headers)
         else:
-            response = requests_type(f_url, headers=f_headers, json=json_data)
+            response = http_request(m, f_url, headers=f_headers, json=json_data)
     except requests.exceptions.RequestException as e:
         log_to_disk(log_category, lvl='ERROR',
                     msg="RequestsError "+log_key+"="+log_value,
@@ -397,6 +387,8 @@ pp = pprint.PrettyPrinter(indent=4)
 
 url_tenant = app_conf['url_tenant']
 
+configure_http(app_conf)
+
 
 # DEV AND DEBUG VARIABLES
 
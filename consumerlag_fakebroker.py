@@ -0,0 +1,287 @@
+import socketserver
+import struct
+import sys
+
+import common
+from common.default import *
+from common.kafkawire import *
+
+#   -----------------------------------   #
+#            LOCAL FUNCTIONS
+#   -----------------------------------   #
+
+# Fake single-node Kafka cluster which answers just enough of the Kafka
+# protocol for lag_collector: 'native' (ApiVersions, Metadata, ListGroups,
+# FindCoordinator, OffsetFetch, DescribeGroups, ListOffsets)
+#
+# Run:  python consumerlag_fakebroker.py 19092 [--legacy] [--debug]
+# Then: kafka_bootstrap_servers: ["localhost:19092"] in consumerlag.yaml
+#
+# The data mirrors the development sample data of consumerlag.py
+
+
+# topic -> list of log-end offsets (one per partition)
+FAKE_LOG_END_OFFSETS = {
+    'perf_db_dt_wa_raw_5': [35253997, 74039511, 60308567, 40349113, 40026470, 45489132],
+    'perf_db_dt_wa_raw_5_reload': [0, 0, 0, 0, 0, 0],
+    'synth_error': [6932623, 0, 0, 0, 0, 0],
+    'updatedb': [0, 0, 0, 0, 0, 0],
+}
+
+# committed offsets per topic, None means no committed offset ("unknown")
+FAKE_COMMITTED_OFFSETS = {
+    'perf_db_dt_wa_raw_5': [35253984, 74039511, 60308560, 40349111, 40026469, 45489131],
+    'perf_db_dt_wa_raw_5_reload': [None, None, None, None, None, None],
+    'synth_error': [6932623, None, None, None, None, None],
+    'updatedb': [None, None, None, None, None, None],
+}
+
+FAKE_CONSUMER_GROUPS = ['MongoInserter',
+                        'ProductHealthDFAGroup',
+                        'syntheticengine_wafpsymsyn03',
+                        'MessageExtractor_Perf_SaaS',
+                        'ProductHealthConsumerGroup',
+                        'syntheticengine_wafpsymsyn01',
+                        'HARSplitter',
+                        'SyntheticEngine',
+                        'DynamicAnomalyEngine2',
+                        'syntheticengine_wafpsymsyn02']
+
+FAKE_NODE_ID = 0
+
+
+def fake_api_versions(reader, version):
+    # --legacy only advertises the oldest version of each request
+    return encode_int16(ERROR_NONE) + encode_array(
+        sorted(CLIENT_API_VERSIONS.items()),
+        lambda item: encode_int16(item[0]) +
+        encode_int16(item[1][0]) +
+        encode_int16(item[1][0] if fake_legacy else item[1][1]))
+
+
+def fake_metadata(reader, version):
+    topics = reader.array(reader.string)
+    if topics is None:
+        topics = sorted(FAKE_LOG_END_OFFSETS)
+
+    def encode_partition(partition):
+        data = encode_int16(ERROR_NONE) + encode_int32(partition) + encode_int32(FAKE_NODE_ID)
+        if version >= 7:
+            data += encode_int32(0)
+        data += encode_array([FAKE_NODE_ID], encode_int32) + \
+            encode_array([FAKE_NODE_ID], encode_int32)
+        if version >= 5:
+            data += encode_array([], encode_int32)
+        return data
+
+    def encode_topic(topic):
+        if topic not in FAKE_LOG_END_OFFSETS:
+            data = encode_int16(ERROR_UNKNOWN_TOPIC_OR_PARTITION) + encode_string(topic) + \
+                encode_int8(0) + encode_array([], encode_partition)
+        else:
+            data = encode_int16(ERROR_NONE) + encode_string(topic) + encode_int8(0) + \
+                encode_array(list(range(len(FAKE_LOG_END_OFFSETS[topic]))), encode_partition)
+        if version >= 8:
+            data += encode_int32(0)
+        return data
+
+    data = b''
+    if version >= 3:
+        data += encode_int32(0)
+    data += encode_array([FAKE_NODE_ID], lambda node_id: encode_int32(node_id) +
+                         encode_string(fake_host) + encode_int32(fake_port) +
+                         encode_string(None))
+    if version >= 2:
+        data += encode_string('fake-cluster')
+    data += encode_int32(FAKE_NODE_ID)
+    data += encode_array(topics, encode_topic)
+    if version >= 8:
+        data += encode_int32(0)
+    return data
+
+
+def fake_list_groups(reader, version):
+    data = b''
+    if version >= 1:
+        data += encode_int32(0)
+    return data + encode_int16(ERROR_NONE) + encode_array(
+        FAKE_CONSUMER_GROUPS,
+        lambda group: encode_string(group) + encode_string('consumer'))
+
+
+def fake_find_coordinator(reader, version):
+    data = b''
+    if version >= 1:
+        data += encode_int32(0) + encode_int16(ERROR_NONE) + encode_string(None)
+    else:
+        data += encode_int16(ERROR_NONE)
+    return data + encode_int32(FAKE_NODE_ID) + encode_string(fake_host) + encode_int32(fake_port)
+
+
+def fake_offset_fetch(reader, version):
+    consumer_group = reader.string()
+    known_group = consumer_group in FAKE_CONSUMER_GROUPS
+
+    def encode_partition(item):
+        partition, offset = item
+        data = encode_int32(partition) + encode_int64(offset if offset is not None else -1)
+        if version >= 5:
+            data += encode_int32(-1)
+        return data + encode_string('') + encode_int16(ERROR_NONE)
+
+    def encode_topic(topic):
+        return encode_string(topic) + \
+            encode_array(list(enumerate(FAKE_COMMITTED_OFFSETS[topic])), encode_partition)
+
+    data = b''
+    if version >= 3:
+        data += encode_int32(0)
+    data += encode_array(sorted(FAKE_COMMITTED_OFFSETS) if known_group else [], encode_topic)
+    return data + encode_int16(ERROR_NONE)
+
+
+def fake_describe_groups(reader, version):
+    consumer_groups = reader.array(reader.string)
+
+    # An unknown group is Dead, newer brokers (--legacy: older ones) answer GROUP_ID_NOT_FOUND
+    def encode_group(consumer_group):
+        if consumer_group in FAKE_CONSUMER_GROUPS:
+            data = encode_int16(ERROR_NONE) + encode_string(consumer_group) + encode_string('Empty')
+        elif fake_legacy:
+            data = encode_int16(ERROR_NONE) + encode_string(consumer_group) + encode_string('Dead')
+        else:
+            data = encode_int16(ERROR_GROUP_ID_NOT_FOUND) + encode_string(consumer_group) + \
+                encode_string('Dead')
+        data += encode_string('consumer') + encode_string('') + encode_array([], None)
+        if version >= 3:
+            data += encode_int32(-2147483648)
+        return data
+
+    data = b''
+    if version >= 1:
+        data += encode_int32(0)
+    return data + encode_array(consumer_groups, encode_group)
+
+
+def fake_list_offsets(reader, version):
+    reader.int32()  # replica_id
+    if version >= 2:
+        reader.int8()  # isolation_level
+
+    def decode_partition():
+        partition = reader.int32()
+        if version >= 4:
+            reader.int32()
+        reader.int64()
+        return partition
+
+    topics = reader.array(lambda: (reader.string(), reader.array(decode_partition)))
+
+    def encode_partition(topic, partition):
+        offsets = FAKE_LOG_END_OFFSETS.get(topic, [])
+        if partition >= len(offsets):
+            data = encode_int32(partition) + encode_int16(ERROR_UNKNOWN_TOPIC_OR_PARTITION) + \
+                encode_int64(-1) + encode_int64(-1)
+        else:
+            data = encode_int32(partition) + encode_int16(ERROR_NONE) + \
+                encode_int64(-1) + encode_int64(offsets[partition])
+        if version >= 4:
+            data += encode_int32(0)
+        return data
+
+    data = b''
+    if version >= 2:
+        data += encode_int32(0)
+    return data + encode_array(topics, lambda item: encode_string(item[0]) + encode_array(
+        item[1], lambda partition: encode_partition(item[0], partition)))
+
+
+FAKE_HANDLERS = {
+    API_VERSIONS: fake_api_versions,
+    API_METADATA: fake_metadata,
+    API_LIST_GROUPS: fake_list_groups,
+    API_FIND_COORDINATOR: fake_find_coordinator,
+    API_OFFSET_FETCH: fake_offset_fetch,
+    API_DESCRIBE_GROUPS: fake_describe_groups,
+    API_LIST_OFFSETS: fake_list_offsets,
+}
+
+
+class FakeBrokerHandler(socketserver.BaseRequestHandler):
+
+    def recv_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def handle(self):
+        while True:
+            size = self.recv_exact(4)
+            if size is None:
+                return
+            payload = self.recv_exact(struct.unpack('>i', size)[0])
+            if payload is None:
+                return
+
+            reader = KafkaWireReader(payload)
+            api_key = reader.int16()
+            api_version = reader.int16()
+            correlation_id = reader.int32()
+            client_id = reader.string()
+
+            log_to_disk('FakeBroker', debug=True,
+                        msg="Request",
+                        kv=kvalue(api_key=api_key, api_version=api_version,
+                                  client_id=client_id))
+
+            if api_key not in FAKE_HANDLERS:
+                # Real brokers also just drop the connection
+                return
+            body = FAKE_HANDLERS[api_key](reader, api_version)
+            response = encode_int32(correlation_id) + body
+            self.request.sendall(encode_int32(len(response)) + response)
+
+
+class FakeBrokerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+#   -----------------------------------   #
+#            VARIABLES
+#   -----------------------------------   #
+
+# GENERAL VARIABLES
+common.default.app_name = "ConsumerLagFakeBroker"
+common.default.app_logdir = "log"
+
+app_logfile_string = common.default.app_name.lower() + \
+                     "_" + str(get_date()) + ".log"
+
+common.default.app_logfile = os.path.join(common.default.app_logdir,
+                                          app_logfile_string)
+
+common.default.app_debug = '--debug' in sys.argv
+fake_legacy = '--legacy' in sys.argv
+
+fake_host = 'localhost'
+fake_port = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 19092
+
+
+#   -----------------------------------   #
+#            SCRIPT ACTIONS
+#   -----------------------------------   #
+
+server = FakeBrokerServer((fake_host, fake_port), FakeBrokerHandler)
+
+log_to_disk('Start', msg="Fake broker listening",
+            kv=kvalue(host=fake_host, port=fake_port))
+
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    server.server_close()
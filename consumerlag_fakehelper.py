@@ -0,0 +1,66 @@
+import json
+import sys
+
+#   -----------------------------------   #
+#            LOCAL FUNCTIONS
+#   -----------------------------------   #
+
+# Fake kafka_admin_helper for lag_collector: 'helper'
+# Answers the line-delimited JSON protocol of common/adminhelper.py
+# with the same sample data as development: True
+#
+# Use in consumerlag.yaml:
+#   kafka_admin_helper:
+#     - "python"
+#     - "consumerlag_fakehelper.py"
+#
+# Optional: "--crash-after", "5" exits after 5 requests to exercise the restart
+
+
+FAKE_CONSUMER_GROUPS = ['MongoInserter',
+                        'ProductHealthDFAGroup',
+                        'syntheticengine_wafpsymsyn03',
+                        'MessageExtractor_Perf_SaaS',
+                        'ProductHealthConsumerGroup',
+                        'syntheticengine_wafpsymsyn01',
+                        'HARSplitter',
+                        'SyntheticEngine',
+                        'DynamicAnomalyEngine2',
+                        'syntheticengine_wafpsymsyn02']
+
+FAKE_TOPIC_LAG = {'perf_db_dt_wa_raw_5': 24, 'synth_error': 0}
+
+
+def answer(request):
+    response = {'id': request.get('id')}
+    if request.get('op') == 'list':
+        response['groups'] = FAKE_CONSUMER_GROUPS
+    elif request.get('op') == 'describe':
+        response['group'] = request['group']
+        if request['group'] in FAKE_CONSUMER_GROUPS:
+            response['lag'] = FAKE_TOPIC_LAG
+        else:
+            response['error'] = 'Consumer group ' + request['group'] + ' does not exist'
+    else:
+        response['error'] = 'unknown op ' + str(request.get('op'))
+    return response
+
+
+#   -----------------------------------   #
+#            SCRIPT ACTIONS
+#   -----------------------------------   #
+
+crash_after = None
+if '--crash-after' in sys.argv:
+    crash_after = int(sys.argv[sys.argv.index('--crash-after') + 1])
+
+num_requests = 0
+
+for line in sys.stdin:
+    num_requests += 1
+    if crash_after is not None and num_requests > crash_after:
+        sys.stderr.write('consumerlag_fakehelper: crashing after ' + str(crash_after) + ' requests\n')
+        sys.exit(1)
+
+    sys.stdout.write(json.dumps(answer(json.loads(line))) + '\n')
+    sys.stdout.flush()
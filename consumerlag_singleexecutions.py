@@ -81,7 +81,7 @@ def obtain_timeseries_metrics(url_tenant, f_headers,
     response = None
 
     try:
-        response = requests.get(f_url, headers=f_headers)
+        response = http_request('get', f_url, headers=f_headers)
     except requests.exceptions.RequestException as e:
         log_to_disk(log_category, lvl='ERROR',
                     msg="RequestsError "+log_key+"="+log_value,
@@ -145,7 +145,7 @@ def create_kafkalag_metric(url_tenant, f_headers, dt_metrics_list,
         response = None
 
         try:
-            response = requests.put(url=f_url, headers=f_headers,
+            response = http_request('put', f_url, headers=f_headers,
                                     json=json_definition)
         except requests.exceptions.RequestException as e:
             log_to_disk(log_category, lvl='ERROR',
@@ -190,7 +190,7 @@ def delete_kafkalag_metric(url_tenant, f_headers, consumer_group,
     response = None
 
     try:
-        response = requests.delete(url=f_url, headers=f_headers)
+        response = http_request('delete', f_url, headers=f_headers)
     except requests.exceptions.RequestException as e:
         log_to_disk(log_category, lvl='ERROR',
                     msg="RequestsError " + log_key + "=" + log_value,
@@ -247,9 +247,9 @@ def define_custom_device(url_tenant, f_headers, unique_name, display_name,
     response = None
 
     try:
-        response = requests.post(url=post_url,
-                             headers=f_headers,
-                             json=json_metrics)
+        response = http_request('post', post_url,
+                                headers=f_headers,
+                                json=json_metrics)
     except requests.exceptions.RequestException as e:
         log_to_disk(log_category, lvl='ERROR',
                     msg="RequestsError " + log_key + "=" + log_value,
@@ -304,6 +304,8 @@ f_headers = json.loads(headers.replace("'", '"'))
 url_tenant = app_conf['url_tenant']
 pp = pprint.PrettyPrinter(indent=4)
 
+configure_http(app_conf)
+
 
 #   -----------------------------------   #
 #            SCRIPT ACTIONS
@@ -0,0 +1,127 @@
+import java.io.BufferedReader;
+import java.io.FileDescriptor;
+import java.io.FileInputStream;
+import java.io.FileOutputStream;
+import java.io.InputStream;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.nio.charset.StandardCharsets;
+import java.util.HashMap;
+import java.util.Map;
+import java.util.Properties;
+import java.util.TreeMap;
+import java.util.concurrent.TimeUnit;
+
+import com.fasterxml.jackson.databind.JsonNode;
+import com.fasterxml.jackson.databind.ObjectMapper;
+import com.fasterxml.jackson.databind.node.ArrayNode;
+import com.fasterxml.jackson.databind.node.ObjectNode;
+import org.apache.kafka.clients.admin.AdminClient;
+import org.apache.kafka.clients.admin.AdminClientConfig;
+import org.apache.kafka.clients.admin.ConsumerGroupListing;
+import org.apache.kafka.clients.admin.ListOffsetsResult;
+import org.apache.kafka.clients.admin.OffsetSpec;
+import org.apache.kafka.clients.consumer.OffsetAndMetadata;
+import org.apache.kafka.common.TopicPartition;
+
+/**
+ * Persistent kafka_admin_helper for lag_collector: 'helper' (see common/adminhelper.py)
+ *
+ * Keeps one AdminClient open and answers line-delimited JSON on stdin/stdout.
+ * Needs Java 11+ and the libs of Kafka 2.5+ (which ship Jackson):
+ *
+ *   java -cp "/opt/isv/tools/kafka/libs/*" helper/ConsumerLagHelper.java \
+ *        /tmp/kafka-bin-client.prop localhost:9092
+ *
+ * The first argument is the same file as --command-config (may be ""),
+ * the second one the bootstrap servers.
+ */
+public class ConsumerLagHelper {
+
+    private static final long TIMEOUT_SEC = 30;
+
+    public static void main(String[] args) throws Exception {
+        Properties props = new Properties();
+        if (args.length > 0 && !args[0].isEmpty()) {
+            try (InputStream in = new FileInputStream(args[0])) {
+                props.load(in);
+            }
+        }
+        if (args.length > 1) {
+            props.put(AdminClientConfig.BOOTSTRAP_SERVERS_CONFIG, args[1]);
+        }
+
+        // stdout is reserved for responses, anything else printed goes to stderr
+        PrintStream responses = new PrintStream(
+                new FileOutputStream(FileDescriptor.out), true, "UTF-8");
+        System.setOut(System.err);
+
+        ObjectMapper mapper = new ObjectMapper();
+        BufferedReader requests = new BufferedReader(
+                new InputStreamReader(System.in, StandardCharsets.UTF_8));
+
+        try (AdminClient admin = AdminClient.create(props)) {
+            String line;
+            while ((line = requests.readLine()) != null) {
+                JsonNode request = mapper.readTree(line);
+                ObjectNode response = mapper.createObjectNode();
+                response.set("id", request.get("id"));
+                try {
+                    String op = request.path("op").asText();
+                    if (op.equals("list")) {
+                        list(admin, response);
+                    } else if (op.equals("describe")) {
+                        describe(admin, request.path("group").asText(), response);
+                    } else {
+                        response.put("error", "unknown op " + op);
+                    }
+                } catch (Exception e) {
+                    response.put("error", String.valueOf(e));
+                }
+                responses.println(mapper.writeValueAsString(response));
+            }
+        }
+    }
+
+    private static void list(AdminClient admin, ObjectNode response) throws Exception {
+        ArrayNode groups = response.putArray("groups");
+        for (ConsumerGroupListing listing
+                : admin.listConsumerGroups().all().get(TIMEOUT_SEC, TimeUnit.SECONDS)) {
+            groups.add(listing.groupId());
+        }
+    }
+
+    private static void describe(AdminClient admin, String group, ObjectNode response)
+            throws Exception {
+        response.put("group", group);
+
+        Map<TopicPartition, OffsetAndMetadata> committed = admin
+                .listConsumerGroupOffsets(group)
+                .partitionsToOffsetAndMetadata()
+                .get(TIMEOUT_SEC, TimeUnit.SECONDS);
+
+        // Partitions without a committed offset have an unknown lag and are skipped
+        Map<TopicPartition, OffsetSpec> latest = new HashMap<>();
+        for (Map.Entry<TopicPartition, OffsetAndMetadata> entry : committed.entrySet()) {
+            if (entry.getValue() != null) {
+                latest.put(entry.getKey(), OffsetSpec.latest());
+            }
+        }
+
+        Map<TopicPartition, ListOffsetsResult.ListOffsetsResultInfo> logEnd = admin
+                .listOffsets(latest)
+                .all()
+                .get(TIMEOUT_SEC, TimeUnit.SECONDS);
+
+        Map<String, Long> topicLag = new TreeMap<>();
+        for (TopicPartition partition : latest.keySet()) {
+            long lag = logEnd.get(partition).offset() - committed.get(partition).offset();
+            topicLag.merge(partition.topic(), Math.max(lag, 0L), Long::sum);
+        }
+
+        ObjectNode lag = response.putObject("lag");
+        for (Map.Entry<String, Long> entry : topicLag.entrySet()) {
+            lag.put(entry.getKey(), entry.getValue());
+        }
+    }
+}
@@ -0,0 +1,54 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import common.default
+
+
+@pytest.fixture(autouse=True)
+def app_logfile(tmp_path):
+    """
+    log_to_disk() needs the globals every script sets up, log to a temporary file
+    """
+    common.default.app_name = 'ConsumerLagTest'
+    common.default.app_debug = False
+    common.default.app_logfile = str(tmp_path / 'consumerlag_test.log')
+    return common.default.app_logfile
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def start_script(tmp_path, args):
+    """
+    Starts one of the consumerlag_*.py scripts from tmp_path (its log directory)
+    """
+    os.makedirs(str(tmp_path / 'log'), exist_ok=True)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_DIR
+    return subprocess.Popen([sys.executable, os.path.join(REPO_DIR, args[0])] + args[1:],
+                            cwd=str(tmp_path), env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_for_port(port, process, timeout_sec=10):
+    deadline = time.time() + timeout_sec
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('script exited with returncode=' + str(process.returncode))
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('nothing listening on port ' + str(port))
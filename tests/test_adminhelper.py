@@ -0,0 +1,59 @@
+import os
+import sys
+
+import pytest
+
+from conftest import REPO_DIR
+
+from common.adminhelper import KafkaAdminHelper, KafkaAdminHelperError
+
+
+FAKE_HELPER = [sys.executable, os.path.join(REPO_DIR, 'consumerlag_fakehelper.py')]
+
+
+@pytest.fixture
+def helper():
+    helper = KafkaAdminHelper(FAKE_HELPER, timeout_sec=10)
+    yield helper
+    helper.stop()
+
+
+def test_list_and_describe(helper):
+    assert 'MongoInserter' in helper.list_groups()
+    assert helper.describe_lag('MongoInserter') == {'perf_db_dt_wa_raw_5': 24, 'synth_error': 0}
+
+    # Both requests went to the same process
+    assert helper.starts == 1
+
+
+def test_unknown_group_raises(helper):
+    with pytest.raises(KafkaAdminHelperError):
+        helper.describe_lag('NoSuchGroup')
+
+    # An error response is an answer, the helper keeps running
+    assert helper.describe_lag('MongoInserter') == {'perf_db_dt_wa_raw_5': 24, 'synth_error': 0}
+    assert helper.starts == 1
+
+
+def test_restart_after_crash():
+    helper = KafkaAdminHelper(FAKE_HELPER + ['--crash-after', '2'], timeout_sec=10)
+    try:
+        for i in range(5):
+            assert helper.describe_lag('MongoInserter') == {'perf_db_dt_wa_raw_5': 24, 'synth_error': 0}
+    finally:
+        helper.stop()
+
+    # Each process crashes on its 3rd request, which the next process answers
+    assert helper.starts == 3
+
+
+def test_hung_helper_raises():
+    helper = KafkaAdminHelper([sys.executable, '-c', 'import time; time.sleep(60)'], timeout_sec=0.5)
+    try:
+        with pytest.raises(KafkaAdminHelperError):
+            helper.list_groups()
+    finally:
+        helper.stop()
+
+    # Killed and restarted once before giving up
+    assert helper.starts == 2
@@ -0,0 +1,60 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from common.collect import collect_in_pool
+
+
+@pytest.fixture
+def executor():
+    executor = ThreadPoolExecutor(max_workers=4)
+    yield executor
+    executor.shutdown(wait=True)
+
+
+def obtain_after(delays):
+    def obtain(consumer_group):
+        time.sleep(delays[consumer_group])
+        return {'consumer_group': consumer_group}
+    return obtain
+
+
+def test_results_keep_the_order_of_the_items(executor):
+    # The last groups finish first
+    delays = {'GroupA': 0.3, 'GroupB': 0.2, 'GroupC': 0.1, 'GroupD': 0.0}
+    completed = []
+
+    results, deadline_reached = collect_in_pool(executor=executor,
+                                                obtain=obtain_after(delays),
+                                                items=list(delays),
+                                                on_result=lambda result: completed.append(result['consumer_group']))
+
+    assert not deadline_reached
+    assert [x['consumer_group'] for x in results] == ['GroupA', 'GroupB', 'GroupC', 'GroupD']
+    assert completed == ['GroupD', 'GroupC', 'GroupB', 'GroupA']
+
+
+def test_deadline_abandons_the_unfinished_items(executor):
+    release = threading.Event()
+    completed = []
+
+    def obtain(consumer_group):
+        if consumer_group == 'GroupB':
+            release.wait(5)
+        return {'consumer_group': consumer_group}
+
+    try:
+        results, deadline_reached = collect_in_pool(executor=executor,
+                                                    obtain=obtain,
+                                                    items=['GroupA', 'GroupB', 'GroupC'],
+                                                    deadline=time.time() + 0.3,
+                                                    on_result=lambda result:
+                                                    completed.append(result['consumer_group']))
+    finally:
+        release.set()
+
+    assert deadline_reached
+    assert [x['consumer_group'] for x in results] == ['GroupA', 'GroupC']
+    assert sorted(completed) == ['GroupA', 'GroupC']
@@ -0,0 +1,146 @@
+import email.utils
+import http.server
+import threading
+import time
+
+import pytest
+
+import common.default
+
+
+@pytest.fixture
+def http_globals(monkeypatch):
+    """
+    configure_http() replaces module globals, put them back after the test
+    """
+    for name in ('http_session', 'http_timeout', 'http_rate_limit', 'http_rate_burst', 'http_rate_retries'):
+        monkeypatch.setattr(common.default, name, getattr(common.default, name))
+
+
+def test_configure_http_defaults(http_globals):
+    common.default.configure_http({})
+
+    adapter = common.default.http_session.get_adapter('https://zzz00000.live.dynatrace.com')
+    assert adapter._pool_maxsize == 10
+    assert common.default.http_timeout == (5, 30)
+    assert common.default.http_rate_limit == 0
+    assert common.default.http_rate_retries == 2
+
+
+def test_configure_http_from_app_conf(http_globals):
+    common.default.configure_http({'http_pool_size': 20,
+                                   'http_connect_timeout_sec': 2,
+                                   'http_read_timeout_sec': '60',
+                                   'http_rate_limit_per_sec': 5,
+                                   'http_rate_burst': 20,
+                                   'http_rate_retries': 0})
+
+    adapter = common.default.http_session.get_adapter('http://127.0.0.1:18081')
+    assert adapter._pool_maxsize == 20
+    assert common.default.http_timeout == (2.0, 60.0)
+    assert common.default.http_rate_limit == 5.0
+    assert common.default.http_rate_burst == 20
+    assert common.default.http_rate_retries == 0
+
+
+class FakeTenant(object):
+    """
+    HTTP server answering the first throttled requests with 429, then 200
+    """
+
+    def __init__(self, throttled, headers=None):
+        self.requests = 0
+        tenant = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                tenant.requests += 1
+                self.send_response(429 if tenant.requests <= throttled else 200)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/api/v1/entity/infrastructure/custom/KafkaClusterTest01' % \
+            self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def rate_globals(monkeypatch):
+    monkeypatch.setattr(common.default, 'http_session', None)
+    monkeypatch.setattr(common.default, 'http_rate_limit', 0)
+    monkeypatch.setattr(common.default, 'http_rate_retries', 2)
+    monkeypatch.setattr(common.default, 'http_rate_buckets', {})
+    monkeypatch.setattr(common.default, 'http_rate_stats',
+                        {'throttled_sec': 0.0, 'throttled': 0, 'rate_limited': 0})
+
+
+def test_http_request_retries_429(rate_globals):
+    tenant = FakeTenant(throttled=2, headers={'Retry-After': '0'})
+    try:
+        response = common.default.http_request('post', tenant.url, data=b'{}')
+    finally:
+        tenant.close()
+
+    assert response.status_code == 200
+    assert tenant.requests == 3
+    assert common.default.http_rate_stats['rate_limited'] == 2
+
+
+def test_http_request_returns_429_after_http_rate_retries(rate_globals):
+    tenant = FakeTenant(throttled=10, headers={'Retry-After': '0'})
+    try:
+        response = common.default.http_request('post', tenant.url, data=b'{}')
+    finally:
+        tenant.close()
+
+    assert response.status_code == 429
+    assert tenant.requests == 1 + common.default.http_rate_retries
+
+
+def test_http_request_waits_for_retry_after(rate_globals):
+    tenant = FakeTenant(throttled=1, headers={'Retry-After': '1'})
+    t_start = time.time()
+    try:
+        response = common.default.http_request('post', tenant.url, data=b'{}')
+    finally:
+        tenant.close()
+
+    assert response.status_code == 200
+    assert tenant.requests == 2
+    assert time.time() - t_start >= 0.9
+    assert common.default.http_rate_stats['throttled'] == 1
+
+
+class FakeResponse(object):
+    def __init__(self, headers):
+        self.headers = headers
+
+
+def test_rate_limit_reset_sec_from_retry_after():
+    assert common.default.get_rate_limit_reset_sec(FakeResponse({'Retry-After': '7'})) == 7.0
+
+    retry_after = email.utils.formatdate(time.time() + 30, usegmt=True)
+    reset_sec = common.default.get_rate_limit_reset_sec(FakeResponse({'Retry-After': retry_after}))
+    assert 28 <= reset_sec <= 30
+
+
+def test_rate_limit_reset_sec_from_x_ratelimit_reset():
+    # Dynatrace sends microseconds, seconds and milliseconds are accepted too
+    for scale in (1e6, 1e3, 1):
+        reset = '%d' % ((time.time() + 10) * scale)
+        reset_sec = common.default.get_rate_limit_reset_sec(FakeResponse({'X-RateLimit-Reset': reset}))
+        assert 8 <= reset_sec <= 10
+
+    assert common.default.get_rate_limit_reset_sec(FakeResponse({'X-RateLimit-Reset': 'soon'})) is None
+    assert common.default.get_rate_limit_reset_sec(FakeResponse({})) is None
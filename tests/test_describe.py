@@ -0,0 +1,118 @@
+import pytest
+
+import common.describe
+from common.describe import parse_kafka_consumer_groups_describe, sum_partition_lag, \
+    aggregate_partition_lag_columnar
+
+
+HEADER = 'GROUP           TOPIC     PARTITION  CURRENT-OFFSET  LOG-END-OFFSET  LAG   CONSUMER-ID   HOST            CLIENT-ID'
+
+ALL_GROUPS_OUTPUT = [
+    '',
+    HEADER,
+    'MongoInserter   topic_a   0          35253984        35253997        13    consumer-3-1  /10.200.200.113 consumer-3',
+    'MongoInserter   topic_b   1          -               0               -     consumer-2-1  /10.200.200.113 consumer-2',
+    '',
+    "Consumer group 'HARSplitter' has no active members.",
+    '',
+    HEADER,
+    'HARSplitter     har_key   0          58492           58681           189   -             -               -',
+    'HARSplitter     har_key   1          -               60011           -     -             -               -',
+    '',
+    "Consumer group 'Unassigned' has no active members.",
+    '',
+    HEADER,
+    'NeverCommitted  topic_c   0          -               100             -     -             -               -',
+    '',
+    "Error: Consumer group 'Gone' does not exist.",
+]
+
+
+def test_rows_with_unknown_offsets():
+    rows = list(parse_kafka_consumer_groups_describe(ALL_GROUPS_OUTPUT))
+
+    assert rows == [
+        ('MongoInserter', 'topic_a', 35253984, 35253997, 13),
+        ('MongoInserter', 'topic_b', None, 0, None),
+        ('HARSplitter', 'har_key', 58492, 58681, 189),
+        ('HARSplitter', 'har_key', None, 60011, None),
+        ('NeverCommitted', 'topic_c', None, 100, None),
+    ]
+
+
+def test_seen_groups_include_groups_without_lag():
+    seen_groups = {}
+    list(parse_kafka_consumer_groups_describe(ALL_GROUPS_OUTPUT, seen_groups=seen_groups))
+
+    # In order of appearance, a group which does not exist is not seen
+    assert list(seen_groups) == ['MongoInserter', 'HARSplitter', 'Unassigned', 'NeverCommitted']
+
+
+def test_single_group_without_group_column():
+    lines = [
+        'TOPIC                PARTITION  CURRENT-OFFSET  LOG-END-OFFSET  LAG        CONSUMER-ID                    HOST            CLIENT-ID',
+        'perf_db_dt_wa_raw_5  0          35253984        35253997        13         consumer-3_/10.200.200.113     /10.200.200.113 consumer-3',
+        'synth_error          1          unknown         0               unknown    consumer-2_/10.200.200.113     /10.200.200.113 consumer-2',
+    ]
+
+    assert list(parse_kafka_consumer_groups_describe(lines)) == [
+        (None, 'perf_db_dt_wa_raw_5', 35253984, 35253997, 13),
+        (None, 'synth_error', None, 0, None),
+    ]
+
+
+def test_lines_before_header_and_garbage_are_skipped():
+    lines = [
+        'Note: This will not show information about old Zookeeper-based consumers.',
+        HEADER,
+        'MongoInserter   topic_a   0          abc             35253997        13    consumer-3-1  /10.200.200.113 consumer-3',
+        'MongoInserter   topic_a',
+    ]
+
+    seen_groups = {}
+    assert list(parse_kafka_consumer_groups_describe(lines, seen_groups=seen_groups)) == []
+    assert list(seen_groups) == ['MongoInserter']
+
+
+# A negative LAG (committed offset ahead of a stale LOG-END-OFFSET) and unknown offsets
+LAG_ROWS = [
+    ('MongoInserter', 'topic_a', 35253984, 35253997, 13),
+    ('MongoInserter', 'topic_a', 1000, 990, -10),
+    ('MongoInserter', 'topic_b', None, 0, None),
+    ('HARSplitter', 'har_key', 58492, 58681, 189),
+    ('HARSplitter', 'har_key', None, 60011, None),
+    ('HARSplitter', 'har_key', 200, 150, -50),
+    ('HARSplitter', 'har_stale', 500, 400, -100),
+    ('NeverCommitted', 'topic_c', None, 100, None),
+]
+
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_columnar_matches_streaming(use_numpy):
+    if use_numpy and common.describe.numpy is None:
+        pytest.skip('NumPy is not installed')
+
+    all_groups_lag, num_rows = sum_partition_lag(LAG_ROWS)
+    all_groups_stats, num_columnar_rows = aggregate_partition_lag_columnar(LAG_ROWS, use_numpy=use_numpy)
+
+    assert all_groups_lag == {'MongoInserter': {'topic_a': 3},
+                              'HARSplitter': {'har_key': 139, 'har_stale': -100},
+                              'NeverCommitted': {}}
+    assert num_rows == num_columnar_rows == len(LAG_ROWS)
+    assert {consumer_group: {topic: stats['lag'] for topic, stats in topic_stats.items()}
+            for consumer_group, topic_stats in all_groups_stats.items()} == all_groups_lag
+    assert all_groups_stats['HARSplitter'] == {
+        'har_key': {'lag': 139, 'max_lag': 189, 'partitions': 2},
+        'har_stale': {'lag': -100, 'max_lag': -100, 'partitions': 1},
+    }
+
+
+def test_columnar_with_and_without_numpy_agree():
+    if common.describe.numpy is None:
+        pytest.skip('NumPy is not installed')
+
+    rows = parse_kafka_consumer_groups_describe(ALL_GROUPS_OUTPUT)
+    rows = list(rows) + LAG_ROWS
+
+    assert aggregate_partition_lag_columnar(rows, use_numpy=True) == \
+        aggregate_partition_lag_columnar(rows, use_numpy=False)
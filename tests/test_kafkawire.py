@@ -0,0 +1,100 @@
+import pytest
+
+from conftest import get_free_port, start_script, wait_for_port
+
+from common.kafkawire import ERROR_GROUP_ID_NOT_FOUND, KafkaWireClient, KafkaWireError
+
+
+# Lag of the sample data of consumerlag_fakebroker.py, partitions
+# without a committed offset do not count
+MONGOINSERTER_LAG = {'perf_db_dt_wa_raw_5': 24, 'synth_error': 0}
+
+
+def run_fake_broker(tmp_path, args):
+    port = get_free_port()
+    process = start_script(tmp_path, ['consumerlag_fakebroker.py', str(port)] + args)
+    try:
+        wait_for_port(port, process)
+    except RuntimeError:
+        process.kill()
+        raise
+    return port, process
+
+
+@pytest.fixture(params=[[], ['--legacy']], ids=['latest', 'legacy'])
+def fake_broker(request, tmp_path):
+    port, process = run_fake_broker(tmp_path, request.param)
+    yield port
+    process.kill()
+    process.wait()
+
+
+@pytest.fixture
+def client(fake_broker):
+    client = KafkaWireClient(['localhost:' + str(fake_broker)], timeout_sec=5)
+    yield client
+    client.close()
+
+
+def test_list_groups(client):
+    groups = client.list_groups()
+    assert 'MongoInserter' in groups
+    assert len(groups) == 10
+
+
+def test_describe_lag(client):
+    assert client.describe_lag('MongoInserter') == MONGOINSERTER_LAG
+
+
+def test_describe_lag_unknown_group(client):
+    with pytest.raises(KafkaWireError, match='does not exist') as e:
+        client.describe_lag('NoSuchGroup')
+    assert e.value.error_code == ERROR_GROUP_ID_NOT_FOUND
+
+    # Also when the group was prefetched with the others
+    client.prefetch_cycle(['MongoInserter', 'NoSuchGroup'])
+    assert client.describe_lag('MongoInserter') == MONGOINSERTER_LAG
+    with pytest.raises(KafkaWireError, match='does not exist'):
+        client.describe_lag('NoSuchGroup')
+
+
+def test_describe_lag_prefetched(client):
+    partitions = client.prefetch_cycle(['MongoInserter', 'HARSplitter'])
+    # Every partition with a committed offset, the same for both groups
+    assert partitions == 7
+
+    # One ListOffsets for the whole cycle, shared by both groups
+    assert client.list_offsets_requests == 1
+    assert client.describe_lag('MongoInserter') == MONGOINSERTER_LAG
+    assert client.describe_lag('HARSplitter') == MONGOINSERTER_LAG
+    assert client.list_offsets_requests == 1
+
+
+def test_unreachable_bootstrap_servers():
+    client = KafkaWireClient(['localhost:' + str(get_free_port())], timeout_sec=1)
+    with pytest.raises(KafkaWireError):
+        client.describe_lag('MongoInserter')
+
+
+class FailingConnection(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def request(self, api_key, body_for_version):
+        raise KafkaWireError('broker gone')
+
+    def close(self):
+        self.closed = True
+
+
+def test_failed_leader_connection_is_closed():
+    client = KafkaWireClient(['localhost:1'])
+    connection = FailingConnection()
+    client.connections[0] = connection
+
+    retry = client._list_offsets_from_leader(0, {'topic_a': [0, 1]}, {})
+
+    assert retry == [('topic_a', 0), ('topic_a', 1)]
+    assert connection.closed
+    assert 0 not in client.connections
@@ -0,0 +1,75 @@
+from common.polltiers import select_consumer_groups_to_poll, update_poll_tiers
+
+POLL_TIERS = [
+    {'name': 'hot', 'poll_every_sec': 15, 'min_threshold_ratio': 0.5, 'min_growth_per_sec': 100},
+    {'name': 'warm', 'poll_every_sec': 60, 'min_threshold_ratio': 0.1, 'min_growth_per_sec': 1},
+    {'name': 'idle', 'poll_every_sec': 300},
+]
+
+THRESHOLDS = {'MongoInserter': 1000.0, 'HARSplitter': 1000.0}
+
+
+def select(consumer_groups_list, poll_state, loop_started_at, poll_tiers=POLL_TIERS):
+    return select_consumer_groups_to_poll(consumer_groups_list=consumer_groups_list,
+                                          poll_state=poll_state,
+                                          loop_started_at=loop_started_at,
+                                          poll_tiers=poll_tiers,
+                                          loop_interval_sec=15)
+
+
+def update(consumer_groups_lag, consumer_groups_list, poll_state, loop_started_at):
+    update_poll_tiers(consumer_groups_lag=[{'consumer_group': consumer_group,
+                                            'consumer_group_lag': consumer_group_lag}
+                                           for consumer_group, consumer_group_lag in consumer_groups_lag],
+                      consumer_groups_list=consumer_groups_list,
+                      poll_state=poll_state,
+                      loop_started_at=loop_started_at,
+                      poll_tiers=POLL_TIERS,
+                      get_threshold=THRESHOLDS.get)
+
+
+def test_without_poll_tiers_every_group_is_due():
+    consumer_groups_list = ['HARSplitter', 'MongoInserter']
+    poll_state = {'HARSplitter': {'tier': 'idle', 'polled_at': 1000.0, 'max_lag': 0}}
+
+    assert select(consumer_groups_list, poll_state, 1015.0, poll_tiers=[]) == consumer_groups_list
+
+
+def test_groups_are_placed_by_threshold_ratio_and_growth():
+    consumer_groups_list = ['HARSplitter', 'MongoInserter', 'NoThreshold', 'Failed']
+    poll_state = {}
+
+    update([('HARSplitter', {'har_key': 600}),
+            ('MongoInserter', {'topic_a': 150, 'topic_b': 20}),
+            ('NoThreshold', {'topic_c': 10}),
+            ('Failed', False)],
+           consumer_groups_list, poll_state, 1000.0)
+
+    assert poll_state == {'HARSplitter': {'tier': 'hot', 'polled_at': 1000.0, 'max_lag': 600},
+                          'MongoInserter': {'tier': 'warm', 'polled_at': 1000.0, 'max_lag': 150},
+                          'NoThreshold': {'tier': 'idle', 'polled_at': 1000.0, 'max_lag': 10}}
+
+    # Growing by 2/sec moves a group without threshold to warm
+    update([('NoThreshold', {'topic_c': 130})], consumer_groups_list, poll_state, 1060.0)
+    assert poll_state['NoThreshold'] == {'tier': 'warm', 'polled_at': 1060.0, 'max_lag': 130}
+
+
+def test_groups_are_due_by_the_interval_of_their_tier():
+    consumer_groups_list = ['HARSplitter', 'MongoInserter', 'NoThreshold', 'New']
+    poll_state = {'HARSplitter': {'tier': 'hot', 'polled_at': 1000.0, 'max_lag': 600},
+                  'MongoInserter': {'tier': 'warm', 'polled_at': 1000.0, 'max_lag': 150},
+                  'NoThreshold': {'tier': 'idle', 'polled_at': 1000.0, 'max_lag': 10}}
+
+    assert select(consumer_groups_list, poll_state, 1015.0) == ['HARSplitter', 'New']
+    # Up to half a loop_interval_sec early still counts
+    assert select(consumer_groups_list, poll_state, 1052.6) == ['HARSplitter', 'MongoInserter', 'New']
+    assert select(consumer_groups_list, poll_state, 1300.0) == consumer_groups_list
+
+
+def test_failed_poll_keeps_the_tier_and_removed_groups_are_dropped():
+    poll_state = {'HARSplitter': {'tier': 'hot', 'polled_at': 1000.0, 'max_lag': 600},
+                  'Gone': {'tier': 'idle', 'polled_at': 1000.0, 'max_lag': 0}}
+
+    update([('HARSplitter', False)], ['HARSplitter'], poll_state, 1015.0)
+
+    assert poll_state == {'HARSplitter': {'tier': 'hot', 'polled_at': 1015.0, 'max_lag': 600}}
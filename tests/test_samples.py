@@ -0,0 +1,224 @@
+import json
+
+from common.samples import CycleSamples, SeriesTemplates, split_large_request, split_metric_lines, escape_line_dimension
+
+
+def make_template(consumer_group, topic):
+    """
+    Same fields as SeriesTemplates.get() makes without line_metric_key
+    """
+    template = {}
+    template['key'] = (consumer_group, topic)
+    template['timeseriesId'] = 'custom:kafka.consumerlag.' + consumer_group.lower() + '.count'
+    template['dimensions'] = {'topic': topic}
+    series_json = json.dumps({'timeseriesId': template['timeseriesId'],
+                              'dimensions': template['dimensions'],
+                              'dataPoints': []}).encode('utf-8')
+    template['json_prefix'] = series_json[:-len(b'[]}')]
+    return template
+
+
+def make_samples(num_series, timestamp=1520803905262):
+    cycle_samples = CycleSamples()
+    for i in range(num_series):
+        cycle_samples.append(make_template('Group%d' % i, 'topic_%d' % i), timestamp, 1000 + i)
+    return cycle_samples
+
+
+def expected_part(series):
+    return json.dumps({'type': 'Kafka', 'series': series}).encode('utf-8')
+
+
+def test_split_large_request_under_limit():
+    cycle_samples = make_samples(3)
+
+    parts = list(split_large_request(cycle_samples, byte_size_limit=10000))
+
+    assert parts == [expected_part(list(cycle_samples.iter_series_dicts()))]
+
+
+def test_split_large_request_parts_match_json_dumps():
+    cycle_samples = make_samples(20)
+    all_series = list(cycle_samples.iter_series_dicts())
+
+    parts = list(split_large_request(cycle_samples, byte_size_limit=1000))
+
+    assert len(parts) > 1
+    pushed_series = []
+    for part in parts:
+        series = json.loads(part.decode('utf-8'))['series']
+        assert part == expected_part(series)
+        assert len(part) <= 1000
+        pushed_series.extend(series)
+    assert pushed_series == all_series
+
+
+def test_split_large_request_fills_parts_up_to_the_limit():
+    cycle_samples = make_samples(5)
+    all_series = list(cycle_samples.iter_series_dicts())
+    byte_size_limit = len(expected_part(all_series[:2]))
+
+    # A part of exactly byte_size_limit bytes still fits
+    parts = list(split_large_request(cycle_samples, byte_size_limit=byte_size_limit))
+    assert parts == [expected_part(all_series[:2]),
+                     expected_part(all_series[2:4]),
+                     expected_part(all_series[4:])]
+
+    # One byte less and only one series fits
+    parts = list(split_large_request(cycle_samples, byte_size_limit=byte_size_limit - 1))
+    assert parts == [expected_part([series]) for series in all_series]
+
+
+def test_split_large_request_series_larger_than_limit():
+    cycle_samples = CycleSamples()
+    big = make_template('Group0', 'topic_0')
+    for i in range(50):
+        cycle_samples.append(big, 1520803905262 + i * 15000, i)
+    cycle_samples.append(make_template('Group1', 'topic_1'), 1520803905262, 1)
+    all_series = list(cycle_samples.iter_series_dicts())
+
+    parts = list(split_large_request(cycle_samples, byte_size_limit=500))
+
+    assert parts == [expected_part(all_series[:1]), expected_part(all_series[1:])]
+    assert len(parts[0]) > 500
+
+
+def test_iter_series_json_matches_json_dumps():
+    cycle_samples = make_samples(3)
+
+    assert list(cycle_samples.iter_series_json()) == \
+        [json.dumps(series).encode('utf-8') for series in cycle_samples.iter_series_dicts()]
+
+
+def test_data_points_of_several_loops_are_grouped_by_series():
+    group_a = make_template('GroupA', 'topic_a')
+    group_b = make_template('GroupB', 'topic_b')
+    cycle_samples = CycleSamples()
+    cycle_samples.append(group_a, 1520803905262, 54171)
+    cycle_samples.append(group_b, 1520803905301, 169)
+    cycle_samples.append(make_template('GroupA', 'topic_a'), 1520803920262, 54012)
+    cycle_samples.append(group_b, 1520803920301, 170)
+
+    assert len(cycle_samples) == 4
+    assert cycle_samples.num_series() == 2
+    assert list(cycle_samples.iter_series_dicts()) == [
+        {'timeseriesId': 'custom:kafka.consumerlag.groupa.count',
+         'dimensions': {'topic': 'topic_a'},
+         'dataPoints': [[1520803905262, 54171], [1520803920262, 54012]]},
+        {'timeseriesId': 'custom:kafka.consumerlag.groupb.count',
+         'dimensions': {'topic': 'topic_b'},
+         'dataPoints': [[1520803905301, 169], [1520803920301, 170]]},
+    ]
+    assert list(cycle_samples.iter_series_json()) == \
+        [json.dumps(series).encode('utf-8') for series in cycle_samples.iter_series_dicts()]
+
+
+def test_iter_lines_one_line_per_data_point():
+    group_a = make_template('GroupA', 'topic_a')
+    group_a['line_prefix'] = b'kafka.consumerlag,group=GroupA,topic=topic_a'
+    cycle_samples = CycleSamples()
+    cycle_samples.append(group_a, 1520803905262, 54171)
+    cycle_samples.append(group_a, 1520803920262, 54012)
+
+    assert list(cycle_samples.iter_lines(dimensions=b',custom_device=KafkaClusterTest01')) == [
+        b'kafka.consumerlag,group=GroupA,topic=topic_a,custom_device=KafkaClusterTest01 54171 1520803905262',
+        b'kafka.consumerlag,group=GroupA,topic=topic_a,custom_device=KafkaClusterTest01 54012 1520803920262',
+    ]
+
+
+def test_escape_line_dimension():
+    assert escape_line_dimension('MongoInserter') == b'MongoInserter'
+    assert escape_line_dimension('Mongo Inserter') == b'"Mongo Inserter"'
+    assert escape_line_dimension('a,b=c') == b'"a,b=c"'
+    assert escape_line_dimension('say "hi"\\') == b'"say \\"hi\\"\\\\"'
+    assert escape_line_dimension('line\nbreak') == b'"line break"'
+
+
+def make_line_samples(num_series, timestamp=1520803905262):
+    cycle_samples = CycleSamples()
+    for i in range(num_series):
+        template = make_template('Group%d' % i, 'topic_%d' % i)
+        template['line_prefix'] = b'kafka.consumerlag,group=Group%d,topic=topic_%d' % (i, i)
+        cycle_samples.append(template, timestamp, 1000 + i)
+    return cycle_samples
+
+
+def test_split_metric_lines_by_byte_size_limit():
+    cycle_samples = make_line_samples(5)
+    lines = list(cycle_samples.iter_lines(dimensions=b',custom_device="Kafka Cluster"'))
+    byte_size_limit = len(b'\n'.join(lines[:2]))
+
+    # A part of exactly byte_size_limit bytes still fits
+    parts = list(split_metric_lines(cycle_samples, custom_device='Kafka Cluster',
+                                    byte_size_limit=byte_size_limit, max_lines=1000))
+    assert parts == [b'\n'.join(lines[:2]), b'\n'.join(lines[2:4]), lines[4]]
+
+    # One byte less and only one line fits
+    parts = list(split_metric_lines(cycle_samples, custom_device='Kafka Cluster',
+                                    byte_size_limit=byte_size_limit - 1, max_lines=1000))
+    assert parts == lines
+
+
+def test_split_metric_lines_by_max_lines():
+    cycle_samples = make_line_samples(5)
+    lines = list(cycle_samples.iter_lines(dimensions=b',custom_device=KafkaClusterTest01'))
+
+    parts = list(split_metric_lines(cycle_samples, custom_device='KafkaClusterTest01',
+                                    byte_size_limit=10000, max_lines=2))
+
+    assert parts == [b'\n'.join(lines[:2]), b'\n'.join(lines[2:4]), lines[4]]
+
+
+def test_split_metric_lines_line_larger_than_limit():
+    cycle_samples = make_line_samples(3)
+    lines = list(cycle_samples.iter_lines(dimensions=b',custom_device=KafkaClusterTest01'))
+
+    parts = list(split_metric_lines(cycle_samples, custom_device='KafkaClusterTest01',
+                                    byte_size_limit=10, max_lines=1000))
+
+    assert parts == lines
+
+
+METRIC_SYNTAX = 'custom:kafka.consumerlag.$metric_key.count'
+
+
+def test_series_template_fields():
+    series_templates = SeriesTemplates()
+
+    template = series_templates.get(METRIC_SYNTAX, 'GroupA', 'topic', 'topic_a')
+
+    expected = make_template('GroupA', 'topic_a')
+    assert template['timeseriesId'] == expected['timeseriesId']
+    assert template['dimensions'] == expected['dimensions']
+    assert template['json_prefix'] == expected['json_prefix']
+    assert 'line_prefix' not in template
+    # The same template every time
+    assert series_templates.get(METRIC_SYNTAX, 'GroupA', 'topic', 'topic_a') is template
+
+
+def test_series_template_single_metric_and_line_prefix():
+    series_templates = SeriesTemplates(line_metric_key='kafka.consumerlag')
+
+    template = series_templates.get('custom:kafka.consumerlag.count', 'Mongo Inserter', 'topic', 'topic_a',
+                                    group_dimension='consumer_group')
+
+    assert template['timeseriesId'] == 'custom:kafka.consumerlag.count'
+    assert template['dimensions'] == {'consumer_group': 'Mongo Inserter', 'topic': 'topic_a'}
+    assert template['line_prefix'] == b'kafka.consumerlag,group="Mongo Inserter",topic=topic_a'
+
+    cycle_samples = CycleSamples()
+    cycle_samples.append(template, 1520803905262, 54171)
+    assert list(cycle_samples.iter_series_json()) == \
+        [json.dumps(series).encode('utf-8') for series in cycle_samples.iter_series_dicts()]
+
+
+def test_series_templates_full_cache_is_emptied():
+    series_templates = SeriesTemplates(max_size=2)
+    first = series_templates.get(METRIC_SYNTAX, 'Group0', 'topic', 'topic_0')
+    series_templates.get(METRIC_SYNTAX, 'Group1', 'topic', 'topic_1')
+    assert len(series_templates) == 2
+
+    series_templates.get(METRIC_SYNTAX, 'Group2', 'topic', 'topic_2')
+
+    assert len(series_templates) == 1
+    assert series_templates.get(METRIC_SYNTAX, 'Group0', 'topic', 'topic_0') is not first
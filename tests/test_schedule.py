@@ -0,0 +1,70 @@
+import pytest
+
+import common.schedule
+from common.schedule import new_loop_schedule, start_loop_schedule, finish_loop_schedule
+
+
+class FakeClock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock(1000.5)
+    monkeypatch.setattr(common.schedule.time, 'time', clock)
+    return clock
+
+
+def test_back_to_back_without_interval(clock):
+    loop_schedule = new_loop_schedule()
+    start_loop_schedule(loop_schedule)
+    clock.now += 100
+
+    assert finish_loop_schedule(loop_schedule, loop_interval_sec=0, loop_align_to_interval=True) == 0
+    assert loop_schedule['overruns'] == 0
+
+
+def test_slots_follow_each_other_by_the_interval(clock):
+    loop_schedule = new_loop_schedule()
+    assert start_loop_schedule(loop_schedule) == 1000.5
+
+    clock.now += 4
+    assert finish_loop_schedule(loop_schedule, 15, loop_align_to_interval=False) == 11
+    assert loop_schedule['slot_start'] == 1015.5
+
+    # A slow start of the next loop does not shift the slots
+    clock.now = 1016.5
+    start_loop_schedule(loop_schedule)
+    clock.now += 2
+    assert finish_loop_schedule(loop_schedule, 15, loop_align_to_interval=False) == 12
+    assert loop_schedule['slot_start'] == 1030.5
+
+
+def test_aligned_slots_are_multiples_of_the_interval(clock):
+    loop_schedule = new_loop_schedule()
+    start_loop_schedule(loop_schedule)
+
+    clock.now += 4
+    assert finish_loop_schedule(loop_schedule, 15, loop_align_to_interval=True) == 1005 - 1004.5
+    assert loop_schedule['slot_start'] == 1005
+
+    clock.now = 1006
+    start_loop_schedule(loop_schedule)
+    assert finish_loop_schedule(loop_schedule, 15, loop_align_to_interval=True) == 14
+    assert loop_schedule['slot_start'] == 1020
+
+
+def test_overrun_skips_the_missed_slots(clock):
+    loop_schedule = new_loop_schedule()
+    start_loop_schedule(loop_schedule)
+
+    # Runs past the start of the next two slots (1015.5 and 1030.5)
+    clock.now += 40
+    assert finish_loop_schedule(loop_schedule, 15, loop_align_to_interval=False) == 5
+    assert loop_schedule['slot_start'] == 1045.5
+    assert loop_schedule['overruns'] == 1
+    assert loop_schedule['skipped_slots'] == 2
@@ -0,0 +1,98 @@
+import threading
+
+from common.singlemetric import create_single_metric
+
+
+def make_tenant():
+    tenant = {}
+    tenant['lock'] = threading.Lock()
+    tenant['single_metric'] = {'metric': False, 'threshold': False, 'registering': False}
+    return tenant
+
+
+class FakePut(object):
+    """
+    create_metric() / create_threshold() of create_single_metric(), answers from results
+    """
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.results.pop(0)
+
+
+def test_registered_once():
+    tenant = make_tenant()
+    create_metric = FakePut(True)
+    create_threshold = FakePut(True)
+
+    assert create_single_metric(tenant, create_metric, create_threshold)
+    assert create_single_metric(tenant, create_metric, create_threshold)
+
+    assert create_metric.calls == 1
+    assert create_threshold.calls == 1
+
+
+def test_failed_puts_are_retried_until_registered():
+    tenant = make_tenant()
+    create_metric = FakePut(False, True)
+    create_threshold = FakePut(False, True)
+
+    # Metric fails, the threshold waits for it
+    assert not create_single_metric(tenant, create_metric, create_threshold)
+    assert (create_metric.calls, create_threshold.calls) == (1, 0)
+
+    # Metric created, threshold fails
+    assert not create_single_metric(tenant, create_metric, create_threshold)
+    assert (create_metric.calls, create_threshold.calls) == (2, 1)
+
+    # Only the threshold is PUT again
+    assert create_single_metric(tenant, create_metric, create_threshold)
+    assert (create_metric.calls, create_threshold.calls) == (2, 2)
+    assert tenant['single_metric'] == {'metric': True, 'threshold': True, 'registering': False}
+
+
+def test_exception_releases_the_registration():
+    tenant = make_tenant()
+
+    def create_metric():
+        raise RuntimeError('connection reset')
+
+    try:
+        create_single_metric(tenant, create_metric, FakePut(True))
+    except RuntimeError:
+        pass
+
+    assert tenant['single_metric'] == {'metric': False, 'threshold': False, 'registering': False}
+    assert create_single_metric(tenant, FakePut(True), FakePut(True))
+
+
+def test_concurrent_callers_register_once():
+    tenant = make_tenant()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def create_metric():
+        calls.append('metric')
+        started.set()
+        release.wait(5)
+        return True
+
+    registering = threading.Thread(target=create_single_metric,
+                                   args=(tenant, create_metric, lambda: True))
+    registering.start()
+    started.wait(5)
+
+    # Another cluster skips it while the first one registers
+    assert not create_single_metric(tenant, create_metric, lambda: True)
+
+    release.set()
+    registering.join(5)
+
+    assert calls == ['metric']
+    assert create_single_metric(tenant, create_metric, lambda: True)
+    assert calls == ['metric']
@@ -0,0 +1,158 @@
+import base64
+import json
+import os
+import threading
+
+from common.spool import PushSpool, admit_push
+
+
+def make_spool(tmp_path, max_bytes=1024 * 1024, segment_bytes=4 * 1024 * 1024):
+    return PushSpool(directory=str(tmp_path / 'spool' / 'tenant'),
+                     max_bytes=max_bytes,
+                     segment_bytes=segment_bytes)
+
+
+class Sender(object):
+    """
+    send() of PushSpool.replay(), accepts the first accept records (all if None), then fails
+    """
+
+    def __init__(self, accept=None):
+        self.accept = accept
+        self.sent = []
+
+    def __call__(self, custom_device, data, content_encoding, push_api):
+        if self.accept is not None and len(self.sent) >= self.accept:
+            return False
+        self.sent.append((custom_device, data, content_encoding, push_api))
+        return True
+
+
+def test_append_and_replay_in_order(tmp_path):
+    spool = make_spool(tmp_path)
+    spool.append('KafkaClusterTest01', b'{"series": [1]}')
+    spool.append('KafkaClusterTest01', b'\x1f\x8b gzip', content_encoding='gzip')
+    spool.append('KafkaClusterTest02', b'kafka.consumerlag 1', push_api='v2')
+    assert spool.records == 3
+
+    send = Sender()
+    assert spool.replay(send) == (3, True)
+
+    assert send.sent == [('KafkaClusterTest01', b'{"series": [1]}', None, 'v1'),
+                         ('KafkaClusterTest01', b'\x1f\x8b gzip', 'gzip', 'v1'),
+                         ('KafkaClusterTest02', b'kafka.consumerlag 1', None, 'v2')]
+    assert spool.empty()
+    assert spool.replay(Sender()) == (0, True)
+
+
+def test_failed_send_keeps_the_record(tmp_path):
+    spool = make_spool(tmp_path)
+    for i in range(3):
+        spool.append('KafkaClusterTest01', b'push %d' % i)
+
+    assert spool.replay(Sender(accept=1)) == (1, False)
+    assert spool.records == 2
+
+    send = Sender()
+    assert spool.replay(send) == (2, True)
+    assert [x[1] for x in send.sent] == [b'push 1', b'push 2']
+
+
+def test_restart_resumes_at_the_replay_offset(tmp_path):
+    spool = make_spool(tmp_path)
+    for i in range(3):
+        spool.append('KafkaClusterTest01', b'push %d' % i)
+    spool.replay(Sender(accept=2))
+
+    restarted = make_spool(tmp_path)
+    assert restarted.records == 1
+    restarted.append('KafkaClusterTest01', b'push 3')
+
+    send = Sender()
+    assert restarted.replay(send) == (2, True)
+    assert [x[1] for x in send.sent] == [b'push 2', b'push 3']
+
+
+def test_torn_write_is_dropped_on_restart(tmp_path):
+    spool = make_spool(tmp_path)
+    spool.append('KafkaClusterTest01', b'push 0')
+    with open(spool._segment_path(spool.segments[-1]), 'ab') as f:
+        f.write(b'{"custom_device": "KafkaClu')
+
+    restarted = make_spool(tmp_path)
+    assert restarted.records == 1
+    restarted.append('KafkaClusterTest01', b'push 1')
+
+    send = Sender()
+    assert restarted.replay(send) == (2, True)
+    assert [x[1] for x in send.sent] == [b'push 0', b'push 1']
+
+
+def test_full_spool_evicts_the_oldest_segment(tmp_path):
+    data = b'x' * 200
+    spool = make_spool(tmp_path, max_bytes=2000, segment_bytes=500)
+    for i in range(20):
+        spool.append('KafkaClusterTest01', data + b'%02d' % i)
+
+    assert spool.size_bytes() <= 2000 + 500
+    assert spool.records < 20
+
+    send = Sender()
+    replayed, is_empty = spool.replay(send)
+    assert is_empty
+    assert replayed == len(send.sent)
+    # The newest records are kept, in order
+    kept = [int(x[1][len(data):]) for x in send.sent]
+    assert kept == list(range(20 - len(kept), 20))
+
+
+def test_records_without_push_api_replay_as_v1(tmp_path):
+    directory = tmp_path / 'spool' / 'tenant'
+    os.makedirs(str(directory))
+    record = {'custom_device': 'KafkaClusterTest01',
+              'content_encoding': None,
+              'spooled_at': 1520803909.3,
+              'data': base64.b64encode(b'push 0').decode('ascii')}
+    with open(str(directory / '0000000001.spool'), 'wb') as f:
+        f.write(json.dumps(record).encode('utf-8') + b'\n')
+
+    send = Sender()
+    assert make_spool(tmp_path).replay(send) == (1, True)
+    assert send.sent == [('KafkaClusterTest01', b'push 0', None, 'v1')]
+
+
+def make_tenant(spool, pending=0):
+    tenant = {}
+    tenant['name'] = 'https://zzz00000.live.dynatrace.com'
+    tenant['lock'] = threading.Lock()
+    tenant['spool'] = spool
+    tenant['stats'] = {'pending': pending, 'dropped': 0, 'spooled': 0, 'spool_records': 0}
+    return tenant
+
+
+def test_admit_push_below_max_pending(tmp_path):
+    tenant = make_tenant(make_spool(tmp_path), pending=1)
+
+    assert admit_push(tenant, 2, 'KafkaClusterTest01', [b'part 0'])
+    assert tenant['stats']['pending'] == 2
+    assert tenant['spool'].empty()
+
+
+def test_admit_push_spools_when_the_tenant_is_behind(tmp_path):
+    tenant = make_tenant(make_spool(tmp_path), pending=2)
+
+    assert not admit_push(tenant, 2, 'KafkaClusterTest01', [b'part 0', b'part 1'],
+                          content_encoding='gzip', push_api='v2')
+
+    assert tenant['stats'] == {'pending': 2, 'dropped': 0, 'spooled': 2, 'spool_records': 2}
+    send = Sender()
+    assert tenant['spool'].replay(send) == (2, True)
+    assert send.sent == [('KafkaClusterTest01', b'part 0', 'gzip', 'v2'),
+                         ('KafkaClusterTest01', b'part 1', 'gzip', 'v2')]
+
+
+def test_admit_push_drops_without_spool():
+    tenant = make_tenant(None, pending=2)
+
+    assert not admit_push(tenant, 2, 'KafkaClusterTest01', [b'part 0'])
+    assert tenant['stats'] == {'pending': 2, 'dropped': 1, 'spooled': 0, 'spool_records': 0}